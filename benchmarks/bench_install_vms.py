@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+#
+#    Compare the throughput of the generation of the virt-install commands
+#    and of the libvirt domain XML used by vm5k.actions.install_vms
+#
+import sys
+from os import path
+from time import time
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k.actions import define_vms, cmd_install_vm, vm_domain_xml, \
+    domains_bundle
+
+
+def bench(func, vms):
+    """Return the number of VMs treated by second"""
+    start = time()
+    func(vms)
+    return len(vms) / (time() - start)
+
+
+def main():
+    n_vms = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    vms = define_vms(['vm-' + str(i) for i in range(n_vms)],
+                     ip_mac=[('10.0.%d.%d' % (i // 250, i % 250),
+                              '02:00:00:00:%02x:%02x' % (i // 256, i % 256))
+                             for i in range(n_vms)],
+                     host='host-1.site.grid5000.fr')
+    results = [('virt-install commands',
+                bench(lambda vms: [cmd_install_vm(vm) for vm in vms], vms)),
+               ('domain XML',
+                bench(lambda vms: [vm_domain_xml(vm) for vm in vms], vms)),
+               ('domain XML bundle', bench(domains_bundle, vms))]
+    print 'Generation throughput for %s VMs' % (n_vms, )
+    for name, throughput in results:
+        print '%s %10.0f VMs/s' % (name.ljust(25), throughput)
+
+if __name__ == "__main__":
+    main()
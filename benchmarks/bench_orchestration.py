@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+#    Time the orchestration hot paths of vm5k at increasing numbers of VMs,
+#    with Grid'5000 data served by the simulated backend, store the results
+#    as JSON and compare them with a previous run
+#
+import sys
+import json
+import argparse
+import logging
+from os import path
+from math import ceil, log
+from time import time, strftime
+from shutil import rmtree
+from tempfile import mkdtemp
+from collections import OrderedDict
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from execo import logger
+import vm5k.utils
+from vm5k.actions import define_vms, distribute_vms, wait_vms_have_started, \
+    create_disks, install_vms
+from vm5k.backend import set_backend, simulated_backend, simulated_cluster
+from vm5k.deployment import vm5k_deployment
+from vm5k.ippool import ip_mac_pool
+from vm5k.readiness import vm_readiness_monitor
+from vm5k.scheduler import vm_start_scheduler
+from vm5k.services.dnsmasq import dhcp_conf, add_vms
+from vm5k.state import deployment_state
+from vm5k.utils import get_kavlan_ip_mac, prettify
+
+default_sizes = [100, 10000, 100000]
+vms_by_host = 10
+backing_file = '/tmp/vm-base.img'
+
+
+def stub_data(n_vms):
+    """Return the hosts, the (ip, mac) and the VMs of a deployment of n_vms,
+    and install a simulated cluster answering for them"""
+    hosts = ['paravance-%s.rennes.grid5000.fr' % (i + 1, )
+             for i in range(max(1, n_vms // vms_by_host))]
+    ip_mac = [('10.%s.%s.%s' % (16 + i // 62500, i // 250 % 250,
+                                i % 250 + 1),
+               '02:00:%02x:%02x:%02x:%02x' % (i >> 24 & 255, i >> 16 & 255,
+                                              i >> 8 & 255, i & 255))
+              for i in range(n_vms)]
+    cluster = simulated_cluster(hosts, ip_mac, seed=n_vms,
+                                latencies={'boot': (0, 0)})
+    set_backend(simulated_backend(cluster))
+    vm5k.utils.get_kavlan_network = lambda kavlan, site: \
+        ('10.16.0.0', 32 - max(10, int(ceil(log(n_vms + 1024, 2)))))
+    return {'hosts': hosts, 'ip_mac': ip_mac, 'cluster': cluster,
+            'vms': define_vms(['vm-%s' % (i, ) for i in range(n_vms)],
+                              ip_mac=ip_mac, backing_file=backing_file)}
+
+
+def bench_define_vms(data):
+    define_vms(['vm-%s' % (i, ) for i in range(len(data['ip_mac']))],
+               ip_mac=data['ip_mac'], backing_file=backing_file)
+
+
+def bench_distribute_vms(data):
+    distribute_vms(data['vms'], data['hosts'], 'round-robin')
+
+
+def bench_get_kavlan_ip_mac(data):
+    pool = ip_mac_pool(get_kavlan_ip_mac(4, 'rennes')[300:])
+    pool.allocate(len(data['ip_mac']))
+
+
+def bench_dhcp_conf(data):
+    dhcp_conf(data['hosts'][0], data['vms'], ['rennes'])
+
+
+def bench_add_vms(data):
+    add_vms(data['vms'], data['hosts'][0])
+
+
+def bench_add_xml_elements(data):
+    deployment = data['deployment']
+    deployment.state = deployment_state()
+    deployment._add_xml_elements()
+    deployment._add_xml_vms()
+
+
+def bench_prettify(data):
+    prettify(data['deployment'].state.to_xml())
+
+
+def bench_get_state(data):
+    data['deployment'].get_state(name='bench')
+
+
+def bench_print_state_compact(data):
+    data['deployment']._print_state_compact()
+
+
+def bench_wait_vms_have_started(data):
+    for vm in data['vms']:
+        vm['state'] = 'KO'
+    monitor = vm_readiness_monitor(data['vms'], initial_delay=0)
+    wait_vms_have_started(data['vms'], restart=False, monitor=monitor)
+
+
+def setup_deployment(data):
+    """Add to the data a deployment of the VMs on the hosts"""
+    data['outdir'] = mkdtemp(prefix='vm5k_bench_')
+    data['deployment'] = vm5k_deployment(hosts=list(data['hosts']),
+                                         ip_mac=data['ip_mac'],
+                                         vms=data['vms'],
+                                         outdir=data['outdir'])
+
+
+def setup_running_vms(data):
+    """Start the VMs in the simulated cluster"""
+    distribute_vms(data['vms'], data['hosts'], 'round-robin')
+    for host in data['hosts']:
+        data['cluster'].put(host, ([backing_file], '/tmp'))
+    create_disks(data['vms']).run()
+    install_vms(data['vms'], mode='xml').run()
+    vm_start_scheduler(data['vms'], ramp=False).run()
+
+
+benchmarks = OrderedDict([
+    ('define_vms', (None, bench_define_vms)),
+    ('distribute_vms', (None, bench_distribute_vms)),
+    ('get_kavlan_ip_mac', (None, bench_get_kavlan_ip_mac)),
+    ('dhcp_conf', (None, bench_dhcp_conf)),
+    ('add_vms', (None, bench_add_vms)),
+    ('add_xml_elements', (setup_deployment, bench_add_xml_elements)),
+    ('prettify', (setup_deployment, bench_prettify)),
+    ('get_state', (setup_deployment, bench_get_state)),
+    ('print_state_compact', (setup_deployment, bench_print_state_compact)),
+    ('wait_vms_have_started', (setup_running_vms,
+                               bench_wait_vms_have_started))])
+
+
+def run(sizes, names, repeat):
+    """Return a dict whose keys are the benchmarks and values a dict whose
+    keys are the sizes and values the best duration of the benchmark"""
+    results = OrderedDict((name, OrderedDict()) for name in names)
+    for n_vms in sizes:
+        data = stub_data(n_vms)
+        done_setups = set()
+        for name in names:
+            setup, func = benchmarks[name]
+            if setup and setup not in done_setups:
+                setup(data)
+                done_setups.add(setup)
+            durations = []
+            for _ in range(repeat if n_vms < max(default_sizes) else 1):
+                start = time()
+                func(data)
+                durations.append(time() - start)
+            results[name][str(n_vms)] = min(durations)
+            print '%s %8s VMs %10.4fs' % (name.ljust(25), n_vms,
+                                          min(durations))
+        if 'outdir' in data:
+            rmtree(data['outdir'], ignore_errors=True)
+    return results
+
+
+def compare(results, reference, tolerance):
+    """Print the ratio between the results and a reference and return the
+    list of (benchmark, size) slower than tolerance times the reference"""
+    regressions = []
+    print '\n%s %8s %10s %10s %7s' % ('benchmark'.ljust(25), 'VMs',
+                                      'reference', 'current', 'ratio')
+    for name, durations in results.iteritems():
+        for n_vms, duration in durations.iteritems():
+            ref = reference.get(name, {}).get(n_vms)
+            if not ref:
+                continue
+            ratio = duration / ref
+            flag = ''
+            if ratio > tolerance:
+                regressions.append((name, n_vms))
+                flag = ' REGRESSION'
+            print '%s %8s %9.4fs %9.4fs %6.2fx%s' % (name.ljust(25), n_vms,
+                                                     ref, duration, ratio,
+                                                     flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the orchestration hot paths of vm5k')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+',
+                        default=default_sizes,
+                        help='numbers of VMs, default to %(default)s')
+    parser.add_argument('-b', '--benchmarks', nargs='+',
+                        choices=benchmarks.keys(), default=benchmarks.keys(),
+                        help='benchmarks to run, default to all')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs of each benchmark, the best is kept')
+    parser.add_argument('-o', '--output',
+                        default='bench_orchestration_' +
+                        strftime('%Y%m%d_%H%M%S') + '.json',
+                        help='JSON file where the results are stored')
+    parser.add_argument('-c', '--compare', metavar='JSON',
+                        help='results of a previous run to compare with')
+    parser.add_argument('-t', '--tolerance', type=float, default=1.5,
+                        help='ratio to the previous run above which a '
+                        'benchmark is a regression, default to %(default)s')
+    args = parser.parse_args()
+    logger.setLevel(logging.ERROR)
+
+    results = run(args.sizes, args.benchmarks, args.repeat)
+    with open(args.output, 'w') as f:
+        json.dump({'date': strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': sys.version.split()[0],
+                   'results': results}, f, indent=2)
+    print 'Results written in %s' % (args.output, )
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)['results']
+        if compare(results, reference, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 from vm5k.engine import *
+from execo import sleep
 from itertools import product, repeat
 
 
@@ -73,9 +74,6 @@ class MicroArchBenchmark(vm5k_engine_para):
             logger.info(style.step('Performing combination ' +\
                     slugify(comb) + ' on ' + host))
 
-            logger.info(host + ': Destroying existing VMS')
-            destroy_vms(hosts)
-
             logger.info(host + ': Defining virtual machines ')
             n_vm = self.comb_nvm(comb)
             if n_vm == 0:
@@ -144,17 +142,14 @@ class MicroArchBenchmark(vm5k_engine_para):
                         str(vm['n_cpu']) + '(' + vm['cpuset'] + ')'
                         for vm in vms]))
 
-            # Create disks, install vms and boot by core
-            logger.info(host + ': Creating disks')
-            create = create_disks(vms).run()
-            if not create.ok:
-                logger.error(host + ': Unable to create the VMS disks %s',
-                             slugify(comb))
-                exit()
-            logger.info(host + ': Installing VMS')
-            install = install_vms(vms).run()
-            if not install.ok:
-                logger.error(host + ': Unable to install the VMS  %s',
+            # Create disks, install vms and boot by core, keeping the
+            # domains and the disks of the previous combination with the
+            # same distribution. The outputs of the kept disks are removed
+            # before the benchmarks.
+            logger.info(host + ': Creating disks and installing VMS')
+            if prepare_vms(vms, hosts, self.host_states,
+                           self.comb_vms_key(comb)) is None:
+                logger.error(host + ': Unable to create the VMS %s',
                              slugify(comb))
                 exit()
             boot_successfull = boot_vms_by_core(vms)
@@ -193,6 +188,13 @@ class MicroArchBenchmark(vm5k_engine_para):
                             vm['id'], slugify(comb))
                         exit()
 
+            rm_outputs = TaktukRemote('rm -f /root/*.out',
+                                      [vm['ip'] for vm in vms]).run()
+            if not rm_outputs.ok:
+                logger.error(host + ': Unable to remove the outputs of %s',
+                             slugify(comb))
+                exit()
+
             # Prepare virtual machines for experiments
             benchs = {
                 'kflops': {
@@ -277,6 +279,11 @@ class MicroArchBenchmark(vm5k_engine_para):
             n_vm += 1
         return n_vm
 
+    def comb_vms_key(self, comb):
+        """The combinations with the same distribution share their single
+        core VMs, only vm-multi changes"""
+        return comb['dist']
+
     def cache_bench(self, vms):
         """Prepare a benchmark command with cachebench"""
         memsize = [str(27 + int(vm['n_cpu'])) for vm in vms]
@@ -372,10 +379,11 @@ class MicroArchBenchmark(vm5k_engine_para):
                 return cellId
         return -1
 
-    def setup_hosts(self):
+    def setup_hosts(self, resources=None):
         """ """
         logger.info('Initialize vm5k_deployment')
-        setup = vm5k_deployment(resources=self.resources,
+        setup = vm5k_deployment(resources=resources if resources
+                                else self.resources,
             env_name=self.options.env_name, env_file=self.options.env_file)
         setup.fact = ActionFactory(remote_tool=TAKTUK,
                                 fileput_tool=CHAINPUT,
@@ -390,6 +398,7 @@ class MicroArchBenchmark(vm5k_engine_para):
         setup.configure_libvirt()
         logger.info('Create backing file')
         setup._create_backing_file(disks=['/home/lpouilloux/synced/images/benchs_vms.qcow2'])
+        return setup.hosts
 
     def _actions_hosts(self, action):
         hosts_ok, hosts_ko = [], []
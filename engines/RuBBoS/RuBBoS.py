@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 from vm5k.engine import *
+from execo import sleep
+from vm5k import start_vms, wait_vms_have_started
 from shutil import copy2
 from os import rename, mkdir, listdir, remove, fdopen, rmdir
 from tempfile import mkstemp
@@ -366,10 +368,11 @@ class RuBBoS(vm5k_engine_para):
         n_vm = int(comb['HTTP']) + int(comb['App']) + int(comb['DB']) + 4
         return n_vm
 
-    def setup_hosts(self):
+    def setup_hosts(self, resources=None):
         """Launch the vm5k_deployment """
         logger.info('Initialize vm5k_deployment')
-        setup = vm5k_deployment(resources=self.resources,
+        setup = vm5k_deployment(resources=resources if resources
+                                else self.resources,
                     env_name=self.options.env_name,
                     env_file=self.options.env_file)
         setup.fact = ActionFactory(remote_tool=TAKTUK,
@@ -398,6 +401,7 @@ class RuBBoS(vm5k_engine_para):
             logger.info('Create backing file')
             setup._create_backing_file(disks=['/home/jorouzaudcornabas/VMs/'
                 + disk for disk in disks])
+        return setup.hosts
 
 
 def get_log_files(vms, logfile, suffix, host, comb_dir):
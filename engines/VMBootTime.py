@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 from vm5k.engine import *
+from execo import sleep
+from vm5k import start_vms, wait_vms_have_started
 #from itertools import product, repeat
 import string
 import random
@@ -50,6 +52,14 @@ class VMBootMeasurement(vm5k_engine_para):
         """
         return comb['n_vm'] * (1 + comb['n_co_vms'])
 
+    def comb_vms_key(self, comb):
+        """The parameters defining the VMs, the combinations differing only
+        by the boot policy, the load injector or the iteration keep the
+        VMs"""
+        return tuple(comb[param] for param in ['n_vm', 'n_co_vms', 'n_mem',
+                                               'n_cpu', 'cpu_sharing',
+                                               'cpu_policy', 'image_policy'])
+
     def workflow(self, comb, hosts, ip_mac):
         """Perform a boot measurements on the VM """
         host = hosts[0]
@@ -65,11 +75,7 @@ class VMBootMeasurement(vm5k_engine_para):
             logger.info(style.step(' Performing combination') + '\n' +
                         slugify(comb))
 
-            logger.info(thread_name + 'Destroying all vms on hosts')
-            destroy_vms(hosts, undefine=True)
-
-            self.umount_mount_tmp(host)
-
+            logger.info(thread_name + 'Preparing the VMs')
             vms = self.create_vms(comb, host, ip_mac)
             logger.info('VMs are ready to be started')
 
@@ -184,7 +190,10 @@ class VMBootMeasurement(vm5k_engine_para):
         return True
 
     def create_vms(self, comb, host, ip_mac):
-        """ """
+        """Return the VMs of the combination, with their disks and domains
+        ready. /tmp is remounted before the disks are created, the disks of
+        the measured VMs are always created again and the coVMs of the
+        previous combination are kept if they have not changed."""
         # set the ID of the virtual machine
         vms_ids = ['vm-' + str(i) for i in range(comb['n_vm'])] + \
             ['covm-' + str(i) for i in range(comb['n_co_vms'] * comb['n_vm'])]
@@ -221,17 +230,13 @@ class VMBootMeasurement(vm5k_engine_para):
                          backing_file=backing_file,
                          real_file=real_file)
 
-        logger.info('Creating disks')
-        create = create_disks(vms).run()
-        if not create.ok:
-            logger.error('Unable to create the VMS disks for %s ',
-                         slugify(comb))
-            exit()
-        logger.info('Installing VMS')
-        install = install_vms(vms).run()
-        if not install.ok:
-            logger.error('Unable to install the VMS for %s ',
-                         slugify(comb))
+        logger.info('Creating disks and installing VMS')
+        plan = prepare_vms(vms, [host], self.host_states,
+                           self.comb_vms_key(comb),
+                           fresh_disks=lambda vm: 'covm' not in vm['id'],
+                           clean=lambda hosts: self.umount_mount_tmp(host))
+        if plan is None:
+            logger.error('Unable to create the VMS for %s ', slugify(comb))
             exit()
 
         return vms
@@ -283,11 +288,12 @@ class VMBootMeasurement(vm5k_engine_para):
         logger.info('Startdate: %s, host: %s', format_date(startdate),
                     self.options.host)
 
-    def setup_hosts(self):
+    def setup_hosts(self, resources=None):
         """ """
         disks = ['/home/lpouilloux/synced/images/benchs_vms.qcow2']
         logger.info('Initialize vm5k_deployment')
-        setup = vm5k_deployment(resources=self.resources,
+        setup = vm5k_deployment(resources=resources if resources
+                                else self.resources,
                                 env_name=self.options.env_name,
                                 env_file=self.options.env_file)
         setup.fact = ActionFactory(remote_tool=TAKTUK,
@@ -304,6 +310,7 @@ class VMBootMeasurement(vm5k_engine_para):
         reboot_hosts(setup.hosts)
         logger.info('Create backing file')
         setup._create_backing_file(disks=disks)
+        return setup.hosts
 
 
 if __name__ == "__main__":
@@ -1,4 +1,5 @@
 from config import default_vm
+from vmtable import VMTable
 from deployment import vm5k_deployment
 from actions import define_vms, install_vms, create_disks, destroy_vms, \
     list_vm, start_vms, wait_vms_have_started, create_disks_all_hosts, \
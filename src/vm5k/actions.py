@@ -17,20 +17,63 @@
 # along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
 """A set of functions to manipulate virtual machines on Grid'5000"""
 import sys
-from os import fdopen
+from os import fdopen, path
 from pprint import pformat
-from execo import SshProcess, TaktukPut, logger, TaktukRemote, Process, \
-    SequentialActions, ChainPut, Local
+from execo import logger, SequentialActions, Local
+from execo.config import SCP
 from execo.log import style
-from execo.time_utils import sleep
 from execo_g5k import get_host_site
 import tempfile
-from math import ceil
+import tarfile
+from StringIO import StringIO
+from xml.sax.saxutils import escape
 from execo.exception import ActionsFailed
 from config import default_vm
-from utils import get_CPU_RAM_FLOPS, get_max_vms
-from itertools import cycle
-from random import randint
+from vmtable import VMTable, vms_by_host
+from readiness import vm_readiness_monitor
+from placement import placement_engine, placement_modes, log_infeasible
+from backend import get_backend
+from agent import get_agents
+from tracing import traced, tracer
+
+domains_dir = '/tmp/vm5k_domains/'
+domain_template = """<domain type="kvm">
+  <name>%(id)s</name>
+  <memory unit="MiB">%(mem)s</memory>
+  <vcpu%(cpuset)s>%(n_cpu)s</vcpu>
+  <os>
+    <type arch="x86_64">hvm</type>
+    <boot dev="hd"/>
+  </os>
+  <features>
+    <acpi/>
+    <apic/>
+  </features>
+  <clock offset="utc"/>
+  <on_poweroff>destroy</on_poweroff>
+  <on_reboot>restart</on_reboot>
+  <on_crash>restart</on_crash>
+  <devices>
+    <disk type="file" device="disk">
+      <driver name="qemu" type="qcow2" cache="none"/>
+      <source file="/tmp/%(id)s.qcow2"/>
+      <target dev="vda" bus="virtio"/>
+    </disk>
+    <interface type="network">
+      <source network="default"/>
+      <mac address="%(mac)s"/>
+      <model type="virtio"/>
+    </interface>%(tap)s
+    <serial type="pty"/>
+    <console type="pty"/>
+  </devices>
+</domain>
+"""
+domain_tap_template = """
+    <interface type="ethernet">
+      <target dev="%s"/>
+      <script path="no"/>
+    </interface>"""
 
 
 def show_vms(vms):
@@ -47,8 +90,8 @@ def show_vms(vms):
 def define_vms(vms_id, template=None, ip_mac=None, tap=None, state=None,
                host=None, n_cpu=None, cpusets=None, mem=None, hdd=None,
                backing_file=None, real_file=None):
-    """Create a list of virtual machines, where VM parameter is a dict
-    similar to
+    """Create a VMTable of virtual machines, where each VM can be used as a
+    dict similar to
     {'id': None, 'host': None, 'ip': None, 'mac': None,
     'mem': 512, 'n_cpu': 1, 'cpuset': 'auto',
     'hdd': 10, 'backing_file': '/tmp/vm-base.img',
@@ -113,70 +156,42 @@ def define_vms(vms_id, template=None, ip_mac=None, tap=None, state=None,
 
     tap = [tap] * n_vm if not isinstance(tap, list) else tap
 
-    vms = [{'id': vms_id[i], 'mem': mem[i], 'n_cpu': n_cpu[i],
-            'cpuset': cpusets[i], 'hdd': hdd[i], 'host': host[i],
-            'backing_file': backing_file[i], 'real_file': real_file[i],
-            'state': state[i], 'tap': tap[i],
-            'ip': ip_mac[i][0], 'mac': ip_mac[i][1]} for i in range(n_vm)]
+    vms = VMTable({'id': vms_id[i], 'mem': mem[i], 'n_cpu': n_cpu[i],
+                   'cpuset': cpusets[i], 'hdd': hdd[i], 'host': host[i],
+                   'backing_file': backing_file[i], 'real_file': real_file[i],
+                   'state': state[i], 'tap': tap[i],
+                   'ip': ip_mac[i][0], 'mac': ip_mac[i][1]}
+                  for i in xrange(n_vm))
 
-    logger.debug('VM parameters have been defined:\n%s',
-                 ' '.join([style.emph(param['id']) for param in vms]))
+    if logger.getEffectiveLevel() <= 10:
+        logger.debug('VM parameters have been defined:\n%s',
+                     ' '.join([style.emph(vm_id) for vm_id in vms_id]))
     return vms
 
 
+@traced()
 def distribute_vms(vms, hosts, distribution='round-robin'):
-    """Distribute the virtual machines on the hosts.
+    """Distribute the virtual machines on the hosts and return the placement
+    report, whose ``feasible`` key is False when some VMs could not be placed.
 
     :param vms: a list of VMs dicts which host key will be updated
 
     :param hosts: a list of hosts
 
     :param distribution: a string defining the distribution type:
-     'round-robin', 'concentrated', 'n_by_hosts', 'random
+     'round-robin', 'concentrated', 'n_by_hosts', 'random',
+     'first-fit-decreasing', 'best-fit' or 'balanced'
 
     """
-    logger.debug('Initial virtual machines distribution \n%s',
-                 "\n".join([vm['id'] + ": " + str(vm['host']) for vm in vms]))
-
-    if distribution in ['round-robin', 'concentrated', 'random']:
-        attr = get_CPU_RAM_FLOPS(hosts)
-        dist_hosts = hosts[:]
-        iter_hosts = cycle(dist_hosts)
-        host = iter_hosts.next()
-        for vm in vms:
-            remaining = attr[host].copy()
-            while remaining['RAM'] - vm['mem'] <= 0 \
-                    or remaining['CPU'] - vm['n_cpu'] / 3 <= 0:
-                dist_hosts.remove(host)
-                if len(dist_hosts) == 0:
-                    req_mem = sum([vm['mem'] for vm in vms])
-                    req_cpu = sum([vm['n_cpu'] for vm in vms]) / 3
-                    logger.error('Not enough ressources ! \n' + 'RAM'.rjust(20)
-                                 + 'CPU'.rjust(10) + '\n' + 'Needed'.ljust(15)
-                                 + '%s Mb'.ljust(15) + '%s \n' +
-                                 'Available'.ljust(15) + '%s Mb'.ljust(15)
-                                 + '%s \n' + 'Maximum number of VM is %s',
-                                 req_mem, req_cpu, attr['TOTAL']['RAM'],
-                                 attr['TOTAL']['CPU'],
-                                 style.emph(str(get_max_vms(hosts, vm['mem']))))
-                    exit()
-
-                iter_hosts = cycle(dist_hosts)
-                host = iter_hosts.next()
-                remaining = attr[host].copy()
-
-            vm['host'] = host
-            remaining['RAM'] -= vm['mem']
-            remaining['CPU'] -= vm['n_cpu'] / 3
-            attr[host] = remaining.copy()
-            if distribution == 'round-robin':
-                host = iter_hosts.next()
-                remaining = attr[host].copy()
-            if distribution == 'random':
-                for i in range(randint(0, len(dist_hosts))):
-                    host = iter_hosts.next()
-                    remaining = attr[host].copy()
-
+    if logger.getEffectiveLevel() <= 10:
+        logger.debug('Initial virtual machines distribution \n%s',
+                     "\n".join([vm['id'] + ": " + str(vm['host'])
+                                for vm in vms]))
+    report = None
+    if distribution in placement_modes:
+        report = placement_engine(hosts, distribution).place(vms)
+        if not report['feasible']:
+            log_infeasible(report)
     elif distribution == 'n_by_hosts':
         n_by_host = int(len(vms) / len(hosts))
         i_vm = 0
@@ -190,10 +205,14 @@ def distribute_vms(vms, hosts, distribution='round-robin'):
             vms[:] = vms[0:n_by_host * len(hosts)]
     else:
         logger.debug('No valid distribution given')
-    logger.debug('Final virtual machines distribution \n%s',
-                 "\n".join([vm['id'] + ": " + str(vm['host']) for vm in vms]))
+    if logger.getEffectiveLevel() <= 10:
+        logger.debug('Final virtual machines distribution \n%s',
+                     "\n".join([vm['id'] + ": " + str(vm['host'])
+                                for vm in vms]))
+    return report
 
 
+@traced()
 def list_vm(hosts, not_running=False):
     """ Return the list of VMs on hosts using a disk which keys are the hosts and
     value are list of VM id"""
@@ -201,7 +220,17 @@ def list_vm(hosts, not_running=False):
     if not_running:
         cmd += ' --all'
     logger.debug('Listing Virtual machines on ' + pformat(hosts))
-    list_vm = TaktukRemote(cmd, hosts).run()
+    agents = get_agents(hosts)
+    if agents:
+        hosts_vms = {host: [{'id': domain['id']} for domain in domains
+                            if domain['state'] in ('running', 'shut off')]
+                     for host, domains
+                     in agents.list_vms(hosts, not_running).iteritems()}
+        for host in hosts:
+            hosts_vms.setdefault(host, [])
+        return hosts_vms
+    list_vm = get_backend().get_remote(cmd, hosts).run()
+    tracer.record(list_vm)
     hosts_vms = {host: [] for host in hosts}
     for p in list_vm.processes:
         lines = p.stdout.split('\n')
@@ -213,24 +242,29 @@ def list_vm(hosts, not_running=False):
     return hosts_vms
 
 
+@traced()
 def destroy_vms(hosts, undefine=False):
     """Destroy all the VM on the hosts"""
-    cmds = []
-    hosts_with_vms = []
+    agents = get_agents(hosts)
+    if agents:
+        destroyed = agents.destroy_vms(hosts, undefine)
+        tracer.record_hosts(destroyed.keys(), [host for host in hosts
+                                               if host not in destroyed])
+        return
+    hosts_cmds = {}
     hosts_vms = list_vm(hosts, not_running=True)
 
     for host, vms in hosts_vms.iteritems():
         if len(vms) > 0:
             if not undefine:
-                cmds.append('; '.join('virsh destroy ' + vm['id']
-                                      for vm in vms))
+                hosts_cmds[host] = '; '.join('virsh destroy ' + vm['id']
+                                             for vm in vms)
             else:
-                cmds.append('; '.join('virsh destroy ' + vm['id'] + '; '
-                                      'virsh undefine ' + vm['id']
-                                      for vm in vms))
-            hosts_with_vms.append(host)
-    if len(cmds) > 0:
-        TaktukRemote('{{cmds}}', hosts_with_vms).run()
+                hosts_cmds[host] = '; '.join('virsh destroy ' + vm['id'] +
+                                             '; virsh undefine ' + vm['id']
+                                             for vm in vms)
+    if len(hosts_cmds) > 0:
+        tracer.record(get_backend().get_remote_cmds(hosts_cmds).run())
 
 
 def cmd_disk_real(vm):
@@ -246,25 +280,68 @@ def cmd_disk_qcow2(vm):
         vm['id'] + '.qcow2 ' + str(vm['hdd']) + 'G ; '
 
 
-def create_disks(vms):
-    """ Return an action to create the disks for the VMs on the hosts"""
-    logger.detail(', '.join([vm['id'] for vm in sorted(vms)]))
-    hosts_cmds = {}
+@traced()
+def create_disks(vms, concurrency=4, copy_mode='convert'):
+    """ Return an action to create the disks for the VMs on the hosts.
 
-    for vm in vms:
-        if vm['real_file']:
-            cmd = cmd_disk_real(vm)
-        else:
-            cmd = cmd_disk_qcow2(vm)
-        logger.detail(vm['id'] + ': ' + cmd)
-        hosts_cmds[vm['host']] = cmd if not vm['host'] in hosts_cmds \
-            else hosts_cmds[vm['host']] + cmd
+    The disks of a host are created by a pool of ``concurrency`` parallel
+    workers, and each disk creation prints a line ``id start end exit_code``
+    that can be read with ``get_disks_timing``.
+
+    :param vms: a list of VM dicts
 
-    logger.debug(pformat(hosts_cmds.values()))
+    :param concurrency: maximum number of disks created at the same time on
+     a host
 
-    return TaktukRemote('{{hosts_cmds.values()}}', list(hosts_cmds.keys()))
+    :param copy_mode: how the disks of VMs with ``real_file`` are created,
+     ``convert`` with qemu-img or ``reflink`` to use ``cp --reflink=auto``,
+     which shares the blocks of the backing file on filesystems that support
+     it and falls back to a full copy otherwise
+    """
+    logger.detail(', '.join([vm['id'] for vm in sorted(vms)]))
+    real_cmd = 'cp --reflink=auto /tmp/$1 /tmp/$0.qcow2' \
+        if copy_mode == 'reflink' \
+        else 'qemu-img convert /tmp/$1 -O qcow2 /tmp/$0.qcow2'
+    disk_cmd = 's=`date +%s.%N`; if [ "$3" = real ]; ' + \
+        'then ' + real_cmd + '; ' + \
+        'else qemu-img create -f qcow2 -o backing_file=/tmp/$1,' + \
+        'backing_fmt=qcow2 /tmp/$0.qcow2 $2G; fi >/dev/null 2>&1; ' + \
+        'r=$?; echo $0 $s `date +%s.%N` $r'
+    hosts_disks = {}
+    for vm in vms:
+        hosts_disks.setdefault(vm['host'], []).append(
+            ' '.join([vm['id'], vm['backing_file'].split('/')[-1],
+                      str(vm['hdd']),
+                      'real' if vm['real_file'] else 'qcow2']))
+    hosts_cmds = {host: "printf '%s\\n' " +
+                  ' '.join('"' + disk + '"' for disk in disks) +
+                  ' | xargs -P ' + str(concurrency) + " -L 1 sh -c '" +
+                  disk_cmd + "'"
+                  for host, disks in hosts_disks.iteritems()}
+    logger.debug(pformat(hosts_cmds))
+
+    return get_backend().get_remote_cmds(hosts_cmds)
+
+
+def get_disks_timing(action):
+    """Return a dict whose keys are the VM ids and values the duration of
+    their disk creation, and the list of VM ids whose disk creation failed,
+    from an action returned by ``create_disks``"""
+    timing, failed = {}, []
+    for p in action.processes:
+        for line in p.stdout.strip().split('\n'):
+            fields = line.split()
+            if len(fields) != 4:
+                continue
+            vm_id, start, end, code = fields
+            if code == '0':
+                timing[vm_id] = float(end) - float(start)
+            else:
+                failed.append(vm_id)
+    return timing, failed
 
 
+@traced()
 def create_disks_all_hosts(vms, hosts):
     """Create a temporary file containing the vms disks creation commands
     upload it and run it on the hosts"""
@@ -279,33 +356,103 @@ def create_disks_all_hosts(vms, hosts):
         f.write('\n' + vm_cmd)
     f.close()
 
-    return SequentialActions([ChainPut(hosts, [vms_disks]),
-                              TaktukRemote('sh ' + vms_disks.split('/')[-1], 
-                                           hosts),
+    return SequentialActions([get_backend().get_fileput(hosts, [vms_disks]),
+                              get_backend().get_remote(
+                                  'sh ' + vms_disks.split('/')[-1], hosts),
                               Local('rm ' + vms_disks)])
 
 
-def install_vms(vms):
-    """ Return an action to install the VM on the hosts"""
+def cmd_install_vm(vm):
+    """Return a virt-install command to install a VM"""
+    cmd = 'virt-install -d --import --connect qemu:///system ' + \
+        '--nographics --noautoconsole --noreboot --name=' + vm['id'] + ' '\
+        '--network network=default,mac=' + vm['mac'] + ' --ram=' + \
+        str(vm['mem']) + ' --disk path=/tmp/' + vm['id'] + \
+        '.qcow2,device=disk,bus=virtio,format=qcow2,size=' + \
+        str(vm['hdd']) + ',cache=none ' + \
+        '--vcpus=' + str(vm['n_cpu']) + ' --cpuset=' + vm['cpuset']
+    if vm['tap']:
+        cmd += '--network tap,script=no,ifname=' + vm['tap']
+    return cmd + ' ; '
+
+
+def vm_domain_xml(vm):
+    """Return the libvirt domain XML of a VM, equivalent to the domain
+    created by virt-install"""
+    quote = {'"': '&quot;'}
+    cpuset = ' cpuset="' + escape(vm['cpuset'], quote) + '"' \
+        if vm['cpuset'] and vm['cpuset'] != 'auto' else ''
+    tap = domain_tap_template % (escape(vm['tap'], quote), ) \
+        if vm['tap'] else ''
+    return domain_template % {'id': escape(vm['id'], quote),
+                              'mem': vm['mem'], 'n_cpu': vm['n_cpu'],
+                              'cpuset': cpuset,
+                              'mac': escape(vm['mac'], quote), 'tap': tap}
+
+
+@traced()
+def install_vms(vms, mode='virt-install'):
+    """ Return an action to install the VM on the hosts
+
+    :param vms: a list of VM dicts
+
+    :param mode: ``virt-install`` to run one virt-install command per VM, or
+     ``xml`` to generate the domains XML locally, send one bundle per host
+     and define all its domains with a single virsh call
+    """
     logger.detail(', '.join([vm['id'] for vm in sorted(vms)]))
+    if mode == 'xml':
+        return _install_vms_xml(vms)
     hosts_cmds = {}
     for vm in vms:
-        cmd = 'virt-install -d --import --connect qemu:///system ' + \
-            '--nographics --noautoconsole --noreboot --name=' + vm['id'] + ' '\
-            '--network network=default,mac=' + vm['mac'] + ' --ram=' + \
-            str(vm['mem']) + ' --disk path=/tmp/' + vm['id'] + \
-            '.qcow2,device=disk,bus=virtio,format=qcow2,size=' + \
-            str(vm['hdd']) + ',cache=none ' + \
-            '--vcpus=' + str(vm['n_cpu']) + ' --cpuset=' + vm['cpuset']
-        if vm['tap']:
-            cmd += '--network tap,script=no,ifname=' + vm['tap']
-        cmd += ' ; '
+        cmd = cmd_install_vm(vm)
         hosts_cmds[vm['host']] = cmd if not vm['host'] in hosts_cmds \
             else hosts_cmds[vm['host']] + cmd
 
-    return TaktukRemote('{{hosts_cmds.values()}}', list(hosts_cmds.keys()))
+    return get_backend().get_remote_cmds(hosts_cmds)
+
+
+def domains_bundle(vms):
+    """Return a gzipped tar archive containing the domain XML of the VMs and
+    a ``define.virsh`` file with the virsh commands to define them"""
+    bundle = StringIO()
+    tar = tarfile.open(fileobj=bundle, mode='w:gz')
 
+    def _add(name, content):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, StringIO(content))
 
+    for vm in vms:
+        _add(vm['id'] + '.xml', vm_domain_xml(vm))
+    _add('define.virsh', ' ; '.join('define ' + domains_dir + vm['id'] +
+                                    '.xml' for vm in vms))
+    tar.close()
+    return bundle.getvalue()
+
+
+def _install_vms_xml(vms):
+    """Return an action that sends a bundle of domain XML on each host and
+    define its domains"""
+    bundles_dir = tempfile.mkdtemp(prefix='vm5k_domains_')
+    hosts_vms = vms_by_host(vms)
+    for host, host_vms in hosts_vms.iteritems():
+        f = open(path.join(bundles_dir, host + '.tgz'), 'wb')
+        f.write(domains_bundle(host_vms))
+        f.close()
+    hosts = list(hosts_vms.keys())
+    cmd = 'rm -rf ' + domains_dir + ' ; mkdir -p ' + domains_dir + ' && ' + \
+        'tar xzf /tmp/{{{host}}}.tgz -C ' + domains_dir + ' && ' + \
+        'virsh --connect qemu:///system "$(cat ' + domains_dir + \
+        'define.virsh)" ; rm -f /tmp/{{{host}}}.tgz'
+    return SequentialActions([get_backend().get_fileput(
+                                  hosts, [bundles_dir + '/{{{host}}}.tgz'],
+                                  remote_location='/tmp/', tool=SCP),
+                              get_backend().get_remote(cmd, hosts),
+                              Local('rm -rf ' + bundles_dir)])
+
+
+@traced()
 def start_vms(vms):
     """ Return an action to start the VMs on the hosts """
     hosts_cmds = {}
@@ -315,9 +462,10 @@ def start_vms(vms):
             else hosts_cmds[vm['host']] + cmd
 
     logger.debug(pformat(hosts_cmds))
-    return TaktukRemote('{{hosts_cmds.values()}}', list(hosts_cmds.keys()))
+    return get_backend().get_remote_cmds(hosts_cmds)
 
 
+@traced()
 def activate_vms(vms, dest='lyon.grid5000.fr'):
     """Connect locally on every host and on all VMS to ping a host
     and update ARP tables"""
@@ -327,95 +475,65 @@ def activate_vms(vms, dest='lyon.grid5000.fr'):
         " ssh $VM \"ping -c 3 " + dest + " \"; " + \
         "done"
     logger.debug('Launching ping probes to update ARP tables with %s', cmd)
-    activate = TaktukRemote(cmd, list(set([vm['host'] for vm in vms])))
+    activate = get_backend().get_remote(cmd,
+                                        list(set([vm['host'] for vm in vms])))
     for p in activate.processes:
         p.ignore_exit_code = p.nolog_exit_code = True
         if logger.getEffectiveLevel() <= 10:
             p.stdout_handlers.append(sys.stdout)
     activate.run()
+    tracer.record(activate)
     return activate.ok
 
 
-def wait_vms_have_started(vms, restart=True):
-    """Scan port 22 on all vms, distributed on hosts"""
-    # Creating file with list of VMs ip
-    fd, tmpfile = tempfile.mkstemp(prefix='vmips')
-    f = fdopen(fd, 'w')
-    for vm in vms:
-        f.write(vm['ip'] + '\n')
-    f.close()
-    # getting the list of host
-    hosts = list(set([vm['host'] for vm in vms]))
-    hosts.sort()
-    # Pushing file on all hosts
-    TaktukPut(hosts, [tmpfile]).run()
-    logger.debug(pformat(hosts))
-    # Splitting nmap scan
-    n_vm_scan = ceil(len(vms) / len(hosts)) + 1
-    cmds = []
-    for i in range(len(hosts)):
-        start = str(int(i * n_vm_scan))
-        end = str(int((i + 1) * n_vm_scan))
-        cmds.append("awk 'NR>=" + start + " && NR<" + end +
-                    "' " + tmpfile.split('/')[-1] + " > nmap_file ; "
-                    + "nmap -v -oG - -i nmap_file -p 22")
-    logger.debug('%s', pformat(cmds))
-    nmap = TaktukRemote('{{cmds}}', hosts)
-    nmap_tries = 0
-    all_up = False
-    started_vms = []
-    old_started = started_vms[:]
-    while (not all_up) and nmap_tries < 10:
-        sleep(15)
-        logger.detail('nmap_tries %s', nmap_tries)
-        nmap.run()
-        for p in nmap.processes:
-            for line in p.stdout.split('\n'):
-                if 'Status' in line:
-                    split_line = line.split(' ')
-                    ip = split_line[1]
-                    state = split_line[3].strip()
-                    if state == 'Up':
-                        vm = [vm for vm in vms if vm['ip'] == ip]
-                        if len(vm) > 0:
-                            vm[0]['state'] = 'OK'
-
-        started_vms = [vm for vm in vms if vm['state'] == 'OK']
-        all_up = len(started_vms) == len(vms)
-        if started_vms != old_started:
-            old_started = started_vms
-        else:
-            if restart:
-                restart_vms([vm for vm in vms if vm['state'] == 'KO'])
-            nmap_tries += 1
-        if nmap_tries == 1:
-            activate_vms([vm for vm in vms if vm['state'] == 'KO'])
-        if not all_up:
-            logger.info(str(nmap_tries) + ': ' + str(len(started_vms)) + '/' +
-                        str(len(vms)))
-        nmap.reset()
-
-    TaktukRemote('rm ' + tmpfile.split('/')[-1], hosts).run()
-    Process('rm ' + tmpfile).run()
-    if all_up:
-        logger.info('All VM have been started')
-        return True
-    else:
-        logger.error('All VM have not been started')
-        return False
+@traced()
+def wait_vms_have_started(vms, restart=True, timeout=600, monitor=None):
+    """Wait until port 22 is open on all vms, probing each pending VM from
+    its host with an exponential backoff, and return True if all VMs
+    have started.
+
+    :param vms: a VMTable or a list of VM dicts, whose state is set to OK
+     when the VM is ready
+
+    :param restart: start again the VMs that are not running when no
+     progress is made
+
+    :param timeout: maximum duration of the wait in seconds
+
+    :param monitor: a ``vm_readiness_monitor`` created before the VMs were
+     started, that can hold push signals listeners and gives access to the
+     ready dates of the VMs
+    """
+    if monitor is None:
+        monitor = vm_readiness_monitor(vms)
+    return monitor.wait(timeout=timeout, restart=restart)
 
 
+@traced()
 def restart_vms(vms):
     """ """
-    hosts = [vm['host'] for vm in vms]
+    hosts = list(set([vm['host'] for vm in vms]))
     running_vms = list_vm(hosts)
+    agents = get_agents(hosts)
+    if agents:
+        hosts_vms = {}
+        for vm in vms:
+            if {'id': vm['id']} not in running_vms[vm['host']]:
+                logger.info('%s has not been started on %s, starting it',
+                            style.vm(vm['id']), style.host(vm['host']))
+                hosts_vms.setdefault(vm['host'], []).append(vm['id'])
+        agents.start_vms({host: [vms_ids]
+                          for host, vms_ids in hosts_vms.iteritems()})
+        return
     for vm in vms:
         if {'id': vm['id']} not in running_vms[vm['host']]:
             logger.info('%s has not been started on %s, starting it',
                         style.vm(vm['id']), style.host(vm['host']))
-            SshProcess('virsh start ' + vm['id'], vm['host']).run()
+            get_backend().get_ssh_process('virsh start ' + vm['id'],
+                                          vm['host']).run()
 
 
+@traced()
 def migrate_vm(vm, host):
     """ Migrate a VM to an host """
     if vm['host'] is None:
@@ -425,7 +543,8 @@ def migrate_vm(vm, host):
         src = vm['host']
 
     # Check that the disk is here
-    test_disk = TaktukRemote('ls /tmp/' + vm['id'] + '.qcow2', [host]).run()
+    test_disk = get_backend().get_remote('ls /tmp/' + vm['id'] + '.qcow2',
+                                         [host]).run()
     if not test_disk.ok:
         vm['host'] = host
         create_disk_on_dest = create_disks([vm]).run()
@@ -434,10 +553,12 @@ def migrate_vm(vm, host):
 
     cmd = 'virsh --connect qemu:///system migrate ' + vm['id'] + \
         ' --live --copy-storage-inc qemu+ssh://' + host + "/system' "
-    return TaktukRemote(cmd, [src])
+    return get_backend().get_remote(cmd, [src])
 
 
+@traced()
 def rm_qcow2_disks(hosts):
     """Removing qcow2 disks located in /tmp"""
     logger.debug('Removing existing disks')
-    TaktukRemote('rm -f /tmp/*.qcow2', hosts).run()
+    tracer.record(get_backend().get_remote('rm -f /tmp/*.qcow2',
+                                           hosts).run())
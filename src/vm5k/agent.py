@@ -0,0 +1,302 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Persistent agents on the hosts, that execute batches of libvirt
+operations and return structured results instead of the output of shell
+commands. The agent (:mod:`vm5k.host_agent`) is copied on the hosts and
+started once, then each host keeps a channel open on its standard input and
+output::
+
+    from vm5k.agent import host_agents, set_agents
+
+    agents = set_agents(host_agents(hosts).start())
+    print agents.list_vms(hosts)
+
+When agents are set, the functions of :mod:`vm5k.actions`, the start
+scheduler and the readiness monitor use them for the hosts they cover.
+"""
+import sys
+import json
+from os import path
+from time import time
+from threading import Condition, Lock
+from execo import logger, Host, Process
+from execo.config import SCP
+from execo.log import style
+from execo.process import ProcessOutputHandler, ProcessLifecycleHandler
+import host_agent
+from backend import get_backend
+
+agent_file = path.splitext(host_agent.__file__)[0] + '.py'
+"""The source of the agent copied on the hosts"""
+
+_agents = None
+
+
+def get_agents(hosts=None):
+    """Return the agents in use if they cover all the hosts, or None"""
+    if _agents is None or (hosts is not None and not _agents.covers(hosts)):
+        return None
+    return _agents
+
+
+def set_agents(agents):
+    """Use some agents, or stop using them with None"""
+    global _agents
+    _agents = agents
+    return agents
+
+
+class agent_channel():
+    """Send requests to an agent on the standard input of a process and read
+    its responses on the standard output"""
+
+    def __init__(self, process):
+        """:param process: an execo process running the agent, not started"""
+        self.process = process
+        self.responses = {}
+        self.closed = False
+        self._n = 0
+        self._cond = Condition()
+        self._write_lock = Lock()
+        process.stdout_handlers.append(_response_handler(self))
+        process.lifecycle_handlers.append(_close_handler(self))
+        process.ignore_exit_code = process.nolog_exit_code = True
+
+    def start(self):
+        """Start the process of the agent"""
+        self.process.start()
+        return self
+
+    def send(self, op, **args):
+        """Send a request and return its id"""
+        with self._cond:
+            self._n += 1
+            request_id = self._n
+            if self.closed:
+                self.responses[request_id] = {'id': request_id, 'ok': False,
+                                              'error': 'agent closed'}
+                return request_id
+        with self._write_lock:
+            self.process.write(json.dumps({'id': request_id, 'op': op,
+                                           'args': args}) + '\n')
+        return request_id
+
+    def get(self, request_id, timeout=None):
+        """Wait for the response of a request, None if it did not come
+        before timeout"""
+        end = time() + timeout if timeout is not None else None
+        with self._cond:
+            while request_id not in self.responses and not self.closed:
+                if end is not None and time() >= end:
+                    return None
+                self._cond.wait(end - time() if end is not None else None)
+            return self.responses.pop(request_id, None) or \
+                {'id': request_id, 'ok': False, 'error': 'agent closed'}
+
+    def close(self):
+        """Stop the agent"""
+        if not self.closed and self.process.started:
+            self.process.kill()
+
+    def _receive(self, response):
+        with self._cond:
+            self.responses[response.get('id')] = response
+            self._cond.notify_all()
+
+    def _closed(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class _response_handler(ProcessOutputHandler):
+    """Give the JSON lines written by an agent to its channel"""
+
+    def __init__(self, channel):
+        super(_response_handler, self).__init__()
+        self.channel = channel
+
+    def read_line(self, process, stream, line, eof, error):
+        if not line.strip():
+            return
+        try:
+            self.channel._receive(json.loads(line))
+        except ValueError:
+            logger.debug('Unexpected output of the agent: %r', line)
+
+
+class _close_handler(ProcessLifecycleHandler):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def end(self, process):
+        self.channel._closed()
+
+
+def local_agent():
+    """Return a channel to an agent running on the frontend, a stand-in of
+    the agents of the hosts for tests"""
+    return agent_channel(Process([sys.executable, agent_file])).start()
+
+
+class host_agents():
+    """The agents of a set of hosts. Every call sends one request to each
+    agent and waits for all the responses, so that an operation on many VMs
+    costs one round trip per host instead of one remote command."""
+
+    def __init__(self, hosts=None, remote_dir='/tmp', timeout=600):
+        """:param hosts: the hosts whose agent is started by :meth:`start`
+
+        :param remote_dir: where the agent is copied on the hosts
+
+        :param timeout: the maximum duration of a call
+        """
+        self.hosts = [host.address if isinstance(host, Host) else host
+                      for host in hosts] if hosts else []
+        self.remote_dir = remote_dir
+        self.timeout = timeout
+        self.channels = {}
+        """A dict whose keys are the hosts and values their agent_channel"""
+        self.failed = set()
+        """The hosts on which the agent could not be started"""
+        self._lock = Lock()
+
+    def start(self, hosts=None):
+        """Copy the agent on some hosts, default to all, start it and check
+        that it answers. Return the agents."""
+        hosts = [host.address if isinstance(host, Host) else host
+                 for host in (hosts if hosts is not None else self.hosts)]
+        hosts = [host for host in hosts if host not in self.channels]
+        if not hosts:
+            return self
+        logger.detail('Starting the agent on %s hosts', len(hosts))
+        put = get_backend().get_fileput(hosts, [agent_file],
+                                        remote_location=self.remote_dir,
+                                        tool=SCP)
+        for p in put.processes:
+            p.nolog_exit_code = True
+        put.run()
+        copied = set(p.host.address for p in put.processes if p.ok)
+        cmd = 'python -u ' + path.join(self.remote_dir,
+                                       path.basename(agent_file))
+        channels = {}
+        for host in hosts:
+            if host in copied:
+                channels[host] = agent_channel(
+                    get_backend().get_agent_process(cmd, host)).start()
+        with self._lock:
+            self.hosts += [host for host in hosts if host not in self.hosts]
+            self.channels.update(channels)
+        answers = self.call('ping', {host: {} for host in channels},
+                            timeout=60)
+        failed = set(hosts) - set(answers)
+        if failed:
+            logger.warning('No agent on %s',
+                           ', '.join(style.host(host) for host in failed))
+            with self._lock:
+                for host in failed:
+                    self.channels.pop(host, None)
+                self.failed |= failed
+        return self
+
+    def stop(self):
+        """Stop the agents"""
+        with self._lock:
+            channels, self.channels = self.channels, {}
+        for channel in channels.itervalues():
+            channel.close()
+
+    def covers(self, hosts):
+        """Return True if all the hosts have an agent"""
+        return all((host.address if isinstance(host, Host) else host)
+                   in self.channels for host in hosts)
+
+    def call(self, op, hosts_args, timeout=None):
+        """Send an operation to the agents of some hosts and return a dict
+        whose keys are the hosts and values the results. The hosts whose
+        agent failed or did not answer are missing from the dict.
+
+        :param op: the name of the operation
+        :param hosts_args: a dict whose keys are the hosts and values a dict
+         of the arguments of the operation
+        """
+        timeout = self.timeout if timeout is None else timeout
+        end = time() + timeout
+        requests = {}
+        for host, args in hosts_args.iteritems():
+            channel = self.channels.get(host)
+            if channel:
+                requests[host] = (channel, channel.send(op, **args))
+        results = {}
+        for host, (channel, request_id) in requests.iteritems():
+            response = channel.get(request_id, max(0, end - time()))
+            if response is None:
+                logger.warning('The agent of %s did not answer to %s',
+                               style.host(host), op)
+            elif not response['ok']:
+                logger.warning('%s failed on %s: %s', op, style.host(host),
+                               response.get('error'))
+            else:
+                results[host] = response['result']
+        return results
+
+    def list_vms(self, hosts, not_running=False):
+        """Return a dict whose keys are the hosts and values the list of
+        their domains as dicts with ``id`` and ``state``"""
+        return self.call('list', {host: {'all': not_running}
+                                  for host in hosts})
+
+    def define_vms(self, hosts_domains):
+        """Define domains from a dict whose keys are the hosts and values a
+        dict whose keys are the VM ids and values their XML. Return the list
+        of VMs that could not be defined."""
+        codes = self.call('define', {host: {'domains': domains}
+                                     for host, domains
+                                     in hosts_domains.iteritems()})
+        return [vm_id for host, domains in hosts_domains.iteritems()
+                for vm_id in domains
+                if codes.get(host, {}).get(vm_id) != 0]
+
+    def start_vms(self, hosts_batches, concurrency=None):
+        """Start the batches of VMs of each host, from a dict whose keys are
+        the hosts and values the list of batches of VM ids, at most
+        ``concurrency`` VMs of a batch at a time. Return a dict whose keys
+        are the hosts and values a list of (id, start, end, exit_code)."""
+        return self.call('start', {host: {'batches': batches,
+                                          'concurrency': concurrency}
+                                   for host, batches
+                                   in hosts_batches.iteritems()})
+
+    def destroy_vms(self, hosts, undefine=False):
+        """Destroy all the domains of the hosts and return a dict whose keys
+        are the hosts and values a dict whose keys are the VM ids and values
+        the exit code"""
+        return self.call('destroy', {host: {'undefine': undefine}
+                                     for host in hosts})
+
+    def probe(self, hosts_ips, port=22, timeout=2):
+        """Probe a TCP port of some ip from their host, given as a dict whose
+        keys are the hosts and values the list of ip. Return the set of ip
+        whose port is open."""
+        results = self.call('probe', {host: {'ips': ips, 'port': port,
+                                             'timeout': timeout}
+                                      for host, ips in hosts_ips.iteritems()})
+        return set(ip for ips in results.itervalues()
+                   for ip, up in ips.iteritems() if up)
+
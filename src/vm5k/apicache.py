@@ -0,0 +1,146 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""A process-wide cache of the Grid'5000 API attributes of the clusters,
+with an optional on-disk store"""
+import json
+from os import path, makedirs, rename
+from time import time
+from threading import RLock
+from execo import logger, Host
+from execo_g5k.api_utils import get_host_cluster, get_host_attributes
+
+
+def api_cluster_attributes(cluster, host=None):
+    """Retrieve from the API the attributes used by vm5k for a cluster, from
+    the description of one of its hosts, its first node if not given"""
+    attr = get_host_attributes(host if host else cluster + '-1')
+    return {'CPU': attr['architecture']['nb_cores'],
+            'RAM': int(attr['main_memory']['ram_size'] / 10 ** 6),
+            'flops': attr['performance']['node_flops'],
+            'virtual': attr['supported_job_types']['virtual']}
+
+
+class api_attributes_cache():
+    """Memoize the attributes of the clusters, so that a deployment makes at
+    most one API lookup per cluster. Entries older than ``ttl`` seconds are
+    retrieved again.
+
+    The attributes can be served by an offline stand-in, given as
+    ``source``: a dict whose keys are the clusters and values their
+    attributes, or a function taking a cluster name and one of its hosts,
+    which may be None.
+
+    The attributes are returned as copies, that the caller can modify.
+    """
+
+    def __init__(self, ttl=86400, store=None, source=None):
+        """:param ttl: the validity of an entry in seconds
+
+        :param store: a JSON file where the entries are kept between runs
+
+        :param source: a dict or a function providing the attributes of a
+         cluster, default to the Grid'5000 API
+        """
+        self._lock = RLock()
+        self._clusters = {}
+        self._hosts_cluster = {}
+        self.ttl = ttl
+        self.store = None
+        self.source = api_cluster_attributes
+        self.configure(store=store, source=source)
+
+    def configure(self, ttl=None, store=None, source=None):
+        """Change the ttl, the on-disk store or the source of the cache"""
+        with self._lock:
+            if ttl is not None:
+                self.ttl = ttl
+            if store is not None:
+                self.store = store
+                self._load()
+            if source is not None:
+                self.source = source
+                self._clusters = {}
+
+    def host_cluster(self, host):
+        """Return the cluster of a host"""
+        if isinstance(host, Host):
+            host = host.address
+        cluster = self._hosts_cluster.get(host)
+        if cluster is None:
+            cluster = get_host_cluster(host)
+            self._hosts_cluster[host] = cluster
+        return cluster
+
+    def cluster(self, cluster, host=None):
+        """Return the attributes of a cluster, retrieved if needed from the
+        description of host"""
+        with self._lock:
+            entry = self._clusters.get(cluster)
+            if entry is None or time() - entry['date'] > self.ttl:
+                if isinstance(self.source, dict):
+                    attr = self.source[cluster]
+                else:
+                    logger.debug('Retrieving the attributes of %s', cluster)
+                    attr = self.source(cluster, host)
+                entry = {'date': time(), 'attr': attr}
+                self._clusters[cluster] = entry
+                self._save()
+            return dict(entry['attr'])
+
+    def host(self, host):
+        """Return the attributes of the cluster of a host"""
+        if isinstance(host, Host):
+            host = host.address
+        return self.cluster(self.host_cluster(host), host)
+
+    def clear(self):
+        """Forget all the entries"""
+        with self._lock:
+            self._clusters = {}
+            self._hosts_cluster = {}
+
+    def _load(self):
+        if not path.exists(self.store):
+            return
+        try:
+            with open(self.store) as f:
+                clusters = json.load(f)
+        except (IOError, ValueError):
+            logger.warning('Unable to read the API cache %s', self.store)
+            return
+        now = time()
+        for cluster, entry in clusters.iteritems():
+            if now - entry['date'] <= self.ttl:
+                self._clusters.setdefault(cluster, entry)
+
+    def _save(self):
+        if not self.store:
+            return
+        if path.dirname(self.store) and \
+                not path.exists(path.dirname(self.store)):
+            makedirs(path.dirname(self.store))
+        try:
+            with open(self.store + '.tmp', 'w') as f:
+                json.dump(self._clusters, f)
+            rename(self.store + '.tmp', self.store)
+        except (IOError, OSError):
+            logger.warning('Unable to write the API cache %s', self.store)
+
+
+attributes_cache = api_attributes_cache()
+"""The cache shared by the vm5k functions"""
@@ -0,0 +1,854 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Execution backends of the remote actions. The default backend runs them
+on the Grid'5000 hosts with execo, the simulated backend runs them in a local
+model of the hosts, their libvirt domains and their disks, so that a whole
+deployment can be played without Grid'5000::
+
+    from vm5k.backend import set_backend, simulated_backend, \\
+        simulated_cluster
+
+    cluster = simulated_cluster(hosts, ip_mac, time_scale=0.01, seed=1)
+    set_backend(simulated_backend(cluster))
+"""
+import re
+import json
+import tarfile
+from os import path
+from fnmatch import fnmatch
+from heapq import heappush, heappop
+from random import Random
+from time import time, sleep
+from threading import Thread, Condition, Event, RLock
+from execo import logger, Host, Process, SshProcess, TaktukRemote
+from execo.action import Action, ActionFactory
+from execo.config import TAKTUK, CHAINPUT, default_connection_params
+from execo.process import ProcessOutputHandler, ProcessLifecycleHandler, \
+    STDOUT
+from execo.report import Report
+from execo_g5k import deploy
+from vm5k.apicache import attributes_cache
+
+default_latencies = {'command': (0.05, 0.01),
+                     'apt': (60, 15),
+                     'apt_cached': (10, 3),
+                     'deploy': (300, 60),
+                     'copy': (10, 2),
+                     'disk': (2, 0.5),
+                     'install': (1, 0.2),
+                     'define': (0.05, 0.01),
+                     'start': (2, 0.5),
+                     'boot': (30, 8)}
+"""The default (mean, standard deviation) in seconds of the simulated
+operations, ``copy`` being given per GiB and ``apt_cached`` being an
+installation whose packages are in the APT cache"""
+
+_backend = None
+
+
+def get_backend():
+    """Return the backend used to create the remote actions, by default an
+    execo_backend"""
+    global _backend
+    if _backend is None:
+        _backend = execo_backend()
+    return _backend
+
+
+def set_backend(backend):
+    """Change the backend used to create the remote actions"""
+    global _backend
+    _backend = backend
+    return backend
+
+
+class execo_backend():
+    """Create execo actions running on the real hosts, with taktuk for the
+    remote commands and chainput for the files"""
+
+    def __init__(self):
+        self.fact = ActionFactory(remote_tool=TAKTUK,
+                                  fileput_tool=CHAINPUT,
+                                  fileget_tool=TAKTUK)
+        self.remote_tool = self.fact.remote_tool
+
+    def get_remote(self, cmd, hosts, connection_params=None):
+        """Return an action running the same command on the hosts"""
+        return self.fact.get_remote(cmd, hosts,
+                                    connection_params=connection_params)
+
+    def get_remote_cmds(self, hosts_cmds):
+        """Return an action running on each host its own command, from a dict
+        whose keys are the hosts and values the commands"""
+        hosts = list(hosts_cmds.keys())
+        cmds = [hosts_cmds[host] for host in hosts]
+        return TaktukRemote('{{cmds}}', hosts)
+
+    def get_fileput(self, hosts, local_files, remote_location='.',
+                    connection_params=None, tool=None):
+        """Return an action copying files on the hosts, with chainput or
+        with the given execo fileput tool"""
+        fact = self.fact if tool is None else ActionFactory(fileput_tool=tool)
+        return fact.get_fileput(hosts, local_files,
+                                remote_location=remote_location,
+                                connection_params=connection_params)
+
+    def get_ssh_process(self, cmd, host):
+        """Return a process running a command on a host"""
+        return SshProcess(cmd, host)
+
+    def get_process(self, cmd, shell=False):
+        """Return a process running a command on the frontend"""
+        return Process(cmd, shell=shell)
+
+    def get_agent_process(self, cmd, host):
+        """Return a process running a vm5k agent on a host, whose standard
+        input is kept open to send it requests. It has no tty, so that the
+        requests are neither echoed nor limited in length."""
+        params = dict(default_connection_params)
+        params['ssh_options'] = tuple(option for option
+                                      in params['ssh_options']
+                                      if option != '-tt')
+        return SshProcess(cmd, host, connection_params=params)
+
+    def deploy(self, deployment, **kwargs):
+        """Deploy the hosts with kadeploy and return a tuple
+        (deployed_hosts, undeployed_hosts)"""
+        return deploy(deployment, **kwargs)
+
+
+class simulated_backend():
+    """Create actions that are played in a simulated_cluster. Commands and
+    file transfers last the time given by the cluster model, scaled by its
+    ``time_scale``."""
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.remote_tool = TAKTUK
+        attributes_cache.configure(source=cluster.attributes)
+
+    def get_remote(self, cmd, hosts, connection_params=None):
+        return simulated_action(self.cluster, [(host, cmd) for host in hosts],
+                                self.cluster.execute)
+
+    def get_remote_cmds(self, hosts_cmds):
+        return simulated_action(self.cluster, hosts_cmds.items(),
+                                self.cluster.execute)
+
+    def get_fileput(self, hosts, local_files, remote_location='.',
+                    connection_params=None, tool=None):
+        return simulated_action(self.cluster,
+                                [(host, (local_files, remote_location))
+                                 for host in hosts],
+                                self.cluster.put)
+
+    def get_ssh_process(self, cmd, host):
+        return simulated_process(self.cluster, host, cmd,
+                                 self.cluster.execute)
+
+    def get_process(self, cmd, shell=False):
+        if self.cluster.local_command(cmd) is None:
+            return Process(cmd, shell=shell)
+        return simulated_process(self.cluster, None, cmd,
+                                 lambda host, cmd:
+                                 self.cluster.local_command(cmd))
+
+    def get_agent_process(self, cmd, host):
+        return simulated_agent_process(self.cluster, host)
+
+    def deploy(self, deployment, **kwargs):
+        hosts = [host.address if isinstance(host, Host) else host
+                 for host in deployment.hosts]
+        return self.cluster.deploy(hosts)
+
+
+class simulated_action(Action):
+    """An execo Action whose processes are played in a simulated_cluster"""
+
+    def __init__(self, cluster, jobs, func, **kwargs):
+        """:param cluster: the simulated_cluster
+
+        :param jobs: a list of (host, command)
+
+        :param func: the function of the cluster playing a command on a
+         host
+        """
+        super(simulated_action, self).__init__(**kwargs)
+        self.cluster = cluster
+        self.jobs = list(jobs)
+        self.func = func
+        self._lock = RLock()
+        self._init_processes()
+
+    def _init_processes(self):
+        self.processes = [simulated_process(self.cluster, host, cmd,
+                                            self.func)
+                          for host, cmd in self.jobs]
+        for p in self.processes:
+            p.lifecycle_handlers.append(self._process_end)
+        self._n_ended = 0
+
+    def _process_end(self, process):
+        with self._lock:
+            self._n_ended += 1
+            if self._n_ended < len(self.processes):
+                return
+        self._notify_terminated()
+
+    def start(self):
+        super(simulated_action, self).start()
+        if not self.processes:
+            self._notify_terminated()
+        for p in self.processes:
+            p.start()
+        return self
+
+    def kill(self):
+        super(simulated_action, self).kill()
+        for p in self.processes:
+            p.kill()
+        return self
+
+
+class simulated_process():
+    """A process played in a simulated_cluster, with the attributes of an
+    execo process read by vm5k"""
+
+    def __init__(self, cluster, host, cmd, func):
+        self.cluster = cluster
+        self.host = Host(host) if host and not isinstance(host, Host) \
+            else host
+        self.cmd = cmd
+        self.func = func
+        self.stdout = ''
+        self.stderr = ''
+        self.exit_code = None
+        self.started = self.ended = self.killed = False
+        self.start_date = self.end_date = None
+        self.ignore_exit_code = self.nolog_exit_code = False
+        self.stdout_handlers = []
+        self.stderr_handlers = []
+        self.lifecycle_handlers = []
+        self._end_event = Event()
+
+    @property
+    def ok(self):
+        return not self.killed and \
+            (not self.ended or self.ignore_exit_code or self.exit_code == 0)
+
+    @property
+    def finished_ok(self):
+        return self.ended and self.ok
+
+    def start(self):
+        self.started = True
+        self.start_date = time()
+        duration, stdout, exit_code = self.func(
+            self.host.address if self.host else None, self.cmd)
+        if duration is not None:
+            self.cluster.clock.call_later(duration * self.cluster.time_scale,
+                                          self._end, stdout, exit_code)
+        return self
+
+    def wait(self, timeout=None):
+        self._end_event.wait(timeout)
+        return self
+
+    def run(self, timeout=None):
+        return self.start().wait(timeout)
+
+    def kill(self):
+        if not self.ended:
+            self.killed = True
+            self._end('', -9)
+        return self
+
+    def stats(self):
+        stats = Report.empty_stats()
+        stats.update({'start_date': self.start_date,
+                      'end_date': self.end_date,
+                      'num_processes': 1,
+                      'num_started': int(self.started),
+                      'num_ended': int(self.ended),
+                      'num_forced_kills': int(self.killed),
+                      'num_non_zero_exit_codes': int(self.exit_code not in
+                                                     (0, None)),
+                      'num_ok': int(self.ok),
+                      'num_finished_ok': int(self.finished_ok)})
+        return stats
+
+    def _end(self, stdout, exit_code):
+        if self.ended:
+            return
+        self.stdout, self.exit_code = stdout, exit_code
+        self.end_date = time()
+        self.ended = True
+        for line in stdout.splitlines(True):
+            for handler in self.stdout_handlers:
+                if isinstance(handler, ProcessOutputHandler):
+                    handler.read_line(self, STDOUT, line, False, False)
+                else:
+                    handler.write(line)
+        if not self.ok and not self.nolog_exit_code:
+            logger.warning('%s failed on %s with exit code %s', self.cmd,
+                           self.host.address if self.host else 'frontend',
+                           exit_code)
+        for handler in self.lifecycle_handlers:
+            handler(self)
+        self._end_event.set()
+
+
+class simulated_agent_process():
+    """A process running a vm5k agent on a host of a simulated_cluster. The
+    requests written on its standard input are answered by the cluster, one
+    after the other, after their simulated duration."""
+
+    def __init__(self, cluster, host):
+        self.cluster = cluster
+        self.host = Host(host) if not isinstance(host, Host) else host
+        self.started = self.ended = self.killed = False
+        self.ignore_exit_code = self.nolog_exit_code = False
+        self.stdout_handlers = []
+        self.lifecycle_handlers = []
+        self._buffer = ''
+        self._busy_until = 0
+        self._lock = RLock()
+
+    def start(self):
+        self.started = True
+        if self.host.address in self.cluster.failed_hosts or \
+                self.host.address not in self.cluster.hosts:
+            self.cluster.clock.call_later(
+                self.cluster.sample('command') * self.cluster.time_scale,
+                self.kill)
+        return self
+
+    def write(self, s):
+        with self._lock:
+            self._buffer += s
+            lines = self._buffer.split('\n')
+            self._buffer = lines.pop()
+            for line in lines:
+                if not line.strip() or self.ended:
+                    continue
+                request = json.loads(line)
+                duration, response = self.cluster.agent_request(
+                    self.host.address, request['op'],
+                    request.get('args', {}))
+                response['id'] = request['id']
+                self._busy_until = max(time(), self._busy_until) + \
+                    duration * self.cluster.time_scale
+                self.cluster.clock.call_later(self._busy_until - time(),
+                                              self._answer, response)
+
+    def kill(self):
+        with self._lock:
+            if self.ended:
+                return self
+            self.ended = self.killed = True
+        for handler in self.lifecycle_handlers:
+            if isinstance(handler, ProcessLifecycleHandler):
+                handler.end(self)
+            else:
+                handler(self)
+        return self
+
+    def _answer(self, response):
+        if self.ended:
+            return
+        for handler in self.stdout_handlers:
+            handler.read_line(self, STDOUT, json.dumps(response) + '\n',
+                              False, False)
+
+
+class simulated_clock():
+    """Call functions after a delay from a single thread"""
+
+    def __init__(self):
+        self._events = []
+        self._cond = Condition()
+        self._thread = None
+        self._n = 0
+
+    def call_later(self, delay, func, *args):
+        if delay <= 0:
+            func(*args)
+            return
+        with self._cond:
+            self._n += 1
+            heappush(self._events, (time() + delay, self._n, func, args))
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._events or self._events[0][0] > time():
+                    self._cond.wait(self._events[0][0] - time()
+                                    if self._events else None)
+                _, _, func, args = heappop(self._events)
+            func(*args)
+
+
+class simulated_cluster():
+    """A model of hosts running libvirt. Each host has a set of files and of
+    libvirt domains, whose state follows the commands sent by vm5k. The
+    duration of every operation is drawn from ``latencies``, multiplied by
+    the speed factor of the host.
+
+    Simulated commands return immediately with their output and exit code,
+    their end is then notified after their duration multiplied by
+    ``time_scale``. Dates printed by the commands are real dates, so they can
+    be mixed with the dates taken by vm5k. Only the files of ``/tmp`` are
+    followed, and commands that are not part of the model succeed after a
+    ``command`` latency.
+    """
+
+    def __init__(self, hosts=None, ip_mac=None, latencies=None, time_scale=0.0,
+                 seed=None, failure_rate=0.0, attributes=None):
+        """:param hosts: the hosts of the cluster
+
+        :param ip_mac: the list of (ip, mac) given by the DHCP of the
+         network, or a dict whose values are such lists
+
+        :param latencies: a dict whose keys are the operations and values a
+         tuple (mean, standard deviation) or a function taking a
+         random.Random and returning a duration, overriding
+         ``default_latencies``
+
+        :param time_scale: the ratio between the real and the simulated
+         durations, 0 to end every command immediately
+
+        :param seed: the seed of the random durations and failures
+
+        :param failure_rate: the probability that the deployment of a host
+         fails
+
+        :param attributes: the Grid'5000 API attributes of the hosts
+        """
+        self.latencies = dict(default_latencies)
+        self.latencies.update(latencies if latencies else {})
+        self.time_scale = time_scale
+        self.failure_rate = failure_rate
+        self.random = Random(seed)
+        self.clock = simulated_clock()
+        self.hosts = {}
+        """A dict whose keys are the hosts and values a dict with their
+        ``domains``, ``files``, ``speed`` and ``ip``"""
+        self.failed_hosts = set()
+        self.counters = {}
+        """The number of operations of each kind played by the cluster"""
+        self._attributes = {'CPU': 16, 'RAM': 65536, 'flops': 10 ** 11,
+                            'virtual': 'ivt'}
+        self._attributes.update(attributes if attributes else {})
+        self._ips = {}
+        self._macs = {}
+        self._domains = {}
+        self._lock = RLock()
+        self._simple_commands = [
+            (r'^virsh(?: --connect \S+)? list( --all)?', self._virsh_list),
+            (r'^virsh(?: --connect \S+)? destroy (\S+)', self._virsh_destroy),
+            (r'^virsh(?: --connect \S+)? undefine (\S+)',
+             self._virsh_undefine),
+            (r'^virsh(?: --connect \S+)? start (\S+)', self._virsh_start),
+            (r'^virt-install .*--name=(\S+) .*mac=([0-9a-fA-F:]+)',
+             self._virt_install),
+            (r'^apt-get .*(?:install|upgrade)', self._apt),
+            (r'^cp (?:--reflink=auto )?(\S+) (\S+)$', self._cp),
+            (r'^mv (\S+) (\S+)$', self._mv),
+            (r'^rm (?:-\w+ )?(.+)$', self._rm),
+            (r'^python \S+ manifest', self._manifest),
+            (r'^brctl show', self._brctl),
+            (r'^tail .*-F', self._follow)]
+        self._batch_commands = [
+            (r'^nmap -n -Pn -oG - -p (\d+) (.+)$', self._nmap),
+            (r'xargs -P \d+ -I\{\} sh -c \'.*virsh .*start', self._start_vms),
+            (r'virsh --connect \S+ start (\S+) >/dev/null 2>&1; r=\$\?; echo',
+             self._start_vm),
+            (r'^printf \'%s\\n\' (.*) \| xargs -P (\d+)', self._create_disks),
+            (r'tar xzf (\S+) -C (\S+).*define\.virsh', self._define_xml)]
+        self._simple_commands = [(re.compile(pattern), func)
+                                 for pattern, func in self._simple_commands]
+        self._batch_commands = [(re.compile(pattern), func)
+                                for pattern, func in self._batch_commands]
+        self.add_hosts(hosts if hosts else [])
+        self.add_ip_mac(ip_mac if ip_mac else [])
+
+    def add_hosts(self, hosts, speed=1.0):
+        """Add some hosts, whose operations last ``speed`` times the
+        latencies"""
+        with self._lock:
+            for host in hosts:
+                if isinstance(host, Host):
+                    host = host.address
+                n = len(self.hosts) + 1
+                self.hosts[host] = {'domains': {}, 'files': {},
+                                    'speed': speed,
+                                    'ip': '10.%s.%s.%s' % (n // 65536 % 256,
+                                                           n // 256 % 256,
+                                                           n % 256)}
+
+    def add_ip_mac(self, ip_mac):
+        """Add some (ip, mac) to the DHCP of the network"""
+        if isinstance(ip_mac, dict):
+            for site_ip_mac in ip_mac.itervalues():
+                self.add_ip_mac(site_ip_mac)
+            return
+        with self._lock:
+            for ip, mac in ip_mac:
+                self._ips[ip] = mac
+
+    def fail_host(self, host):
+        """Make a host unreachable"""
+        with self._lock:
+            self.failed_hosts.add(host)
+
+    def attributes(self, cluster, host=None):
+        """Return the API attributes of the hosts of a cluster"""
+        return dict(self._attributes)
+
+    def sample(self, kind, host=None):
+        """Return a random duration for an operation on a host"""
+        with self._lock:
+            self.counters[kind] = self.counters.get(kind, 0) + 1
+            latency = self.latencies[kind]
+            if callable(latency):
+                duration = latency(self.random)
+            else:
+                duration = max(0, self.random.gauss(*latency))
+        if host in self.hosts:
+            duration *= self.hosts[host]['speed']
+        return duration
+
+    def deploy(self, hosts):
+        """Deploy the hosts, each one failing with ``failure_rate``, and
+        return a tuple (deployed_hosts, undeployed_hosts)"""
+        self.add_hosts([host for host in hosts if host not in self.hosts])
+        deployed, undeployed = set(), set()
+        duration = 0
+        for host in hosts:
+            duration = max(duration, self.sample('deploy', host))
+            with self._lock:
+                self.hosts[host]['domains'] = {}
+                self.hosts[host]['files'] = {}
+                if host in self.failed_hosts or \
+                        self.random.random() < self.failure_rate:
+                    self.failed_hosts.add(host)
+                    undeployed.add(host)
+                else:
+                    deployed.add(host)
+        sleep(duration * self.time_scale)
+        return deployed, undeployed
+
+    def execute(self, host, cmd):
+        """Play a command on a host and return a tuple (duration, stdout,
+        exit_code), the duration being None for a command that never
+        ends"""
+        if host not in self.hosts or host in self.failed_hosts:
+            return self.sample('command'), '', 255
+        cmd = cmd.replace('{{{host}}}', host)
+        with self._lock:
+            for pattern, func in self._batch_commands:
+                match = pattern.search(cmd)
+                if match:
+                    return func(host, match)
+            duration, stdout, exit_code = 0, '', 0
+            for simple_cmd in re.split(r';|&&', cmd):
+                simple_cmd = simple_cmd.strip()
+                if not simple_cmd:
+                    continue
+                for pattern, func in self._simple_commands:
+                    match = pattern.search(simple_cmd)
+                    if match:
+                        d, out, exit_code = func(host, match)
+                        break
+                else:
+                    d, out, exit_code = self.sample('command', host), '', 0
+                if d is None:
+                    return None, '', 0
+                duration += d
+                stdout += out
+            return duration, stdout, exit_code
+
+    def put(self, host, files_location):
+        """Copy some local files on a host and return a tuple (duration,
+        stdout, exit_code)"""
+        local_files, remote_location = files_location
+        if host not in self.hosts or host in self.failed_hosts:
+            return self.sample('command'), '', 255
+        duration = self.sample('command', host)
+        with self._lock:
+            for local_file in local_files:
+                local_file = local_file.replace('{{{host}}}', host)
+                if path.exists(local_file):
+                    duration += self.sample('copy', host) * \
+                        path.getsize(local_file) / 2 ** 30
+                remote = path.join(remote_location.replace('{{{host}}}',
+                                                           host),
+                                   path.basename(local_file))
+                self.hosts[host]['files'][path.normpath(remote)] = local_file
+        return duration, '', 0
+
+    def local_command(self, cmd):
+        """Play a command of the frontend that concerns the hosts, return
+        None if it does not concern them"""
+        match = re.match(r'^host (\S+)', cmd)
+        if match:
+            ip = self.hosts.get(match.group(1), {}).get('ip', '127.0.0.1')
+            return self.sample('command'), ip if 'cut' in cmd else \
+                match.group(1) + ' has address ' + ip, 0
+        match = re.match(r'^nmap (\S+) -p 53', cmd)
+        if match:
+            return self.sample('command'), '53/tcp open  domain\n', 0
+        match = re.match(r'^nmap (.+) -p 22$', cmd)
+        if match:
+            n = len(match.group(1).split())
+            return self.sample('command'), 'Nmap done: %s IP addresses ' \
+                '(%s hosts up) scanned\n' % (n, n), 0
+        return None
+
+    def agent_request(self, host, op, args):
+        """Play a request of the vm5k agent of a host and return a tuple
+        (duration, response)"""
+        if host not in self.hosts or host in self.failed_hosts:
+            return self.sample('command'), {'ok': False,
+                                            'error': 'host unreachable'}
+        with self._lock:
+            domains = self.hosts[host]['domains']
+            duration = self.sample('command', host)
+            if op == 'ping':
+                result = {'version': 1, 'pid': 0}
+            elif op == 'run':
+                d, stdout, exit_code = self.execute(host, args['cmd'])
+                duration = d if d is not None else duration
+                result = {'exit_code': exit_code, 'stdout': stdout}
+            elif op == 'list':
+                result = [{'id': vm_id, 'state': domain['state']}
+                          for vm_id, domain in sorted(domains.iteritems())
+                          if args.get('all') or domain['state'] == 'running']
+            elif op == 'define':
+                result = {}
+                for vm_id, xml in args['domains'].iteritems():
+                    mac = re.search(r'<mac address="([^"]+)"', xml)
+                    result[vm_id] = 0 if mac else 1
+                    if mac:
+                        self._define(host, vm_id, mac.group(1))
+                    duration += self.sample('define', host)
+            elif op == 'start':
+                result = []
+                offset = duration
+                for batch in args['batches']:
+                    workers = [offset] * min(len(batch),
+                                             args.get('concurrency') or
+                                             len(batch))
+                    for vm_id in batch:
+                        start = heappop(workers)
+                        d, _, code = self._virsh_start(
+                            host, re.match(r'(\S+)', vm_id), start)
+                        result.append([vm_id, time() + start *
+                                       self.time_scale, time() +
+                                       (start + d) * self.time_scale, code])
+                        heappush(workers, start + d)
+                    offset = max(workers) if workers else offset
+                duration = offset
+            elif op == 'destroy':
+                result = {}
+                for vm_id in args.get('vms') or list(domains):
+                    match = re.match(r'(\S+)', vm_id)
+                    result[vm_id] = self._virsh_destroy(host, match)[2]
+                    if args.get('undefine'):
+                        result[vm_id] = self._virsh_undefine(host, match)[2]
+                    duration += self.sample('command', host)
+            elif op == 'probe':
+                now = time()
+                result = {}
+                for ip in args['ips']:
+                    vm_id = self._macs.get(self._ips.get(ip, '').lower())
+                    domain = self.hosts[self._domains[vm_id]]['domains'].get(
+                        vm_id) if vm_id in self._domains else None
+                    result[ip] = bool(domain and
+                                      domain['state'] == 'running' and
+                                      domain['boot_date'] <= now)
+            else:
+                return duration, {'ok': False,
+                                  'error': 'KeyError: %r' % (op, )}
+        return duration, {'ok': True, 'result': result}
+
+    def _date(self, offset):
+        return '%.6f' % (time() + offset * self.time_scale, )
+
+    def _virsh_list(self, host, match):
+        lines = [' Id    Name                           State',
+                 '----------------------------------------------------']
+        for vm_id, domain in sorted(self.hosts[host]['domains'].iteritems()):
+            if domain['state'] == 'running':
+                lines.append(' 1     %-30s running' % (vm_id, ))
+            elif match.group(1):
+                lines.append(' -     %-30s shut off' % (vm_id, ))
+        return self.sample('command', host), '\n'.join(lines) + '\n', 0
+
+    def _virsh_destroy(self, host, match):
+        domain = self.hosts[host]['domains'].get(match.group(1))
+        if not domain or domain['state'] != 'running':
+            return self.sample('command', host), '', 1
+        domain['state'] = 'shut off'
+        return self.sample('command', host), '', 0
+
+    def _virsh_undefine(self, host, match):
+        if match.group(1) not in self.hosts[host]['domains']:
+            return self.sample('command', host), '', 1
+        del self.hosts[host]['domains'][match.group(1)]
+        self._domains.pop(match.group(1), None)
+        return self.sample('command', host), '', 0
+
+    def _virsh_start(self, host, match, offset=0):
+        duration = self.sample('start', host)
+        domain = self.hosts[host]['domains'].get(match.group(1))
+        if not domain or domain['state'] == 'running' or \
+                '/tmp/' + match.group(1) + '.qcow2' \
+                not in self.hosts[host]['files']:
+            return duration, '', 1
+        domain['state'] = 'running'
+        domain['boot_date'] = time() + (offset + duration +
+                                        self.sample('boot', host)) * \
+            self.time_scale
+        self._domains[match.group(1)] = host
+        return duration, '', 0
+
+    def _virt_install(self, host, match):
+        self._define(host, match.group(1), match.group(2))
+        return self.sample('install', host), '', 0
+
+    def _define(self, host, vm_id, mac):
+        if vm_id in self._domains and self._domains[vm_id] != host:
+            self.hosts[self._domains[vm_id]]['domains'].pop(vm_id, None)
+        self.hosts[host]['domains'].setdefault(vm_id, {'state': 'shut off'})
+        self._domains[vm_id] = host
+        self._macs[mac.lower()] = vm_id
+
+    def _apt(self, host, match):
+        if any(f.startswith('/var/cache/apt/archives/')
+               for f in self.hosts[host]['files']):
+            return self.sample('apt_cached', host), '', 0
+        return self.sample('apt', host), '', 0
+
+    def _cp(self, host, match):
+        files = self.hosts[host]['files']
+        if not match.group(1).startswith('/tmp/'):
+            return self.sample('command', host), '', 0
+        if match.group(1) not in files:
+            return self.sample('command', host), '', 1
+        files[match.group(2)] = files[match.group(1)]
+        return self.sample('disk', host), '', 0
+
+    def _mv(self, host, match):
+        files = self.hosts[host]['files']
+        if not match.group(1).startswith('/tmp/'):
+            return self.sample('command', host), '', 0
+        if match.group(1) not in files:
+            return self.sample('command', host), '', 1
+        files[match.group(2)] = files.pop(match.group(1))
+        return self.sample('command', host), '', 0
+
+    def _rm(self, host, match):
+        files = self.hosts[host]['files']
+        for pattern in match.group(1).split():
+            for remote in [f for f in files if fnmatch(f, pattern)]:
+                del files[remote]
+        return self.sample('command', host), '', 0
+
+    def _manifest(self, host, match):
+        return self.sample('command', host), 'null\n', 0
+
+    def _brctl(self, host, match):
+        return self.sample('command', host), 'br0\n', 0
+
+    def _follow(self, host, match):
+        return None, '', 0
+
+    def _nmap(self, host, match):
+        now = time()
+        lines = []
+        for ip in match.group(2).split():
+            vm_id = self._macs.get(self._ips.get(ip, '').lower())
+            domain = self.hosts[self._domains[vm_id]]['domains'].get(vm_id) \
+                if vm_id in self._domains else None
+            up = domain and domain['state'] == 'running' and \
+                domain['boot_date'] <= now
+            lines.append('Host: %s ()\tPorts: %s/%s/tcp//ssh///' %
+                         (ip, match.group(1), 'open' if up else 'closed'))
+        return self.sample('command', host), '\n'.join(lines) + '\n', 0
+
+    def _start_vms(self, host, match):
+        lines = []
+        offset = 0
+        for batch, n_workers in re.findall(
+                r"echo '([^']*)' \| tr ' ' '\\n' \| xargs -P (\d+)",
+                match.string):
+            workers = [offset] * int(n_workers)
+            for vm_id in batch.split():
+                start = heappop(workers)
+                duration, _, code = self._virsh_start(
+                    host, re.match(r'(\S+)', vm_id), start)
+                lines.append(' '.join([vm_id, self._date(start),
+                                       self._date(start + duration),
+                                       str(code)]))
+                heappush(workers, start + duration)
+            offset = max(workers)
+        return offset, '\n'.join(lines) + '\n', 0
+
+    def _start_vm(self, host, match):
+        duration, _, code = self._virsh_start(host, match)
+        return duration, ' '.join([match.group(1), self._date(0),
+                                   self._date(duration), str(code)]) + '\n', 0
+
+    def _create_disks(self, host, match):
+        files = self.hosts[host]['files']
+        workers = [0] * int(match.group(2))
+        lines = []
+        for disk in re.findall(r'"([^"]+)"', match.group(1)):
+            vm_id, backing_file, _, mode = disk.split()
+            start = heappop(workers)
+            duration = self.sample('disk', host) * (5 if mode == 'real'
+                                                    else 1)
+            code = 0 if '/tmp/' + backing_file in files else 1
+            if code == 0:
+                files['/tmp/' + vm_id + '.qcow2'] = '/tmp/' + backing_file
+            lines.append(' '.join([vm_id, self._date(start),
+                                   self._date(start + duration), str(code)]))
+            heappush(workers, start + duration)
+        return max(workers), '\n'.join(lines) + '\n', 0
+
+    def _define_xml(self, host, match):
+        bundle = self.hosts[host]['files'].pop(path.normpath(match.group(1)),
+                                               None)
+        if not bundle or not path.exists(bundle):
+            return self.sample('command', host), '', 1
+        tar = tarfile.open(bundle)
+        duration = self.sample('command', host)
+        define = tar.extractfile('define.virsh').read()
+        for vm_id in re.findall(r'define \S*/([^/\s]+)\.xml', define):
+            mac = re.search(r'<mac address="([^"]+)"',
+                            tar.extractfile(vm_id + '.xml').read())
+            self._define(host, vm_id, mac.group(1))
+            duration += self.sample('define', host)
+        tar.close()
+        return duration, '', 0
@@ -0,0 +1,391 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Execution of the combinations of an engine campaign on a pool of hosts.
+A :class:`combination_scheduler` runs a bounded number of workers, each
+taking idle hosts from a :class:`host_pool` and the most costly remaining
+combination of the sweeper, so that a host is given a new combination as
+soon as it is released::
+
+    pool = host_pool(hosts)
+    combination_scheduler(sweeper, pool, workflow, n_nodes=1,
+                          cost=lambda comb: comb['n_vm']).run()
+"""
+import sys
+from collections import deque, OrderedDict
+from threading import Thread, Condition, Lock
+from time import time
+from execo import logger
+from execo.log import style
+from execo_g5k import get_oar_job_info
+from execo_engine import slugify
+
+
+class host_pool():
+    """The hosts of a campaign, with a queue of the idle ones. A worker
+    waits on the queue until enough hosts are idle, instead of polling
+    them. The hosts are in groups, e.g. one by OAR job, and the hosts
+    given to a worker are of the same group. The time spent idle and busy
+    by the hosts is measured."""
+
+    def __init__(self, hosts=None, group=None):
+        """:param hosts: the hosts of the pool, all idle
+
+        :param group: the group of the hosts
+        """
+        self.hosts = []
+        """The hosts of the pool, busy or idle"""
+        self.groups = {}
+        """A dict whose keys are the hosts and values their group"""
+        self.idle_time = 0
+        """The total time spent idle by the hosts, while the pool was
+        open"""
+        self.busy_time = 0
+        """The total time spent busy by the hosts"""
+        self._idle = OrderedDict()
+        self._idle_since = {}
+        self._busy_since = {}
+        self._closed = False
+        self._cond = Condition()
+        self.add(hosts if hosts else [], group)
+
+    def add(self, hosts, group=None):
+        """Add some hosts to the pool, idle"""
+        with self._cond:
+            for host in hosts:
+                if host not in self.hosts:
+                    self.hosts.append(host)
+                    self.groups[host] = group
+                    self._idle.setdefault(group, deque())
+                    self._set_idle(host)
+            self._cond.notify_all()
+
+    def remove(self, hosts):
+        """Remove some hosts from the pool. A busy host leaves the pool when
+        it is released."""
+        with self._cond:
+            for host in hosts:
+                if host in self.hosts:
+                    self.hosts.remove(host)
+                if host in self._idle_since:
+                    self._idle[self.groups[host]].remove(host)
+                    self._set_busy(host)
+                    self._busy_since.pop(host)
+            self._cond.notify_all()
+
+    def group_of(self, host):
+        """Return the group of a host"""
+        return self.groups.get(host)
+
+    def busy(self, hosts=None):
+        """Return the hosts that are acquired, among some hosts or all"""
+        with self._cond:
+            if hosts is None:
+                return list(self._busy_since)
+            return [host for host in hosts if host in self._busy_since]
+
+    def acquire(self, n, prefer=None, timeout=None):
+        """Wait until n hosts of a group are idle and return them, the hosts
+        of ``prefer`` and their group first. Return None if the pool is
+        closed, if no group has n hosts or after timeout."""
+        end = time() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                groups = self._idle_groups(n, prefer)
+                if groups:
+                    group = groups[0]
+                    break
+                sizes = {}
+                for host in self.hosts:
+                    sizes[self.groups[host]] = \
+                        sizes.get(self.groups[host], 0) + 1
+                if not sizes or max(sizes.itervalues()) < n:
+                    return None
+                if end is not None and time() >= end:
+                    return None
+                self._cond.wait(end - time() if end is not None else None)
+            idle = self._idle[group]
+            hosts = [host for host in prefer if host in self._idle_since and
+                     self.groups[host] == group][:n] if prefer else []
+            for host in hosts:
+                idle.remove(host)
+            while len(hosts) < n:
+                hosts.append(idle.popleft())
+            for host in hosts:
+                self._set_busy(host)
+            return hosts
+
+    def release(self, hosts):
+        """Give back some hosts to the pool"""
+        with self._cond:
+            for host in hosts:
+                since = self._busy_since.pop(host, None)
+                if since is not None:
+                    self.busy_time += time() - since
+                if host in self.hosts and host not in self._idle_since:
+                    self._set_idle(host)
+            self._cond.notify_all()
+
+    def idle(self):
+        """Return the list of the idle hosts"""
+        with self._cond:
+            return [host for idle in self._idle.itervalues()
+                    for host in idle]
+
+    def close(self):
+        """Wake up the workers waiting for hosts, no more hosts are given"""
+        with self._cond:
+            for host in list(self._idle_since):
+                self._set_busy(host)
+                self._busy_since.pop(host)
+            self._closed = True
+            self._cond.notify_all()
+
+    def _idle_groups(self, n, prefer):
+        """Return the groups with n idle hosts, the group of the preferred
+        hosts first"""
+        groups = [group for group, idle in self._idle.iteritems()
+                  if len(idle) >= n]
+        if prefer and self.groups.get(prefer[0]) in groups[1:]:
+            groups.remove(self.groups[prefer[0]])
+            groups.insert(0, self.groups[prefer[0]])
+        return groups
+
+    def _set_idle(self, host):
+        self._idle[self.groups[host]].append(host)
+        self._idle_since[host] = time()
+
+    def _set_busy(self, host):
+        since = self._idle_since.pop(host, None)
+        if since is not None and not self._closed:
+            self.idle_time += time() - since
+        self._busy_since[host] = time()
+
+
+class oar_job_state():
+    """The state of an OAR job, asked to OAR at most once every
+    ``min_interval`` seconds whatever the number of threads checking it"""
+
+    def __init__(self, oar_job_id, frontend=None, min_interval=60):
+        self.oar_job_id = oar_job_id
+        self.frontend = frontend
+        self.min_interval = min_interval
+        self._state = None
+        self._date = None
+        self._lock = Lock()
+
+    def get(self):
+        """Return the state of the job, possibly cached"""
+        with self._lock:
+            if self._date is None or \
+                    time() - self._date >= self.min_interval:
+                try:
+                    self._state = get_oar_job_info(self.oar_job_id,
+                                                   self.frontend)['state']
+                except Exception, e:
+                    logger.warning('Unable to get the state of job %s: %s',
+                                   self.oar_job_id, e)
+                self._date = time()
+            return self._state
+
+    def alive(self):
+        """Return False if the job is in Error or Terminated"""
+        return self.get() not in ('Error', 'Terminated')
+
+
+class combination_scheduler():
+    """Run the combinations of a sweeper on the hosts of a pool. Each of the
+    workers acquires ``n_nodes`` hosts, takes the most costly remaining
+    combination, runs the workflow and gives back the hosts, until no
+    combination remains. The workflow is responsible for marking the
+    combination done or canceling it, and a combination canceled
+    ``max_tries`` times is skipped."""
+
+    def __init__(self, sweeper, hosts, workflow, n_nodes=1, cost=None,
+                 n_workers=None, ip_mac=None, comb_nvm=None, alive=None,
+                 max_tries=3, affinity=None, prefer_ip_mac=None):
+        """:param sweeper: an execo_engine ParamSweeper
+
+        :param hosts: a host_pool
+
+        :param workflow: the function called with the combination, the
+         list of hosts and the list of (ip, mac)
+
+        :param n_nodes: the number of hosts of a combination
+
+        :param cost: a function returning the cost of a combination, the
+         most costly ones are run first
+
+        :param n_workers: the maximum number of combinations run at the same
+         time, default to the number of hosts divided by n_nodes
+
+        :param ip_mac: an ip_mac_pool from which the addresses of the VMs
+         of the combinations are allocated, or a dict whose keys are the
+         groups of the host pool and values their ip_mac_pool
+
+        :param comb_nvm: a function returning the number of VMs of a
+         combination
+
+        :param alive: a function returning False when no more combination
+         should be started, e.g. because the job is dead
+
+        :param max_tries: the number of times a combination is tried
+
+        :param affinity: a function returning the affinity of a combination
+         with the hosts given to a worker, e.g. because the VMs left by the
+         previous combination can be kept. The combinations with the
+         highest affinity are run first, then the most costly ones.
+
+        :param prefer_ip_mac: a function returning the list of (ip, mac)
+         that are allocated first for the VMs of some hosts
+        """
+        self.sweeper = sweeper
+        self.hosts = hosts
+        self.workflow = workflow
+        self.n_nodes = n_nodes
+        self.n_workers = n_workers
+        self.ip_mac = ip_mac
+        self.comb_nvm = comb_nvm
+        self.alive = alive
+        self.max_tries = max_tries
+        self.affinity = affinity
+        self.prefer_ip_mac = prefer_ip_mac
+        self.n_done = 0
+        self.tries = {}
+        self._cost = cost
+        self._costs = {}
+        self._workers = []
+        self._lock = Lock()
+        self._stopped = False
+
+    def cost(self, comb):
+        """Return the cost of a combination, computed once"""
+        if comb not in self._costs:
+            self._costs[comb] = self._cost(comb) if self._cost else 0
+        return self._costs[comb]
+
+    def next_combination(self, hosts=None):
+        """Take the remaining combination with the highest affinity with the
+        hosts and the most costly from the sweeper"""
+        def key(comb):
+            if self.affinity and hosts:
+                return self.affinity(comb, hosts), self.cost(comb)
+            return 0, self.cost(comb)
+        return self.sweeper.get_next(
+            lambda remaining: [max(remaining, key=key)]
+            if remaining else [])
+
+    def ip_mac_pool(self, hosts):
+        """Return the ip_mac_pool of the VMs of some hosts"""
+        if isinstance(self.ip_mac, dict):
+            return self.ip_mac.get(self.hosts.group_of(hosts[0]))
+        return self.ip_mac
+
+    def grow(self):
+        """Start workers up to the number of hosts of the pool divided by
+        n_nodes, or to n_workers"""
+        with self._lock:
+            n = len(self.hosts.hosts) // self.n_nodes
+            if self.n_workers:
+                n = min(n, self.n_workers)
+            self._workers = [t for t in self._workers if t.is_alive()]
+            while len(self._workers) < n and not self._stopped:
+                t = Thread(target=self._worker,
+                           name='worker-%s' % (len(self._workers) + 1, ))
+                t.daemon = True
+                t.start()
+                self._workers.append(t)
+
+    def run(self):
+        """Run the combinations and return when no worker is left"""
+        start = time()
+        self.grow()
+        logger.info('Running the combinations with %s workers',
+                    style.emph(len(self._workers)))
+        while True:
+            with self._lock:
+                workers = [t for t in self._workers if t.is_alive()]
+            if not workers:
+                break
+            for t in workers:
+                while t.is_alive():
+                    t.join(1)
+        duration = time() - start
+        logger.info('%s combinations done in %.1f s, hosts idle %.1f%% of '
+                    'the time', self.n_done, duration,
+                    100. * self.hosts.idle_time /
+                    max(self.hosts.idle_time + self.hosts.busy_time, 1e-6))
+        return self
+
+    def stop(self):
+        """Let the running combinations end and start no other one"""
+        self._stopped = True
+
+    def _worker(self):
+        hosts = None
+        while not self._stopped:
+            hosts = self.hosts.acquire(self.n_nodes, prefer=hosts)
+            if hosts is None:
+                break
+            if self.alive and not self.alive():
+                logger.warning('Stopping the combinations')
+                self._stopped = True
+                self.hosts.release(hosts)
+                break
+            comb = self.next_combination(hosts)
+            if comb is None:
+                self.hosts.release(hosts)
+                break
+            pool = self.ip_mac_pool(hosts)
+            prefer = self.prefer_ip_mac(hosts) if self.prefer_ip_mac \
+                else None
+            ip_mac = pool.allocate(self.comb_nvm(comb), prefer) \
+                if pool and self.comb_nvm else []
+            try:
+                self.workflow(comb, hosts, ip_mac)
+            except BaseException:
+                logger.error('%s failed on %s', slugify(comb),
+                             ', '.join(hosts), exc_info=sys.exc_info())
+            finally:
+                if pool:
+                    pool.release(ip_mac)
+                self.hosts.release(hosts)
+            self._check_tries(comb)
+
+    def _check_tries(self, comb):
+        """Count the tries of a combination that is not done, try it again
+        or skip it after max_tries"""
+        if comb in self.sweeper.get_done():
+            with self._lock:
+                self.n_done += 1
+            return
+        if comb in self.sweeper.get_skipped():
+            return
+        with self._lock:
+            self.tries[comb] = self.tries.get(comb, 0) + 1
+            tries = self.tries[comb]
+        if tries < self.max_tries:
+            if comb in self.sweeper.get_inprogress():
+                self.sweeper.cancel(comb)
+            return
+        logger.warning('Skipping %s after %s tries', slugify(comb), tries)
+        if comb not in self.sweeper.get_inprogress():
+            self.sweeper.get_next(lambda remaining:
+                                  [comb] if comb in remaining else [])
+        self.sweeper.skip(comb)
@@ -0,0 +1,176 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Per-chunk hash manifests of disk images and chunk-level patches.
+
+This module has no dependency outside the standard library, as it is also
+copied on the hosts and run as a script::
+
+    python chunks.py manifest <image> [<manifest>]
+    python chunks.py adopt <image> <manifest> <reference_manifest>
+    python chunks.py apply <image> <manifest> <patch> <reference_manifest>
+"""
+import sys
+import json
+from os import stat, path
+from hashlib import sha1
+
+chunk_size = 4 * 1024 * 1024
+
+
+def default_manifest_path(image):
+    """Return the path of the manifest stored alongside an image"""
+    return image + '.manifest'
+
+
+def compute_manifest(image, size=chunk_size):
+    """Read an image and return its manifest, a dict containing its size,
+    mtime, the chunk size, the sha1 of every chunk and a digest of the
+    whole image"""
+    chunks = []
+    f = open(image, 'rb')
+    while True:
+        data = f.read(size)
+        if not data:
+            break
+        chunks.append(sha1(data).hexdigest())
+    f.close()
+    return _manifest(image, size, chunks)
+
+
+def load_manifest(image, manifest_path=None, size=chunk_size):
+    """Return the cached manifest of an image if it is still valid, i.e. the
+    image has the same size and mtime, or None"""
+    manifest_path = manifest_path or default_manifest_path(image)
+    if not path.exists(image) or not path.exists(manifest_path):
+        return None
+    try:
+        f = open(manifest_path)
+        manifest = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+        return None
+    st = stat(image)
+    if manifest.get('size') != st.st_size or \
+            manifest.get('mtime') != st.st_mtime or \
+            manifest.get('chunk_size') != size:
+        return None
+    return manifest
+
+
+def save_manifest(manifest, manifest_path):
+    """Write a manifest, silently ignoring read-only locations"""
+    try:
+        f = open(manifest_path, 'w')
+        json.dump(manifest, f)
+        f.close()
+        return True
+    except IOError:
+        return False
+
+
+def get_manifest(image, manifest_path=None, size=chunk_size):
+    """Return the manifest of an image, from the cache if valid, otherwise
+    computed and cached. Return None if the image does not exist"""
+    if not path.exists(image):
+        return None
+    manifest_path = manifest_path or default_manifest_path(image)
+    manifest = load_manifest(image, manifest_path, size)
+    if manifest is None:
+        manifest = compute_manifest(image, size)
+        save_manifest(manifest, manifest_path)
+    return manifest
+
+
+def missing_chunks(reference, manifest):
+    """Return the indexes of the chunks of the reference manifest that differ
+    in the other manifest, which can be None"""
+    if manifest is None or manifest['chunk_size'] != reference['chunk_size']:
+        return range(len(reference['chunks']))
+    chunks = manifest['chunks']
+    return [i for i, chunk in enumerate(reference['chunks'])
+            if i >= len(chunks) or chunks[i] != chunk]
+
+
+def write_patch(image, reference, indexes, patch):
+    """Write a patch file containing the given chunks of an image, preceded
+    by a JSON header line"""
+    size = reference['chunk_size']
+    src = open(image, 'rb')
+    dst = open(patch, 'wb')
+    dst.write(json.dumps({'size': reference['size'], 'chunk_size': size,
+                          'chunks': indexes}) + '\n')
+    for i in indexes:
+        src.seek(i * size)
+        dst.write(src.read(size))
+    src.close()
+    dst.close()
+
+
+def apply_patch(image, patch):
+    """Write the chunks of a patch in an image and truncate it to its final
+    size"""
+    src = open(patch, 'rb')
+    header = json.loads(src.readline())
+    size = header['chunk_size']
+    mode = 'r+b' if path.exists(image) else 'w+b'
+    dst = open(image, mode)
+    for i in header['chunks']:
+        dst.seek(i * size)
+        dst.write(src.read(size))
+    dst.truncate(header['size'])
+    dst.close()
+    src.close()
+
+
+def adopt_manifest(image, reference, manifest_path=None):
+    """Store the reference manifest as the manifest of an image that has
+    been copied or patched, with the local size and mtime of the image"""
+    manifest = _manifest(image, reference['chunk_size'],
+                         reference['chunks'])
+    save_manifest(manifest, manifest_path or default_manifest_path(image))
+    return manifest
+
+
+def _manifest(image, size, chunks):
+    st = stat(image)
+    return {'size': st.st_size, 'mtime': st.st_mtime, 'chunk_size': size,
+            'chunks': chunks, 'digest': sha1(''.join(chunks)).hexdigest()}
+
+
+def _load_json(json_path):
+    f = open(json_path)
+    data = json.load(f)
+    f.close()
+    return data
+
+
+def main(args):
+    if args[0] == 'manifest':
+        manifest = get_manifest(args[1], args[2] if len(args) > 2 else None)
+        print json.dumps(manifest)
+    elif args[0] == 'adopt':
+        adopt_manifest(args[1], _load_json(args[3]), args[2])
+    elif args[0] == 'apply':
+        apply_patch(args[1], args[3])
+        adopt_manifest(args[1], _load_json(args[4]), args[2])
+    else:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
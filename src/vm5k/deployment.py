@@ -16,26 +16,42 @@
 # You should have received a copy of the GNU General Public License
 # along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
 import sys
-from os import fdopen
+import json
+from os import fdopen, path
+from threading import RLock
 from xml.etree.ElementTree import Element, SubElement, parse
 from time import localtime, strftime
-from tempfile import mkstemp
-from execo import logger, Process, SshProcess, SequentialActions, Host, \
-    Local, sleep, TaktukPut, Timer
-from execo.action import ActionFactory, ParallelActions, Remote
+from shutil import rmtree
+from tempfile import mkstemp, mkdtemp
+from execo import logger, SequentialActions, Host, Local, sleep, Timer
+from execo.action import ParallelActions
 from execo.log import style
-from execo.config import TAKTUK, CHAINPUT, default_connection_params
-from execo_g5k import deploy, Deployment
-from execo_g5k.api_utils import get_host_cluster, \
-    get_cluster_site, get_host_site, canonical_host_name, get_g5k_hosts
+from execo.config import TAKTUK, default_connection_params
+from execo_g5k import Deployment
+from execo_g5k.api_utils import get_host_cluster, get_host_site, \
+    canonical_host_name
 from execo_g5k.utils import get_kavlan_host_name, hosts_list
 from vm5k.config import default_vm
-from vm5k.actions import create_disks, install_vms, start_vms, \
+from vm5k.vmtable import VMTable, vms_by
+from vm5k.state import deployment_state
+from vm5k.actions import create_disks, install_vms, get_disks_timing, \
     wait_vms_have_started, destroy_vms, create_disks_all_hosts, distribute_vms,\
-    activate_vms
+    activate_vms, vm_domain_xml
+from vm5k.readiness import vm_readiness_monitor
+from vm5k.imagestore import image_copy, script_file, local_manifest
+from vm5k.scheduler import vm_start_scheduler
+from vm5k.pipeline import host_pipeline, pipeline_stage
+from vm5k.backend import get_backend
+from vm5k.placement import placement_engine, log_infeasible
+from vm5k.packages import package_plan, base_packages, libvirt_packages, \
+    libvirt_release, apt_archives, deb_files
+from vm5k.agent import host_agents, get_agents, set_agents
+from vm5k.journal import deployment_journal
+from vm5k.tracing import tracer, traced
 from vm5k.utils import prettify, print_step, get_fastest_host, \
     get_CPU_RAM_FLOPS
-from vm5k.services import dnsmasq_server, setup_aptcacher_server, configure_apt_proxy
+from vm5k.services import dnsmasq_server, dns_tier, setup_aptcacher_server, \
+    configure_apt_proxy
 
 default_connection_params['user'] = 'root'
 
@@ -52,7 +68,7 @@ class vm5k_deployment():
     def __init__(self, infile=None, resources=None, hosts=None,
                  ip_mac=None, vlan=None,
                  env_name=None, env_file=None, vms=None,
-                 distribution=None, outdir=None):
+                 distribution=None, outdir=None, resume=False):
         """:param infile: an XML file that describe the topology of the
         deployment
 
@@ -64,17 +80,19 @@ class vm5k_deployment():
 
         :param env_file: path to the Kadeploy environment file
 
-        :params vms: dict defining the virtual machines
+        :params vms: a VMTable or a list of dicts defining the virtual
+        machines
 
         :params distribution: how to distribute the vms on the hosts
         (``round-robin`` , ``concentrated``, ``random``)
 
         :params outdir: directory to store the deployment files
+
+        :params resume: if True, the stages recorded in the journal of outdir
+        by a previous deployment are not done again
         """
-        # set a factory for the deployment that use taktuk and chainput
-        self.fact = ActionFactory(remote_tool=TAKTUK,
-                                  fileput_tool=CHAINPUT,
-                                  fileget_tool=TAKTUK)
+        # the backend creating the actions, taktuk and chainput by default
+        self.fact = get_backend()
         self.kavlan = None if not vlan else vlan
         self.kavlan_site = None
         if env_name is not None:
@@ -99,10 +117,39 @@ class vm5k_deployment():
             self.outdir = 'vm5k_' + strftime("%Y%m%d_%H%M%S_%z")
 
         self.copy_actions = None
-
-        self.state = Element('vm5k')
+        self._copy_dir = None
+        self._copy_lock = RLock()
+        self._hosts_copied = set()
+        self._disks_created = set()
+        self._placement = None
+        self._ip_next = None
+        self._state_lock = RLock()
+        self.pipeline_report = None
+        self.service_node = None
+        self.service_nodes = []
+        self.n_service_nodes = 1
+        """The number of hosts serving the DNS/DHCP of the VMs"""
+        self.shard_by = 'mac'
+        """How the VMs are sharded among the service nodes, ``mac`` or
+        ``site``"""
+        self.dns_tier = None
+        self.use_agents = False
+        """If True, a vm5k agent is started on the hosts once libvirt is
+        configured and executes the operations on the VMs"""
+        self.agents = None
+        self.deb_bundle = None
+        """A directory of .deb files put in the APT cache of the hosts before
+        installing the packages"""
+        self.vms_boot_time = {}
+        self.disks_timing = {}
+
+        self.state = deployment_state()
+        self.journal = deployment_journal(path.join(self.outdir,
+                                                    'journal.jsonl'), resume)
+        """The journal of the stages completed by the hosts and the VMs"""
         self._define_elements(infile, resources, hosts, vms, ip_mac,
                               distribution)
+        self.journal.record_vms('placed', self.vms)
 
         logger.info('%s %s %s %s %s %s %s %s',
                     len(self.sites), style.emph('sites'),
@@ -111,11 +158,26 @@ class vm5k_deployment():
                     len(self.vms), style.vm('vms'))
 
     # PUBLIC METHODS
-    def run(self):
+    def run(self, pipeline=False, pipeline_workers=None, **vms_options):
         """Launch the deployment and configuration of hosts and virtual
         machines: hosts_deployment, packages_mamangement, configure_service_node
-        configure_libvirt, deploy_vms"""
+        configure_libvirt, deploy_vms. With ``pipeline``, the hosts are
+        configured with a host_pipeline instead of step by step, and the
+        disks of the VMs are created on each host as soon as it is ready,
+        with at most ``pipeline_workers`` stages running at the same time.
+        ``vms_options`` are given to deploy_vms, except ``disk_location``
+        which the pipeline does not support. The timings of the steps are
+        written in trace.json and trace.folded in the outdir. The spans of
+        a previous deployment are forgotten, unless run() is called inside
+        another span."""
+        if tracer.current() is None:
+            tracer.reset()
+        span = tracer.open('deployment', hosts=self.hosts)
         try:
+            if pipeline:
+                self._run_pipeline(max_workers=pipeline_workers,
+                                   **vms_options)
+                return
             print_step('HOSTS DEPLOYMENT')
             self.hosts_deployment()
 
@@ -127,12 +189,18 @@ class vm5k_deployment():
 
             print_step('CONFIGURING LIBVIRT')
             self.configure_libvirt()
+            self.start_agents()
 
             print_step('VIRTUAL MACHINES')
-            self.deploy_vms()
+            self.deploy_vms(**vms_options)
         finally:
+            self.stop_agents()
+            tracer.close(span)
             self.get_state()
+            if path.isdir(self.outdir):
+                tracer.write(self.outdir)
 
+    @traced()
     def hosts_deployment(self, max_tries=1, check_deploy=True,
                          conf_ssh=True):
         """Deploy the hosts using kadeploy, configure ssh for taktuk execution
@@ -142,79 +210,135 @@ class vm5k_deployment():
         if conf_ssh:
             self._configure_ssh()
 
+    @traced()
     def packages_management(self, upgrade=True, other_packages=None,
                             launch_disk_copy=True, apt_cacher=False):
-        """Configure APT to use testing repository,
-        perform upgrade and install required packages. Finally start
-        kvm module"""
-        self._configure_apt()
-        if upgrade:
-            self._upgrade_hosts()
+        """Configure APT to use testing repository, then upgrade and install
+        the base packages, and the libvirt and other packages while the
+        backing files are copied. Finally start kvm module"""
+        hosts = self.journal.hosts_todo('packages', self.hosts)
+        if len(hosts) < len(self.hosts):
+            logger.info('Packages already installed on %s hosts',
+                        len(self.hosts) - len(hosts))
+        if hosts:
+            self._configure_apt(hosts)
         self._install_packages(other_packages=other_packages,
-                               launch_disk_copy=launch_disk_copy)
+                               launch_disk_copy=launch_disk_copy,
+                               hosts=hosts, upgrade=upgrade)
         if apt_cacher:
             setup_aptcacher_server(self.hosts)
         # Post configuration to load KVM
-        self.fact.get_remote(
-            'modprobe kvm; modprobe kvm-intel; modprobe kvm-amd ; ' + \
-            'chown root:kvm /dev/kvm ;', self.hosts).run()
-
-    def configure_service_node(self):
+        if hosts:
+            self._load_kvm(hosts)
+        self.journal.record_hosts('packages', [host for host in hosts
+                                               if host in self.hosts])
+
+    @traced()
+    def configure_service_node(self, incremental=False, n_service_nodes=None,
+                               shard_by=None):
         """Setup automatically a DNS server to access virtual machines by id
-        and also install a DHCP server if kavlan is used"""
+        and also install a DHCP server if kavlan is used. With
+        ``incremental``, a running server only gets the changes of the
+        VMs. With several service nodes, the VMs are sharded among them by
+        ``mac`` or by ``site``."""
         if self.kavlan:
             service = 'DNS/DHCP'
             dhcp = True
         else:
             service = 'DNS'
             dhcp = False
-
-        service_node = get_fastest_host(self.hosts)
+        n_service_nodes = n_service_nodes if n_service_nodes \
+            else self.n_service_nodes
+        shard_by = shard_by if shard_by else self.shard_by
+        if n_service_nodes > 1 or shard_by == 'site':
+            self.service_nodes = self._get_service_nodes(n_service_nodes,
+                                                         shard_by)
+            self.service_node = self.service_nodes[0]
+            self.dns_tier = dns_tier(self.service_nodes, self.vms, shard_by)
+            self.dns_tier.configure(self.hosts, dhcp, incremental)
+            return
+
+        self.service_node = get_fastest_host(self.hosts)
+        self.service_nodes = [self.service_node]
         logger.info('Setting up %s on %s', style.emph(service),
-                    style.host(service_node.split('.')[0]))
+                    style.host(self.service_node.split('.')[0]))
         clients = list(self.hosts)
-        clients.remove(service_node)
+        clients.remove(self.service_node)
 
-        dnsmasq_server(service_node, clients, self.vms, dhcp)
+        dnsmasq_server(self.service_node, clients, self.vms, dhcp,
+                       incremental)
 
-    def configure_libvirt(self, bridge='br0', libvirt_conf=None):
+    @traced()
+    def configure_libvirt(self, bridge='br0', libvirt_conf=None, hosts=None):
         """Enable a bridge if needed on the remote hosts, configure libvirt
         with a bridged network for the virtual machines, and restart service.
         """
-        self._enable_bridge()
-        self._libvirt_check_service()
-        self._libvirt_uniquify()
-        self._libvirt_bridged_network(bridge)
+        if hosts is None:
+            hosts = self.hosts
+        bridge_hosts = self.journal.hosts_todo('bridge', hosts)
+        if bridge_hosts:
+            self._enable_bridge(hosts=bridge_hosts)
+            self.journal.record_hosts('bridge', [host for host in bridge_hosts
+                                                 if host in self.hosts])
+        hosts = self.journal.hosts_todo('libvirt', [host for host in hosts
+                                                    if host in self.hosts])
+        if not hosts:
+            return
+        self._libvirt_check_service(hosts)
+        self._libvirt_uniquify(hosts)
+        self._libvirt_bridged_network(bridge, hosts)
         logger.info('Restarting %s', style.emph('libvirt'))
-        self.fact.get_remote('service libvirtd restart', self.hosts).run()
-
+        self.fact.get_remote('service libvirtd restart', hosts).run()
+        self.journal.record_hosts('libvirt', [host for host in hosts
+                                              if host in self.hosts])
+
+    @traced()
+    def start_agents(self, hosts=None):
+        """Start a vm5k agent on some hosts, default to all, if
+        ``use_agents`` is set. The hosts without agent keep using remote
+        commands."""
+        if not self.use_agents:
+            return
+        if hosts is None:
+            hosts = self.hosts
+        with self._state_lock:
+            if self.agents is None:
+                self.agents = set_agents(host_agents())
+        self.agents.start(hosts)
+
+    def stop_agents(self):
+        """Stop the agents of the hosts"""
+        if self.agents:
+            self.agents.stop()
+            if get_agents() is self.agents:
+                set_agents(None)
+            self.agents = None
+
+    @traced()
     def deploy_vms(self, clean_disks=False, disk_location='one',
-                   apt_cacher=False):
+                   apt_cacher=False, install_mode='virt-install',
+                   start_concurrency=4, disk_concurrency=4,
+                   disk_copy_mode='convert'):
         """Destroy the existing VMS, create the virtual disks, install the vms
-        start them and wait until they have rebooted"""
+        start them and wait until they have rebooted. ``install_mode`` can be
+        ``virt-install`` or ``xml`` (see ``vm5k.actions.install_vms``),
+        ``start_concurrency`` and ``disk_concurrency`` are the maximum number
+        of VMs started and of disks created at the same time on a host, and
+        ``disk_copy_mode`` is given to ``vm5k.actions.create_disks``"""
         logger.info('Destroying existing virtual machines')
-        destroy_vms(self.hosts, undefine=True)
+        self._destroy_vms(self.hosts)
         if clean_disks:
             self._remove_existing_disks()
         logger.info('Creating the virtual disks ')
         self._create_backing_file()
         if disk_location == 'one':
             logger.info('Create disk on each nodes')
-            create_disks(self.vms).run()
+            self._create_vms_disks(self.vms, disk_concurrency, disk_copy_mode)
         elif disk_location == 'all':
             logger.info('Create all disks on all nodes')
             create_disks_all_hosts(self.vms, self.hosts).run()
-        logger.info('Installing the virtual machines')
-        install_vms(self.vms).run()
-        logger.info('Starting the virtual machines')
-        self.boot_time = Timer()
-        start_vms(self.vms).run()
-        logger.info('Waiting for VM to boot ...')
-        wait_vms_have_started(self.vms, self.hosts[0])
-        activate_vms(self.vms)
-        self._update_vms_xml()
-        if apt_cacher:
-            configure_apt_proxy(self.vms)
+        self._start_vms(apt_cacher, install_mode, start_concurrency,
+                        disk_concurrency, disk_copy_mode)
 
     def get_state(self, name=None, output=True, mode='compact', plot=False):
         """ """
@@ -223,7 +347,7 @@ class vm5k_deployment():
         if output:
             output = self.outdir + '/' + name + '.xml'
             f = open(output, 'w')
-            f.write(prettify(self.state))
+            f.write(prettify(self.state.to_xml()))
             f.close()
 
         if mode == 'compact':
@@ -232,14 +356,216 @@ class vm5k_deployment():
         logger.info('State %s', log)
 
     # PRIVATE METHODS
+    @traced()
+    def _run_pipeline(self, clean_disks=False, apt_cacher=False,
+                      install_mode='virt-install', start_concurrency=4,
+                      disk_concurrency=4, disk_copy_mode='convert',
+                      max_workers=None):
+        """Deploy the hosts, then configure them and create the VMs disks
+        with a host_pipeline, so that each host goes through the stages at
+        its own pace. The hosts that have installed their base packages
+        within a few seconds receive the backing files together, while they
+        install and configure libvirt, and create their disks as soon as
+        their copy has ended. The options are those of deploy_vms, and
+        ``max_workers`` that of the host_pipeline."""
+        print_step('HOSTS DEPLOYMENT')
+        self.hosts_deployment(conf_ssh=False)
+
+        print_step('PIPELINED HOSTS CONFIGURATION')
+        stages = [
+            pipeline_stage('ssh', self._configure_ssh),
+            pipeline_stage('apt', self._todo('packages', self._configure_apt),
+                           ['ssh']),
+            pipeline_stage('base',
+                           self._todo('packages', lambda hosts:
+                                      self._apply_package_plan(
+                                          self._package_plans(True)[0],
+                                          hosts)),
+                           ['apt']),
+            pipeline_stage('copy', self._copy_backing_files, ['base'],
+                           wave_delay=10),
+            pipeline_stage('packages',
+                           self._todo('packages', lambda hosts:
+                                      self._apply_package_plan(
+                                          self._package_plans()[1], hosts,
+                                          update=False)),
+                           ['base']),
+            pipeline_stage('kvm', self._todo('packages', self._load_kvm,
+                                             record=True), ['packages']),
+            pipeline_stage('libvirt', lambda hosts:
+                           self.configure_libvirt(hosts=hosts), ['kvm']),
+            pipeline_stage('agent', self.start_agents, ['libvirt']),
+            pipeline_stage('disks', lambda hosts:
+                           self._prepare_hosts_vms(hosts, clean_disks,
+                                                   disk_concurrency,
+                                                   disk_copy_mode),
+                           ['agent', 'copy']),
+            pipeline_stage('service', lambda hosts:
+                           self.configure_service_node(), ['disks'],
+                           barrier=True),
+            pipeline_stage('vms', lambda hosts:
+                           self._start_vms(apt_cacher, install_mode,
+                                           start_concurrency,
+                                           disk_concurrency, disk_copy_mode),
+                           ['service'], barrier=True)]
+        pipeline = host_pipeline(self.hosts, stages,
+                                 check=lambda hosts: [host for host in hosts
+                                                      if host in self.hosts],
+                                 max_workers=max_workers)
+        try:
+            pipeline.run()
+        finally:
+            self.pipeline_report = pipeline.report()
+            pipeline.log_report()
+            if path.isdir(self.outdir):
+                with open(self.outdir + '/pipeline.json', 'w') as f:
+                    json.dump(self.pipeline_report, f, indent=2)
+
+    def _todo(self, stage, func, record=False):
+        """Return a pipeline function calling func on the hosts that have
+        not completed a stage in the journal, and recording the stage if
+        ``record``"""
+        def _func(hosts):
+            hosts = self.journal.hosts_todo(stage, hosts)
+            if hosts:
+                func(hosts)
+            if record:
+                self.journal.record_hosts(stage, [host for host in hosts
+                                                  if host in self.hosts])
+        return _func
+
+    @traced()
+    def _prepare_hosts_vms(self, hosts, clean_disks=False,
+                           disk_concurrency=4, disk_copy_mode='convert'):
+        """Destroy the existing VMs of some hosts, and create the disks of
+        the VMs that are placed on them"""
+        self._destroy_vms(hosts)
+        if clean_disks:
+            self._remove_existing_disks(hosts)
+        self._create_backing_file(hosts=hosts)
+        with self._state_lock:
+            vms = [vm.copy() for vm in self.vms if vm['host'] in hosts]
+        if vms:
+            self._create_vms_disks(vms, disk_concurrency, disk_copy_mode)
+
+    def _destroy_vms(self, hosts):
+        """Destroy and undefine the VMs of the hosts, except on the hosts
+        where the journal has VMs defined"""
+        with self._state_lock:
+            vms = [vm for vm in self.vms if vm['host'] in hosts]
+        kept = set(vm['host'] for vm in self.journal.vms_done('defined', vms))
+        if kept:
+            logger.info('Keeping the VMs of %s hosts', len(kept))
+        hosts = [host for host in hosts if host not in kept]
+        if hosts:
+            destroy_vms(hosts, undefine=True)
+
+    @traced()
+    def _create_vms_disks(self, vms, concurrency=4, copy_mode='convert'):
+        """Create the disks of the VMs on their hosts and record their
+        creation time"""
+        done = self.journal.vms_done('disk', vms)
+        if done:
+            logger.info('Disks of %s VMs already created', len(done))
+            self._disks_created.update((vm['id'], vm['host']) for vm in done)
+            vms = self.journal.vms_todo('disk', vms)
+            if not vms:
+                return
+        disks = create_disks(vms, concurrency=concurrency,
+                             copy_mode=copy_mode).run()
+        timing, failed = get_disks_timing(disks)
+        self.disks_timing.update(timing)
+        self._disks_created.update((vm['id'], vm['host']) for vm in vms
+                                   if vm['id'] not in failed)
+        self.journal.record_vms('disk', [vm for vm in vms
+                                         if vm['id'] not in failed])
+        if failed:
+            logger.warning('Unable to create the disks of %s',
+                           ', '.join(style.emph(vm_id) for vm_id in failed))
+        if timing:
+            logger.detail('Disks created in %.1fs on average, %.1fs max',
+                          sum(timing.values()) / len(timing),
+                          max(timing.values()))
+
+    @traced()
+    def _start_vms(self, apt_cacher=False, install_mode='virt-install',
+                   start_concurrency=4, disk_concurrency=4,
+                   disk_copy_mode='convert'):
+        """Install the VMs, start them and wait until they have booted. The
+        disks of VMs that have been moved to another host after the creation
+        of their disk are created first."""
+        missing = [vm for vm in self.vms
+                   if (vm['id'], vm['host']) not in self._disks_created]
+        if self._disks_created and missing:
+            logger.info('Creating the disks of %s moved VMs', len(missing))
+            self._create_vms_disks(missing, disk_concurrency, disk_copy_mode)
+        logger.info('Installing the virtual machines')
+        vms = self.journal.vms_todo('defined', self.vms)
+        agents = get_agents(self.hosts)
+        if not vms:
+            logger.info('All the VMs are already defined')
+        elif agents and install_mode == 'xml':
+            hosts_domains = {}
+            for vm in vms:
+                hosts_domains.setdefault(vm['host'], {})[vm['id']] = \
+                    vm_domain_xml(vm)
+            failed = agents.define_vms(hosts_domains)
+            if failed:
+                logger.warning('Unable to define %s',
+                               ', '.join(style.emph(vm_id)
+                                         for vm_id in failed))
+            self.journal.record_vms('defined', [vm for vm in vms
+                                                if vm['id'] not in failed])
+        else:
+            install = install_vms(vms, mode=install_mode).run()
+            hosts_ko = set(p.host.address for p in install.processes
+                           if getattr(p, 'host', None) and not p.ok)
+            self.journal.record_vms('defined', [vm for vm in vms
+                                                if vm['host'] not in hosts_ko])
+        logger.info('Starting the virtual machines')
+        self.boot_time = Timer()
+        ready = self.journal.vms_done('ready', self.vms)
+        for vm in ready:
+            vm['state'] = 'OK'
+        monitor = vm_readiness_monitor(self.vms, watch=False)
+        if self.kavlan:
+            for service_node in self.service_nodes:
+                monitor.listen_dnsmasq(service_node)
+        start = vm_start_scheduler(self.journal.vms_todo('started', self.vms),
+                                   host_concurrency=start_concurrency).run()
+        self.journal.record_vms('started', [vm for vm in self.vms
+                                            if vm['id'] in start.started])
+        if ready:
+            logger.info('%s VMs already ready', len(ready))
+        monitor.watch(self.journal.vms_todo('ready', self.vms))
+        logger.info('Waiting for VM to boot ...')
+        wait_vms_have_started(self.vms, monitor=monitor)
+        self.journal.record_vms('ready', [vm for vm in self.vms
+                                          if vm['id'] in monitor.ready])
+        if self.dns_tier:
+            self.dns_tier.log_load()
+        self.vms_boot_time = monitor.boot_times(start.started)
+        activate_vms(self.vms)
+        self._update_vms_xml()
+        if apt_cacher:
+            configure_apt_proxy(self.vms)
+
+    @traced()
     def _launch_kadeploy(self, max_tries=1, check_deploy=True):
         """Create a execo_g5k.Deployment object, launch the deployment and
         return a tuple (deployed_hosts, undeployed_hosts)
         """
-        logger.info('Deploying %s hosts \n%s', len(self.hosts),
-                    hosts_list(self.hosts))
+        done = self.journal.hosts_done('deployed', self.hosts)
+        hosts = self.journal.hosts_todo('deployed', self.hosts)
+        if done:
+            logger.info('%s hosts already deployed', len(done))
+            if not hosts:
+                self._update_hosts_state(done, [])
+                return done, []
+        logger.info('Deploying %s hosts \n%s', len(hosts),
+                    hosts_list(hosts))
         deployment = Deployment(hosts=[Host(canonical_host_name(host))
-                                       for host in self.hosts],
+                                       for host in hosts],
                                 env_file=self.env_file,
                                 env_name=self.env_name,
                                 user=self.env_user,
@@ -252,11 +578,9 @@ class vm5k_deployment():
             stdout = None
             stderr = None
 
-        deployed_hosts, undeployed_hosts = deploy(deployment,
-                                                  stdout_handlers=stdout,
-                                                  stderr_handlers=stderr,
-                                                  num_tries=max_tries,
-                                                  check_deployed_command=check_deploy)
+        deployed_hosts, undeployed_hosts = self.fact.deploy(
+            deployment, stdout_handlers=stdout, stderr_handlers=stderr,
+            num_tries=max_tries, check_deployed_command=check_deploy)
         deployed_hosts = list(deployed_hosts)
         undeployed_hosts = list(undeployed_hosts)
         # Renaming hosts if a kavlan is used
@@ -270,10 +594,15 @@ class vm5k_deployment():
         cr = '\n' if len(undeployed_hosts) > 0 else ''
         logger.info('Failed %s hosts %s%s', len(undeployed_hosts), cr,
                     hosts_list(undeployed_hosts))
+        self.journal.record_hosts('deployed', deployed_hosts)
+        deployed_hosts += done
         self._update_hosts_state(deployed_hosts, undeployed_hosts)
         return deployed_hosts, undeployed_hosts
 
-    def _configure_ssh(self):
+    @traced()
+    def _configure_ssh(self, hosts=None):
+        if hosts is None:
+            hosts = self.hosts
         if self.fact.remote_tool == 2:
             # Configuring SSH with precopy of id_rsa and id_rsa.pub keys on all
             # host to allow TakTuk connection
@@ -284,64 +613,90 @@ class vm5k_deployment():
             taktuk_conf = ('-s', )
         conf_ssh = self.fact.get_remote('echo "Host *" >> /root/.ssh/config ;' +
                                         'echo " StrictHostKeyChecking no" >> /root/.ssh/config; ',
-                                        self.hosts,
+                                        hosts,
                                         connection_params={'taktuk_options': taktuk_conf}).run()
         self._actions_hosts(conf_ssh)
 
-    def _start_disk_copy(self, disks=None):
-        """ """
+    @traced()
+    def _start_disk_copy(self, disks=None, hosts=None):
+        """Start the copy of the backing files on the hosts, sending to each
+        host only the chunks that differ from its own copy"""
         disks_copy = []
         if not disks:
             disks = self.backing_files
+        if hosts is None:
+            hosts = self.hosts
+        self.fact.get_fileput(hosts, [script_file()],
+                              remote_location='/tmp').run()
+        self._copy_dir = mkdtemp(prefix='vm5k_disks_')
         for bf in disks:
             logger.info('Treating ' + style.emph(bf))
             logger.debug("Checking frontend disk vs host disk")
-            raw_disk = '/tmp/orig_' + bf.split('/')[-1]
-            f_disk = Process('md5sum -b ' + bf).run()
-            disk_hash = f_disk.stdout.split(' ')[0]
-            cmd = 'if [ -f ' + raw_disk + ' ]; ' + \
-                'then md5sum  -b ' + raw_disk + '; fi'
-            h_disk = self.fact.get_remote(cmd, self.hosts).run()
-            disk_ok = True
-            for p in h_disk.processes:
-
-                if p.stdout.split(' ')[0] != disk_hash:
-                    disk_ok = False
-                    break
-            if disk_ok:
+            copy = image_copy(bf, hosts, self.fact, self._copy_dir)
+            if len(copy) == 0:
                 logger.info("Disk " + style.emph(bf) +
                             " is already present, skipping copy")
-            else:
-                disks_copy.append(self.fact.get_fileput(self.hosts, [bf],
-                                                        remote_location="/tmp"))
+            disks_copy += copy
         if len(disks_copy) > 0:
             self.copy_actions = ParallelActions(disks_copy).start()
         else:
-            self.copy_actions = Remote('ls', self.hosts[0]).run()
+            self.copy_actions = self.fact.get_remote('ls', hosts[:1]).run()
 
-    def _create_backing_file(self, disks=None):
-        """ """
-        if not self.copy_actions:
+    @traced()
+    def _copy_backing_files(self, hosts, disks=None):
+        """Copy the backing files on a wave of hosts, chaining the transfers
+        between them, and wait for the end of the copy, independently of the
+        copies of the other waves"""
+        if not disks:
+            disks = self.backing_files
+        with self._copy_lock:
+            for bf in disks:
+                local_manifest(bf)
+        self.fact.get_fileput(hosts, [script_file()],
+                              remote_location='/tmp').run()
+        copy_dir = mkdtemp(prefix='vm5k_disks_')
+        try:
+            disks_copy = []
+            for bf in disks:
+                disks_copy += image_copy(bf, hosts, self.fact, copy_dir)
+            if disks_copy:
+                ParallelActions(disks_copy).run()
+                for act in disks_copy:
+                    self._actions_hosts(act.actions[-1], hosts)
+        finally:
+            rmtree(copy_dir, ignore_errors=True)
+        with self._state_lock:
+            self._hosts_copied.update(hosts)
+
+    @traced()
+    def _create_backing_file(self, disks=None, hosts=None):
+        """Wait for the end of the backing files copy and add the ssh keys
+        to the reference images of the hosts"""
+        if hosts is None:
+            hosts = self.hosts
+        if not self.copy_actions and \
+                not all(host in self._hosts_copied for host in hosts):
             self._start_disk_copy(disks)
-        if not self.copy_actions.ended:
+        if self.copy_actions and not self.copy_actions.ended:
             logger.info("Waiting for the end of the disks copy")
             self.copy_actions.wait()
         if isinstance(self.copy_actions, ParallelActions):
-            mv_actions = []
             for act in self.copy_actions.actions:
-                fname = act.local_files[0].split('/')[-1]
-                mv_actions.append(self.fact.get_remote("mv /tmp/" + fname +
-                                                       " /tmp/orig_" + fname,
-                                                       self.hosts))
-
-            mv = ParallelActions(mv_actions).run()
+                self._actions_hosts(act.actions[-1], hosts)
+        if self._copy_dir:
+            rmtree(self._copy_dir, ignore_errors=True)
+            self._copy_dir = None
+        hosts = self.journal.hosts_todo('backing', [host for host in hosts
+                                                    if host in self.hosts])
+        if not hosts:
+            return
 
         if not disks:
             disks = self.backing_files
         for bf in disks:
             raw_disk = '/tmp/orig_' + bf.split('/')[-1]
             to_disk = '/tmp/' + bf.split('/')[-1]
-            self.fact.get_remote('cp ' + raw_disk + ' ' + to_disk, self.hosts).run()
+            self.fact.get_remote('cp ' + raw_disk + ' ' + to_disk, hosts).run()
             logger.info('Copying ssh key on ' + to_disk + ' ...')
             cmd = 'modprobe nbd max_part=16; ' + \
                 'qemu-nbd --connect=/dev/nbd0 ' + to_disk + \
@@ -352,20 +707,26 @@ class vm5k_deployment():
                 'cp -r /root/.ssh/id_rsa* /mnt/root/.ssh/ ;' + \
                 'umount /mnt; qemu-nbd -d /dev/nbd0'
             logger.detail(cmd)
-            copy_on_vm_base = self.fact.get_remote(cmd, self.hosts).run()
+            copy_on_vm_base = self.fact.get_remote(cmd, hosts).run()
             self._actions_hosts(copy_on_vm_base)
+        self.journal.record_hosts('backing', [host for host in hosts
+                                              if host in self.hosts])
 
+    @traced()
     def _remove_existing_disks(self, hosts=None):
         """Remove all img and qcow2 file from /tmp directory """
         logger.info('Removing existing disks')
         if hosts is None:
             hosts = self.hosts
         remove = self.fact.get_remote('rm -f /tmp/*.img; rm -f /tmp/*.qcow2',
-                                      self.hosts).run()
+                                      hosts).run()
         self._actions_hosts(remove)
 
-    def _libvirt_check_service(self):
+    @traced()
+    def _libvirt_check_service(self, hosts=None):
         """ """
+        if hosts is None:
+            hosts = self.hosts
         logger.detail('Checking libvirt service name')
         cmd = "if [ ! -e /etc/init.d/libvirtd ]; " + \
             "  then if [ -e /etc/init.d/libvirt-bin ]; " + \
@@ -373,19 +734,25 @@ class vm5k_deployment():
             "       else echo 1; " + \
             "        fi; " + \
             "else echo 0; fi"
-        check_libvirt = self.fact.get_remote(cmd, self.hosts).run()
+        check_libvirt = self.fact.get_remote(cmd, hosts).run()
         self._actions_hosts(check_libvirt)
 
-    def _libvirt_uniquify(self):
+    @traced()
+    def _libvirt_uniquify(self, hosts=None):
+        if hosts is None:
+            hosts = self.hosts
         logger.detail('Making libvirt host unique')
         cmd = 'uuid=`uuidgen` ' + \
             '&& sed -i "s/.*host_uuid.*/host_uuid=\\"${uuid}\\"/g" ' + \
             '/etc/libvirt/libvirtd.conf ' + \
             '&& service libvirtd restart'
         logger.debug(cmd)
-        self.fact.get_remote(cmd, self.hosts).run()
+        self.fact.get_remote(cmd, hosts).run()
 
-    def _libvirt_bridged_network(self, bridge):
+    @traced()
+    def _libvirt_bridged_network(self, bridge, hosts=None):
+        if hosts is None:
+            hosts = self.hosts
         logger.detail('Configuring libvirt network')
         # Creating an XML file describing the network
         root = Element('network')
@@ -400,23 +767,26 @@ class vm5k_deployment():
         logger.debug('Destroying existing network')
         destroy = self.fact.get_remote('virsh net-destroy default; ' +
                                        'virsh net-undefine default',
-                                       self.hosts)
-        put = TaktukPut(self.hosts, [network_xml],
-                        remote_location='/root/')
+                                       hosts)
+        put = self.fact.get_fileput(hosts, [network_xml],
+                                    remote_location='/root/', tool=TAKTUK)
         start = self.fact.get_remote(
             'virsh net-define /root/' + \
             network_xml.split('/')[-1] + ' ; ' + \
             'virsh net-start default; virsh net-autostart default;',
-            self.hosts)
+            hosts)
         netconf = SequentialActions([destroy, put, start]).run()
 
         self._actions_hosts(netconf)
 
     # Hosts configuration
-    def _enable_bridge(self, name='br0'):
+    @traced()
+    def _enable_bridge(self, name='br0', hosts=None):
         """We need a bridge to have automatic DHCP configuration for the VM."""
+        if hosts is None:
+            hosts = self.hosts
         logger.detail('Configuring the bridge')
-        hosts_br = self._get_bridge(self.hosts)
+        hosts_br = self._get_bridge(hosts)
         nobr_hosts = []
         for host, br in hosts_br.iteritems():
             if br is None:
@@ -425,8 +795,9 @@ class vm5k_deployment():
             elif br != name:
                 logger.debug('Wrong bridge on host %s, destroying it',
                              style.host(host))
-                SshProcess('ip link set ' + br + ' down ; brctl delbr ' + br,
-                            host).run()
+                self.fact.get_ssh_process('ip link set ' + br +
+                                          ' down ; brctl delbr ' + br,
+                                          host).run()
                 nobr_hosts.append(host)
             else:
                 logger.debug('Bridge %s is present on host %s',
@@ -464,9 +835,9 @@ class vm5k_deployment():
             while (not if_up) and nmap_tries < 20:
                 sleep(20)
                 nmap_tries += 1
-                nmap = Process('nmap ' +
-                               ' '.join([host for host in nobr_hosts]) +
-                               ' -p 22').run()
+                nmap = self.fact.get_process(
+                    'nmap ' + ' '.join([host for host in nobr_hosts]) +
+                    ' -p 22').run()
                 for line in nmap.stdout.split('\n'):
                     if 'Nmap done' in line:
                         if_up = line.split()[2] == line.split()[5].replace('(',
@@ -491,8 +862,11 @@ class vm5k_deployment():
                 hosts_br[p.host] = stdout
         return hosts_br
 
-    def _configure_apt(self):
+    @traced()
+    def _configure_apt(self, hosts=None):
         """Create the sources.list file """
+        if hosts is None:
+            hosts = self.hosts
         logger.detail('Configuring APT')
         # Create sources.list file
         fd, tmpsource = mkstemp(dir='/tmp/', prefix='sources.list_')
@@ -513,61 +887,125 @@ class vm5k_deployment():
         f.write('APT::Acquire::Retries=20;\n')
         f.close()
 
-        TaktukPut(self.hosts, [tmpsource, tmppref, tmpaptconf],
-                  remote_location='/etc/apt/').run()
+        self.fact.get_fileput(hosts, [tmpsource, tmppref, tmpaptconf],
+                              remote_location='/etc/apt/', tool=TAKTUK).run()
         cmd = 'cd /etc/apt && ' + \
             'mv ' + tmpsource.split('/')[-1] + ' sources.list &&' + \
             'mv ' + tmppref.split('/')[-1] + ' preferences &&' + \
             'mv ' + tmpaptconf.split('/')[-1] + ' apt.conf'
-        apt_conf = self.fact.get_remote(cmd, self.hosts).run()
+        apt_conf = self.fact.get_remote(cmd, hosts).run()
         self._actions_hosts(apt_conf)
         Local('rm ' + tmpsource + ' ' + tmppref + ' ' + tmpaptconf).run()
+        self._put_deb_bundle([host for host in hosts if host in self.hosts])
+
+    @traced()
+    def _put_deb_bundle(self, hosts=None):
+        """Copy the .deb files of ``deb_bundle`` in the APT cache of the
+        hosts with chainput, so that APT does not download them"""
+        if not self.deb_bundle:
+            return
+        if hosts is None:
+            hosts = self.hosts
+        debs = deb_files(self.deb_bundle)
+        if not debs:
+            logger.warning('No .deb file in %s', style.emph(self.deb_bundle))
+            return
+        if not hosts:
+            return
+        logger.info('Copying %s packages of %s', len(debs),
+                    style.emph(self.deb_bundle))
+        put = self.fact.get_fileput(hosts, debs,
+                                    remote_location=apt_archives)
+        for p in put.processes:
+            p.nolog_exit_code = True
+        put.run()
+        if not put.ok:
+            logger.warning('The packages could not be copied on some hosts, '
+                           'they are downloaded from the mirror')
+
+    def _package_plans(self, upgrade=False, other_packages=None):
+        """Return the plan of the base packages, without their recommended
+        packages, and the plan of the libvirt and extra packages"""
+        base = package_plan(upgrade, recommends=False).add(base_packages)
+        plan = package_plan().add(libvirt_packages, libvirt_release)
+        if other_packages:
+            plan.add(other_packages)
+        return base, plan
 
-    def _upgrade_hosts(self):
+    @traced()
+    def _apply_package_plan(self, plan, hosts=None, update=True):
+        """Run a package plan on some hosts, default to all"""
+        if hosts is None:
+            hosts = self.hosts
+        logger.info('Installing packages%s \n%s',
+                    ' after a dist-upgrade' if plan.upgrade else '',
+                    style.emph(' '.join(plan.targets())))
+        install = self.fact.get_remote(plan.command(update=update),
+                                       hosts).run()
+        self._actions_hosts(install)
+
+    @traced()
+    def _upgrade_hosts(self, hosts=None):
         """Dist upgrade performed on all hosts"""
+        if hosts is None:
+            hosts = self.hosts
         logger.info('Upgrading packages')
-        cmd = "echo 'debconf debconf/frontend select noninteractive' | debconf-set-selections ; " + \
-              "echo 'debconf debconf/priority select critical' | debconf-set-selections ;      " + \
-              "export DEBIAN_MASTER=noninteractive ; apt-get update ; " + \
-              "apt-get dist-upgrade -y --force-yes -o Dpkg::Options::='--force-confdef' " + \
-              "-o Dpkg::Options::='--force-confold' "
-        upgrade = self.fact.get_remote(cmd, self.hosts).run()
+        upgrade = self.fact.get_remote(package_plan(upgrade=True).command(),
+                                       hosts).run()
         self._actions_hosts(upgrade)
 
-    def _install_packages(self, other_packages=None, launch_disk_copy=True):
-        """Installation of required packages on the hosts"""
-        base_packages = 'uuid-runtime bash-completion taktuk locate htop init-system-helpers netcat-traditional'
-        logger.info('Installing base packages \n%s', style.emph(base_packages))
-        cmd = 'export DEBIAN_MASTER=noninteractive ; apt-get update && apt-get ' + \
-            'install -y --force-yes --no-install-recommends ' + base_packages
-        install_base = self.fact.get_remote(cmd, self.hosts).run()
-        self._actions_hosts(install_base)
+    @traced()
+    def _install_packages(self, other_packages=None, launch_disk_copy=True,
+                          hosts=None, upgrade=False):
+        """Installation of required packages on some hosts, default to all.
+        The copy of the backing files is started on all the hosts once the
+        base packages are installed, and goes on while libvirt and the
+        other packages are installed."""
+        if hosts is None:
+            hosts = self.hosts
+        base, plan = self._package_plans(upgrade, other_packages)
+        if hosts:
+            self._apply_package_plan(base, hosts)
         if launch_disk_copy:
             self._start_disk_copy()
-        libvirt_packages = 'libvirt-bin virtinst python2.7 python-pycurl python-libxml2 qemu-kvm nmap libgmp10'
-        logger.info('Installing libvirt packages \n%s',
-                    style.emph(libvirt_packages))
-        cmd = 'export DEBIAN_MASTER=noninteractive ; apt-get update && apt-get install -y --force-yes '+\
-            '-o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold" -t wheezy-backports '+\
-            libvirt_packages
-        install_libvirt = self.fact.get_remote(cmd, self.hosts).run()
-        self._actions_hosts(install_libvirt)
-        if other_packages:
-            self._other_packages(other_packages)
+        hosts = [host for host in hosts if host in self.hosts]
+        if hosts:
+            self._apply_package_plan(plan, hosts, update=False)
 
-    def _other_packages(self, other_packages=None):
-        """Installation of packages"""
-        other_packages = other_packages.replace(',', ' ')
-        logger.info('Installing extra packages \n%s',
-                    style.emph(other_packages))
+    @traced()
+    def _install_base_packages(self, hosts=None):
+        """Installation of the packages required for the disks copy"""
+        if hosts is None:
+            hosts = self.hosts
+        self._apply_package_plan(package_plan(recommends=False)
+                                 .add(base_packages), hosts)
 
-        cmd = 'export DEBIAN_MASTER=noninteractive ; ' + \
-            'apt-get update && apt-get install -y --force-yes ' + \
-            other_packages
-        install_extra = self.fact.get_remote(cmd, self.hosts).run()
-        self._actions_hosts(install_extra)
+    @traced()
+    def _install_libvirt_packages(self, hosts=None):
+        """Installation of libvirt and KVM"""
+        if hosts is None:
+            hosts = self.hosts
+        self._apply_package_plan(package_plan().add(libvirt_packages,
+                                                    libvirt_release), hosts)
+
+    @traced()
+    def _load_kvm(self, hosts=None):
+        """Load the KVM modules"""
+        if hosts is None:
+            hosts = self.hosts
+        self.fact.get_remote(
+            'modprobe kvm; modprobe kvm-intel; modprobe kvm-amd ; ' + \
+            'chown root:kvm /dev/kvm ;', hosts).run()
+
+    @traced()
+    def _other_packages(self, other_packages=None, hosts=None):
+        """Installation of packages"""
+        if hosts is None:
+            hosts = self.hosts
+        self._apply_package_plan(package_plan().add(other_packages), hosts)
 
     # State related methods
+    @traced()
     def _define_elements(self, infile=None, resources=None,
                          hosts=None, vms=None, ip_mac=None,
                          distribution=None):
@@ -589,7 +1027,8 @@ class vm5k_deployment():
             self.clusters = []
 
         if not infile:
-            self.vms = vms
+            self.vms = vms if vms is None or isinstance(vms, VMTable) \
+                else VMTable(vms)
             if len(filter(lambda v: v['host'] is None, self.vms)) > 0:
                 self.distribution = distribution if distribution \
                     else 'round-robin'
@@ -604,11 +1043,15 @@ class vm5k_deployment():
                 exit()
 
         self._add_xml_elements()
+        if self.journal.resumed:
+            self._resume_hosts()
 
         if self.vms:
             if self.distribution:
-                distribute_vms(self.vms, self.hosts, self.distribution)
+                self._distribute_vms()
             self._set_vms_ip_mac()
+            if self.journal.resumed:
+                self._resume_vms()
             self._add_xml_vms()
         else:
             self.vms = []
@@ -630,7 +1073,7 @@ class vm5k_deployment():
             # multi site in prod network
             self.ip_mac = {site: resource['ip_mac']
                            for site, resource in resources.iteritems()}
-        if isinstance(self.ip_mac, list) and len(self.ip_mac) == 0:
+        if not isinstance(self.ip_mac, dict) and len(self.ip_mac) == 0:
             logger.error('No ip_range given in the resources')
             exit()
         elif isinstance(self.ip_mac, dict):
@@ -692,9 +1135,10 @@ class vm5k_deployment():
                     '\n resource %s \n infile %s', self.hosts, hosts)
                 ok = False
             else:
+                el_hosts = {el_host.get('id'): el_host
+                            for el_host in xml.findall('.//host')}
                 for i in range(len(hosts)):
-                    el_host = xml.find(".//host/[@id='" + hosts[i] + "']")
-                    el_host.attrib['id'] = self.hosts[i]
+                    el_hosts[hosts[i]].attrib['id'] = self.hosts[i]
 
         return ok
 
@@ -716,7 +1160,7 @@ class vm5k_deployment():
         def _default_xml_value(key):
             return default_vm[key] if key not in vm.attrib else vm.get(key)
 
-        vms = []
+        vms = VMTable()
         for host in xml.findall('.//host'):
             for vm in host.findall('.//vm'):
                 vms.append({'id': vm.get('id'),
@@ -730,12 +1174,43 @@ class vm5k_deployment():
                     'state': 'KO'})
         return vms
 
+    def _resume_hosts(self):
+        """Remove the hosts that were KO in the journal"""
+        ko = [host for host in self.hosts if host in self.journal.ko_hosts]
+        for host in ko:
+            self.state.set_host_state(host, 'KO')
+            self.hosts.remove(host)
+        if ko:
+            logger.info('Skipping %s hosts KO in the journal', len(ko))
+
+    def _resume_vms(self):
+        """Give back to the VMs the host, ip and mac recorded in the
+        journal, and move the VMs whose host is lost"""
+        placement = self.journal.placement
+        hosts = set(self.hosts)
+        lost = set()
+        for vm in self.vms:
+            placed = placement.get(vm['id'])
+            if placed is None:
+                continue
+            if placed['host'] not in hosts:
+                lost.add(placed['host'])
+            vm['host'], vm['ip'], vm['mac'] = placed['host'], placed['ip'], \
+                placed['mac']
+        self._placement = None
+        if lost:
+            self._move_vms(lost)
+
+    @traced()
     def _set_vms_ip_mac(self):
         """Not finished """
         if isinstance(self.ip_mac, dict):
             i_vm = {site: 0 for site in self.sites}
+            hosts_site = {}
             for vm in self.vms:
-                vm_site = get_host_site(vm['host'])
+                if vm['host'] not in hosts_site:
+                    hosts_site[vm['host']] = get_host_site(vm['host'])
+                vm_site = hosts_site[vm['host']]
                 vm['ip'], vm['mac'] = self.ip_mac[vm_site][i_vm[vm_site]]
                 i_vm[vm_site] += 1
         else:
@@ -743,49 +1218,36 @@ class vm5k_deployment():
             for vm in self.vms:
                 vm['ip'], vm['mac'] = self.ip_mac[i_vm]
                 i_vm += 1
+        self._ip_next = i_vm
 
+    @traced()
     def _add_xml_elements(self):
         """Add sites, clusters, hosts to self.state """
-        _state = self.state
-        logger.debug('Initial state \n %s', prettify(_state))
         for site in self.sites:
-            SubElement(_state, 'site', attrib={'id': site})
-        else:
-            el_site = SubElement(_state, 'site', attrib={'id': 'unknown'})
-        logger.debug('Sites added \n %s', prettify(_state))
+            self.state.add_site(site)
+        self.state.add_site('unknown')
+        clusters_site = {get_host_cluster(host): get_host_site(host)
+                         for host in self.hosts}
         for cluster in self.clusters:
-            el_site = _state.find("./site[@id='" + get_cluster_site(cluster) \
-                                  + "']")
-            SubElement(el_site, 'cluster', attrib={'id': cluster})
-        else:
-            el_cluster = SubElement(el_site, 'cluster', attrib={'id': 'unknown'})
-        logger.debug('Clusters added \n %s', prettify(_state))
+            self.state.add_cluster(cluster, clusters_site.get(cluster,
+                                                              'unknown'))
+        self.state.add_cluster('unknown', self.state.clusters[self.clusters[-1]]
+                               if self.clusters else 'unknown')
         hosts_attr = get_CPU_RAM_FLOPS(self.hosts)
         for host in self.hosts:
-            if host in get_g5k_hosts(): 
-                el_cluster = _state.find(".//cluster/[@id='" +
-                                         get_host_cluster(host) + "']")
-
-            SubElement(el_cluster, 'host', attrib={'id': host,
-                                                   'state': 'Undeployed',
-                                                   'cpu': str(hosts_attr[host]['CPU']),
-                                                   'mem': str(hosts_attr[host]['RAM'])})
-        logger.debug('Hosts added \n %s', prettify(_state))
+            cluster = get_host_cluster(host)
+            self.state.add_host(host, cluster if cluster in self.clusters
+                                else 'unknown',
+                                state='Undeployed',
+                                cpu=str(hosts_attr[host]['CPU']),
+                                mem=str(hosts_attr[host]['RAM']))
+        if logger.getEffectiveLevel() <= 10:
+            logger.debug('Hosts added \n %s', prettify(self.state.to_xml()))
 
     def _add_xml_vms(self):
         """Add vms distributed on hosts to self.state """
         for vm in self.vms:
-            host = self.state.find(".//host/[@id='" + vm['host'] + "']")
-            SubElement(host, 'vm', attrib={'id': vm['id'],
-                                           'ip': vm['ip'],
-                                           'mac': vm['mac'],
-                                           'mem': str(vm['mem']),
-                                           'n_cpu': str(vm['n_cpu']),
-                                           'cpuset': vm['cpuset'],
-                                           'hdd': str(vm['hdd']),
-                                           'backing_file': vm['backing_file'],
-                                           'real_file': str(vm['real_file']),
-                                           'state': vm['state']})
+            self.state.add_vm(vm)
 
     def _print_state_compact(self):
         """Display in a compact form the distribution of vms on hosts."""
@@ -829,38 +1291,124 @@ class vm5k_deployment():
         return log
 
     def _update_vms_xml(self):
-        for vm in self.vms:
-            self.state.find(".//vm/[@id='" + vm['id'] + "']").set('state',
-                                                                vm['state'])
+        self.state.update_vms(self.vms)
 
     def _update_hosts_state(self, hosts_ok, hosts_ko):
-        """ """
+        """Record the state of the hosts and remove the KO hosts, placing
+        again the VMs if some hosts are lost"""
+        tracer.record_hosts(hosts_ok, hosts_ko)
+        with self._state_lock:
+            self._set_hosts_state(hosts_ok, hosts_ko)
+
+    def _set_hosts_state(self, hosts_ok, hosts_ko):
         for host in hosts_ok:
             if host:
                 if isinstance(host, Host):
                     host = host.address
-                self.state.find(".//host/[@id='" + host + "']").set('state',
-                                                                    'OK')
+                self.state.set_host_state(host, 'OK')
         for host in hosts_ko:
             if host:
                 if isinstance(host, Host):
                     host = host.address
-                self.state.find(".//host/[@id='" + host + "']").set('state',
-                                                                    'KO')
-                self.hosts.remove(host)
+                self.state.set_host_state(host, 'KO')
+                if host in self.hosts:
+                    self.hosts.remove(host)
+        self.journal.record_ko(hosts_ko)
 
         if len(self.hosts) == 0:
             logger.error('No hosts available, because %s are KO',
                          hosts_list(hosts_ko))
             exit()
 
-        if self.vms:
-            distribute_vms(self.vms, self.hosts, self.distribution)
-            self._set_vms_ip_mac()
+        if self.vms and hosts_ko:
+            self._move_vms([host.address if isinstance(host, Host) else host
+                            for host in hosts_ko if host])
+
+    def _get_service_nodes(self, n_service_nodes, shard_by):
+        """Return the fastest hosts, one by site if sharding by site"""
+        attr = get_CPU_RAM_FLOPS(self.hosts)
+        hosts = sorted(self.hosts, key=lambda host: -attr[host]['flops'])
+        if shard_by == 'site':
+            sites_hosts = {}
+            for host in hosts:
+                sites_hosts.setdefault(get_host_site(host), []).append(host)
+            n_by_site = max(1, n_service_nodes // len(sites_hosts))
+            return [host for site in sorted(sites_hosts)
+                    for host in sites_hosts[site][:n_by_site]]
+        return hosts[:n_service_nodes]
+
+    @traced()
+    def _distribute_vms(self):
+        """Place the VMs on the hosts and stop the deployment if the hosts
+        cannot sustain all of them"""
+        report = distribute_vms(self.vms, self.hosts, self.distribution)
+        self._placement = None
+        if report and not report['feasible']:
+            exit()
 
-    def _actions_hosts(self, action):
+    @traced()
+    def _move_vms(self, hosts_ko):
+        """Place the VMs of some KO hosts on the remaining capacity of the
+        other hosts. The other VMs are not moved, and the moved VMs keep
+        their ip and mac unless they change of site."""
+        moved = [vm for host in hosts_ko for vm in self._vms_on_host(host)]
+        engine = self._placement_engine()
+        for host in hosts_ko:
+            engine.remove_host(host)
+        if not moved:
+            return
+        sites = [get_host_site(vm['host']) for vm in moved]
+        report = engine.place(moved)
+        if not report['feasible']:
+            log_infeasible(report)
+            exit()
+        if isinstance(self.ip_mac, dict):
+            for vm, site in zip(moved, sites):
+                if get_host_site(vm['host']) != site:
+                    vm['ip'], vm['mac'] = self._next_ip_mac(
+                        get_host_site(vm['host']))
+        for vm in moved:
+            if vm['id'] in self.state.vms:
+                self.state.add_vm(vm)
+        self.journal.record_vms('placed', moved)
+        logger.info('%s VMs of %s moved on the other hosts',
+                    style.emph(len(moved)), hosts_list(hosts_ko))
+
+    def _vms_on_host(self, host):
+        if isinstance(self.vms, VMTable):
+            return self.vms.on_host(host)
+        return [vm for vm in self.vms if vm['host'] == host]
+
+    def _placement_engine(self):
+        """Return the placement engine of the hosts, that keeps their
+        remaining capacity between the moves of VMs"""
+        if self._placement is None:
+            mode = 'best-fit' if self.distribution in \
+                ['concentrated', 'first-fit-decreasing', 'best-fit'] \
+                else 'balanced'
+            engine = placement_engine(self.hosts, mode)
+            for vm in self.vms:
+                if engine.has_host(vm['host']):
+                    engine.reserve(vm['host'], vm)
+            self._placement = engine
+        return self._placement
+
+    def _next_ip_mac(self, site):
+        """Return the first ip and mac of a site not used by a VM"""
+        if not isinstance(self._ip_next, dict):
+            self._ip_next = {}
+        used = vms_by(self.vms, 'ip')
+        i = self._ip_next.get(site, 0)
+        while self.ip_mac[site][i][0] in used:
+            i += 1
+        self._ip_next[site] = i + 1
+        return self.ip_mac[site][i]
+
+    def _actions_hosts(self, action, hosts=None):
         hosts_ok, hosts_ko = [], []
         for p in action.processes:
+            if hosts is not None and p.host.address not in hosts:
+                continue
             if p.ok:
                 hosts_ok.append(p.host)
             else:
@@ -16,31 +16,190 @@
 # You should have received a copy of the GNU General Public License
 # along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
 
+import sys
 from os import path, mkdir, listdir, remove
 from pprint import pformat
 from xml.etree.ElementTree import fromstring, parse, ElementTree
+from collections import OrderedDict
 import time
 import datetime
-from execo import Host, SshProcess, sleep, Remote, TaktukRemote, Get, Put, ChainPut, \
+from execo import Host, SshProcess, Remote, TaktukRemote, Get, Put, ChainPut, \
     SequentialActions, ParallelActions, format_date, format_duration, \
     default_connection_params
-from execo.time_utils import timedelta_to_seconds
+from execo.time_utils import timedelta_to_seconds, get_seconds
 from execo.config import SSH, SCP, TAKTUK, CHAINPUT
 from execo.log import style
 from execo.action import ActionFactory
-from execo_g5k import default_frontend_connection_params, get_oar_job_info, \
-    get_cluster_site, OarSubmission, \
-    oarsub, get_oar_job_nodes, wait_oar_job_start, oardel, get_host_attributes
+from execo_g5k import default_frontend_connection_params, get_cluster_site, \
+    OarSubmission, oarsub, get_oar_job_nodes, wait_oar_job_start, oardel, \
+    get_host_attributes
 from execo_g5k.planning import get_planning, compute_slots, get_jobs_specs
-from vm5k import config, define_vms, create_disks, install_vms, start_vms, wait_vms_have_started,\
-    destroy_vms, rm_qcow2_disks, vm5k_deployment, get_oar_job_vm5k_resources, print_step
+from vm5k import config, define_vms, create_disks, install_vms, destroy_vms, \
+    rm_qcow2_disks, vm5k_deployment, get_oar_job_vm5k_resources, print_step
 from vm5k.config import default_vm
+from vm5k.backend import get_backend
+from vm5k.ippool import ip_mac_pool
+from vm5k.readiness import vm_readiness_monitor
+from vm5k.scheduler import vm_start_scheduler
+from vm5k.campaign import host_pool, oar_job_state, combination_scheduler
 from execo_engine import Engine, ParamSweeper, sweep, slugify, logger
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 
 
 default_connection_params['user'] = 'root'
 
+vm_domain_params = ['mem', 'n_cpu', 'cpuset', 'mac', 'tap']
+"""The parameters of a VM that are part of its libvirt domain"""
+
+vm_disk_params = ['backing_file', 'real_file', 'hdd']
+"""The parameters of a VM that are part of its disk"""
+
+
+class host_state_tracker():
+    """The domains and the disks left on the hosts by the previous
+    combination, so that a combination keeps those whose parameters have not
+    changed instead of destroying and recreating all of them. The state of a
+    host is unknown until a combination has recorded its VMs, and is
+    forgotten as soon as they are changed."""
+
+    def __init__(self):
+        self._vms = {}
+        self._keys = {}
+        self._lock = Lock()
+
+    def plan(self, vms, hosts, fresh_disks=False):
+        """Return a dict describing how to go from the VMs on the hosts to
+        the VMs of a combination:
+
+        - ``keep``: the VMs whose domain and disk are kept
+        - ``define``: the VMs whose domain is defined
+        - ``disk``: the VMs whose disk is created
+        - ``undefine``: a dict whose keys are the hosts and values the ids
+          of the domains to undefine, no longer needed or redefined
+        - ``rm``: a dict whose keys are the hosts and values the ids of the
+          VMs whose disk is removed
+        - ``unknown``: the hosts whose state is unknown, that are cleaned
+
+        :param fresh_disks: if True, the disks are all created again, e.g.
+         when the state of the disks changes the measures, or a function
+         returning True for the VMs whose disk is created again
+        """
+        plan = {'keep': [], 'define': [], 'disk': [], 'undefine': {},
+                'rm': {}, 'unknown': []}
+        with self._lock:
+            for host in hosts:
+                if host not in self._vms:
+                    plan['unknown'].append(host)
+                    continue
+                ids = [vm['id'] for vm in vms if vm['host'] == host]
+                removed = [vm_id for vm_id in self._vms[host]
+                           if vm_id not in ids]
+                if removed:
+                    plan['undefine'][host] = list(removed)
+                    plan['rm'][host] = removed
+            for vm in vms:
+                old = self._vms.get(vm['host'], {}).get(vm['id'])
+                same_domain = old is not None and \
+                    all(old[p] == vm.get(p) for p in vm_domain_params)
+                fresh = fresh_disks(vm) if callable(fresh_disks) \
+                    else fresh_disks
+                same_disk = old is not None and not fresh and \
+                    all(old[p] == vm.get(p) for p in vm_disk_params)
+                if not same_domain:
+                    plan['define'].append(vm)
+                    if old is not None:
+                        plan['undefine'].setdefault(vm['host'],
+                                                    []).append(vm['id'])
+                if not same_disk:
+                    plan['disk'].append(vm)
+                if same_domain and same_disk:
+                    plan['keep'].append(vm)
+        return plan
+
+    def record(self, vms, hosts, key=None):
+        """Record the VMs present on the hosts and the key of the
+        combination that defined them"""
+        with self._lock:
+            for host in hosts:
+                self._vms[host] = OrderedDict()
+                self._keys[host] = key
+            for vm in vms:
+                self._vms[vm['host']][vm['id']] = \
+                    {p: vm.get(p) for p in ['ip'] + vm_domain_params +
+                     vm_disk_params}
+
+    def forget(self, hosts):
+        """Make the state of the hosts unknown"""
+        with self._lock:
+            for host in hosts:
+                self._vms.pop(host, None)
+                self._keys.pop(host, None)
+
+    def key(self, hosts):
+        """Return the key of the combination whose VMs are on all the
+        hosts, or None"""
+        with self._lock:
+            keys = set(self._keys.get(host) for host in hosts)
+        return keys.pop() if len(keys) == 1 else None
+
+    def ip_mac(self, hosts):
+        """Return the list of the (ip, mac) of the VMs on the hosts, in the
+        order they were recorded"""
+        with self._lock:
+            return [(vm['ip'], vm['mac']) for host in hosts
+                    for vm in self._vms.get(host, {}).itervalues()]
+
+
+def prepare_vms(vms, hosts, host_states, key=None, fresh_disks=False,
+                clean=None):
+    """Stop the VMs of the hosts and prepare the domains and the disks of
+    the VMs of a combination, keeping those that have not changed since the
+    previous combination. Return the plan of the host_state_tracker, or None
+    if the VMs could not be prepared.
+
+    :param vms: the VMs of the combination
+
+    :param hosts: the hosts of the combination
+
+    :param host_states: the host_state_tracker of the hosts
+
+    :param key: the key of the combination, see
+     :meth:`vm5k_engine_para.comb_vms_key`
+
+    :param fresh_disks: if True, the disks are all created again, or a
+     function returning True for the VMs whose disk is created again
+
+    :param clean: a function called with the hosts once their VMs are
+     stopped and before the disks are created, e.g. to remount /tmp
+    """
+    plan = host_states.plan(vms, hosts, fresh_disks)
+    host_states.forget(hosts)
+    unknown = plan['unknown']
+    if unknown:
+        destroy_vms(unknown, undefine=True)
+    if len(unknown) < len(hosts):
+        destroy_vms([host for host in hosts if host not in unknown])
+    hosts_cmds = {}
+    for host in hosts:
+        cmds = ['virsh --connect qemu:///system undefine ' + vm_id
+                for vm_id in plan['undefine'].get(host, [])] + \
+            ['rm -f /tmp/' + vm_id + '.qcow2'
+             for vm_id in plan['rm'].get(host, [])]
+        if cmds:
+            hosts_cmds[host] = ' ; '.join(cmds)
+    if hosts_cmds:
+        get_backend().get_remote_cmds(hosts_cmds).run()
+    if clean:
+        clean(hosts)
+    logger.detail('%s VMs kept, %s domains defined, %s disks created',
+                  len(plan['keep']), len(plan['define']), len(plan['disk']))
+    if plan['disk'] and not create_disks(plan['disk']).run().ok:
+        return None
+    if plan['define'] and not install_vms(plan['define']).run().ok:
+        return None
+    host_states.record(vms, hosts, key)
+    return plan
+
 
 class vm5k_engine(Engine):
     """ The base vm5k engine class, that is build from execo_engine.Engine
@@ -151,7 +310,15 @@ class vm5k_engine(Engine):
                 logger.error('There are not enough nodes on %s for your ' + \
                              'experiments, abort ...', self.cluster)
                 exit()
-        jobs_specs = get_jobs_specs({self.cluster: n_nodes},
+        (self.oar_job_id, self.frontend) = self._oarsub(self.cluster, n_nodes,
+                                                        startdate)
+        logger.info('Startdate: %s, n_nodes: %s', format_date(startdate),
+                    str(n_nodes))
+
+    def _oarsub(self, cluster, n_nodes, startdate):
+        """Submit a deploy job of n_nodes of a cluster with 4000 IP and
+        return the tuple (oar_job_id, site)"""
+        jobs_specs = get_jobs_specs({cluster: n_nodes},
                                     name=self.__class__.__name__)
         sub = jobs_specs[0][0]
         tmp = str(sub.resources).replace('\\', '')
@@ -159,9 +326,7 @@ class vm5k_engine(Engine):
         sub.walltime = self.options.walltime
         sub.additional_options = '-t deploy'
         sub.reservation_date = startdate
-        (self.oar_job_id, self.frontend) = oarsub(jobs_specs)[0]
-        logger.info('Startdate: %s, n_nodes: %s', format_date(startdate),
-                    str(n_nodes))
+        return oarsub(jobs_specs)[0]
 
     def get_resources(self):
         """Retrieve the ressources for the vm5k_deployement and define
@@ -172,10 +337,18 @@ class vm5k_engine(Engine):
         self.hosts = self.resources[get_cluster_site(self.cluster)]['hosts']
         self.ip_mac = self.resources[get_cluster_site(self.cluster)]['ip_mac']
 
-    def setup_hosts(self):
-        """Launch the vm5k_deployment """
+    def get_ip_mac_pool(self):
+        """Return a pool of the (ip, mac) of the job, whose allocations are
+        kept in the result directory"""
+        return ip_mac_pool(self.ip_mac,
+                           store=path.join(self.result_dir, 'ip_mac.json'))
+
+    def setup_hosts(self, resources=None):
+        """Launch the vm5k_deployment on the resources of the job, or on
+        other resources, and return the hosts that are set up"""
         logger.info('Initialize vm5k_deployment')
-        setup = vm5k_deployment(resources=self.resources,
+        setup = vm5k_deployment(resources=resources if resources
+                                else self.resources,
                     env_name=self.options.env_name,
                     env_file=self.options.env_file)
         setup.fact = ActionFactory(remote_tool=TAKTUK,
@@ -190,13 +363,182 @@ class vm5k_engine(Engine):
         logger.info('Create backing file')
         backing_files = self.options.backing_files.split(',')
         setup._create_backing_file(disks=backing_files)
+        return setup.hosts
 
 
 class vm5k_engine_para(vm5k_engine):
-    """A engine that use threads to treate combination in parallel
-    """
+    """A engine that use threads to treate combination in parallel. The
+    combinations are run by a ``vm5k.campaign.combination_scheduler``, the
+    most costly first according to ``comb_cost``. A host is preferably given
+    a combination whose VMs have the same ``comb_vms_key`` as those of its
+    previous combination, so that the workflow can keep them with
+    :func:`prepare_vms`."""
     def __init__(self):
         super(vm5k_engine_para, self).__init__()
+        self.options_parser.add_option("--extra-clusters",
+                    dest="extra_clusters",
+                    help="clusters where additional jobs are submitted when " +
+                    "combinations wait for hosts, separated by , " +
+                    "(default to the cluster of the experiment)",
+                    type="string",
+                    default=None)
+        self.options_parser.add_option("--max-extra-jobs",
+                    dest="max_extra_jobs",
+                    help="maximum number of additional jobs, 0 to disable them",
+                    type="int",
+                    default=2)
+        self.watch_interval = 60
+        """The interval in seconds between two checks of the jobs"""
+        self.jobs = {}
+        """A dict whose keys are the OAR job ids and values a dict with the
+        ``site``, ``n_nodes``, ``hosts`` and ``state`` of the job"""
+        self.ip_mac_pools = {}
+        """A dict whose keys are the OAR job ids and values their
+        ip_mac_pool"""
+        self.host_states = host_state_tracker()
+        """The VMs left on the hosts by the previous combinations"""
+        self._watching = Event()
+
+    def comb_cost(self, comb):
+        """Return the cost of a combination, by default its number of
+        VMs"""
+        return self.comb_nvm(comb)
+
+    def comb_vms_key(self, comb):
+        """Return a key that is the same for the combinations having
+        identical VMs, or sharing most of them, e.g. the tuple of the
+        parameters defining them, or None if they share no VM"""
+        return None
+
+    def comb_affinity(self, comb, hosts):
+        """Return 1 if the VMs of the previous combination on the hosts
+        are identical to those of the combination, 0 otherwise"""
+        key = self.comb_vms_key(comb)
+        return int(key is not None and key == self.host_states.key(hosts))
+
+    def _watch_jobs(self):
+        """Remove from the host pool the hosts of the dead jobs, submit
+        additional jobs while combinations wait for hosts and release them
+        once the sweep is drained"""
+        while not self._watching.wait(self.watch_interval):
+            for oar_job_id, job in self.jobs.items():
+                if job['hosts'] and not job['state'].alive():
+                    logger.warning('Job %s is %s, removing its hosts',
+                                   oar_job_id, job['state'].get())
+                    self.host_pool.remove(job['hosts'])
+                    self.host_states.forget(job['hosts'])
+                    job['hosts'] = []
+            remaining = len(self.sweeper.get_remaining())
+            if remaining == 0:
+                self._release_extra_jobs()
+            else:
+                self._extend_jobs(remaining)
+
+    def _extra_jobs(self):
+        # the attaching threads delete jobs while the watcher iterates
+        return [oar_job_id for oar_job_id in list(self.jobs)
+                if oar_job_id != self.oar_job_id]
+
+    def _extend_jobs(self, remaining):
+        """Submit an additional job if the remaining combinations need more
+        hosts than the jobs have"""
+        extra = self._extra_jobs()
+        if len(extra) >= self.options.max_extra_jobs:
+            return
+        jobs = [self.jobs.get(oar_job_id) for oar_job_id in extra]
+        n_hosts = len(self.host_pool.hosts) + \
+            sum(job['n_nodes'] for job in jobs
+                if job and 'attached' not in job)
+        needed = remaining * self.options.n_nodes - n_hosts
+        if needed < self.options.n_nodes:
+            return
+        clusters = self.options.extra_clusters.split(',') \
+            if self.options.extra_clusters else [self.cluster]
+        starttime = int(time.time() + 60)
+        walltime = get_seconds(self.options.walltime)
+        planning = get_planning(elements=clusters, starttime=starttime,
+                                endtime=starttime + 2 * walltime,
+                                out_of_chart=self.options.outofchart)
+        for startdate, _, free in compute_slots(planning,
+                                                self.options.walltime):
+            if startdate > starttime + walltime:
+                break
+            n_free, cluster = max((free.get(cluster, 0), cluster)
+                                  for cluster in clusters)
+            n_nodes = min(needed, self.options.n_nodes *
+                          (n_free // self.options.n_nodes))
+            if n_nodes >= self.options.n_nodes:
+                break
+        else:
+            logger.detail('No slot for %s additional hosts', needed)
+            return
+        if n_nodes < self.options.n_nodes:
+            return
+        oar_job_id, site = self._oarsub(cluster, n_nodes, startdate)
+        if not oar_job_id:
+            return
+        logger.info('Additional job %s of %s %s hosts at %s', oar_job_id,
+                    n_nodes, style.host(cluster), format_date(startdate))
+        self.jobs[oar_job_id] = {'site': site, 'n_nodes': n_nodes,
+                                 'hosts': [],
+                                 'state': oar_job_state(oar_job_id, site)}
+        t = Thread(target=self._attach_job, args=(oar_job_id, ))
+        t.daemon = True
+        t.start()
+
+    def _attach_job(self, oar_job_id):
+        """Wait for the start of an additional job, set up its hosts and
+        give them to the host pool"""
+        job = self.jobs.get(oar_job_id)
+        if job is None:
+            return
+        try:
+            wait_oar_job_start(oar_job_id, job['site'])
+            if oar_job_id not in self.jobs:
+                return
+            resources = get_oar_job_vm5k_resources([(oar_job_id,
+                                                     job['site'])])
+            hosts = resources[job['site']]['hosts']
+            if not self.options.no_hosts_setup:
+                hosts = self.setup_hosts(resources)
+        except BaseException:
+            logger.error('Unable to use the hosts of job %s', oar_job_id,
+                         exc_info=sys.exc_info())
+            self._delete_job(oar_job_id)
+            return
+        if oar_job_id not in self.jobs or self._watching.is_set():
+            return
+        self.ip_mac_pools[oar_job_id] = ip_mac_pool(
+            resources[job['site']]['ip_mac'],
+            store=path.join(self.result_dir, 'ip_mac_%s.json' % (oar_job_id, )))
+        job['hosts'] = list(hosts)
+        job['attached'] = True
+        self.host_pool.add(hosts, oar_job_id)
+        self.scheduler.grow()
+        logger.info('%s hosts of job %s added to the pool', len(hosts),
+                    oar_job_id)
+
+    def _release_extra_jobs(self, wait=True):
+        """Remove the hosts of the additional jobs from the pool and delete
+        the jobs whose hosts are all released, or all of them if not
+        ``wait``"""
+        for oar_job_id in self._extra_jobs():
+            job = self.jobs.get(oar_job_id)
+            if job is None:
+                continue
+            self.host_pool.remove(job['hosts'])
+            if not wait or not self.host_pool.busy(job['hosts']):
+                self._delete_job(oar_job_id)
+
+    def _delete_job(self, oar_job_id):
+        job = self.jobs.pop(oar_job_id, None)
+        if job is None:
+            return
+        if self.options.keep_alive:
+            logger.info('Keeping job %s alive', oar_job_id)
+            return
+        logger.info('Deleting the additional job %s', oar_job_id)
+        oardel([(oar_job_id, job['site'])])
 
     def _get_nodes(self, starttime, endtime):
         """ """
@@ -240,7 +582,6 @@ class vm5k_engine_para(vm5k_engine):
             # You need have a method called define_parameters, that returns a list of parameter dicts
             self.create_paramsweeper()
 
-            job_is_dead = False
             # While they are combinations to treat
             while len(self.sweeper.get_remaining()) > 0:
                 # If no job, we make a reservation and prepare the hosts for the experiments
@@ -254,60 +595,41 @@ class vm5k_engine_para(vm5k_engine):
                 if len(self.hosts) == 0:
                     break
 
-                # Initializing the resources and threads
-                available_hosts = list(self.hosts)
-                available_ip_mac = list(self.ip_mac)
-                threads = {}
-
-                # Checking that the job is running and not in Error
-                while get_oar_job_info(self.oar_job_id, self.frontend)['state'] != 'Error' \
-                    or len(threads.keys()) > 0:
-                    job_is_dead = False
-                    while self.options.n_nodes > len(available_hosts):
-                        tmp_threads = dict(threads)
-                        for t in tmp_threads:
-                            if not t.is_alive():
-                                available_hosts.extend(tmp_threads[t]['hosts'])
-                                available_ip_mac.extend(tmp_threads[t]['ip_mac'])
-                                del threads[t]
-                        sleep(5)
-                        if get_oar_job_info(self.oar_job_id, self.frontend)['state'] == 'Error':
-                            job_is_dead = True
-                            break
-                    if job_is_dead:
-                        break
-
-                    # Getting the next combination
-                    comb = self.sweeper.get_next()
-                    if not comb:
-                        while len(threads.keys()) > 0:
-                            tmp_threads = dict(threads)
-                            for t in tmp_threads:
-                                if not t.is_alive():
-                                    del threads[t]
-                            logger.info('Waiting for threads to complete')
-                            sleep(20)
-                        break
-
-                    used_hosts = available_hosts[0:self.options.n_nodes]
-                    available_hosts = available_hosts[self.options.n_nodes:]
-
-                    n_vm = self.comb_nvm(comb)
-                    used_ip_mac = available_ip_mac[0:n_vm]
-                    available_ip_mac = available_ip_mac[n_vm:]
-
-                    t = Thread(target=self.workflow,
-                               args=(comb, used_hosts, used_ip_mac))
-                    threads[t] = {'hosts': used_hosts, 'ip_mac': used_ip_mac}
-                    logger.debug('Threads: %s', len(threads))
-                    t.daemon = True
-                    t.start()
-
-                if get_oar_job_info(self.oar_job_id, self.frontend)['state'] == 'Error':
-                    job_is_dead = True
-
-                if job_is_dead:
+                # Running the combinations on the hosts of the job and of
+                # the additional jobs
+                job = oar_job_state(self.oar_job_id, self.frontend)
+                self.jobs = {self.oar_job_id: {'site': self.frontend,
+                                               'n_nodes': len(self.hosts),
+                                               'hosts': list(self.hosts),
+                                               'state': job}}
+                self.host_pool = host_pool(self.hosts, self.oar_job_id)
+                self.ip_mac_pools = {self.oar_job_id: self.get_ip_mac_pool()}
+                self.host_states = host_state_tracker()
+                self.scheduler = combination_scheduler(
+                    self.sweeper, self.host_pool, self.workflow,
+                    n_nodes=self.options.n_nodes, cost=self.comb_cost,
+                    ip_mac=self.ip_mac_pools, comb_nvm=self.comb_nvm,
+                    affinity=self.comb_affinity,
+                    prefer_ip_mac=self.host_states.ip_mac)
+                self._watching.clear()
+                watcher = Thread(target=self._watch_jobs)
+                watcher.daemon = True
+                watcher.start()
+                try:
+                    self.scheduler.run()
+                finally:
+                    self._watching.set()
+                    self._release_extra_jobs(wait=False)
+                    for pool in list(self.ip_mac_pools.values()):
+                        pool.flush()
+
+                if not job.alive():
                     self.oar_job_id = None
+                elif self.scheduler.n_done == 0 and \
+                        len(self.sweeper.get_remaining()) > 0:
+                    logger.error('No combination could be done on the '
+                                 'hosts of job %s', self.oar_job_id)
+                    break
 
         finally:
             if self.oar_job_id is not None:
@@ -363,8 +685,10 @@ def get_cpu_topology(cluster, xpdir=None):
     return cpu_topology
 
 
-def boot_vms_by_core(vms):
-    """ """
+def boot_vms_by_core(vms, timeout=600):
+    """Boot the VMs of a host so that only one VM is booting on each
+    cpuset at a time: the next VM of a cpuset is started as soon as the
+    previous one is ready, without waiting for the other cpusets"""
     n_vm = len(vms)
     if n_vm == 0:
         return True
@@ -374,26 +698,35 @@ def boot_vms_by_core(vms):
         host = vms[0]['host'].split('.')[0]
 
     sub_vms = {}
-    for i_core in list(set(vm['cpuset'] for vm in vms)):
-        sub_vms[i_core] = list()
-        for vm in vms:
-            if vm['cpuset'] == i_core:
-                sub_vms[i_core].append(vm)
+    for vm in vms:
+        sub_vms.setdefault(vm['cpuset'], []).append(vm)
+    monitor = vm_readiness_monitor(vms, watch=False)
+    booting = {}
+
+    def _start(vms_to_boot):
+        logger.info(style.Thread(host) + ': Starting VMS ' +
+                    ', '.join([vm['id'] for vm in sorted(vms_to_boot)]))
+        vm_start_scheduler(vms_to_boot, ramp=False).run()
+        monitor.watch(vms_to_boot)
+        for vm in vms_to_boot:
+            booting[vm['id']] = vm['cpuset']
+
+    _start([core_vms.pop(0) for core_vms in sub_vms.itervalues()])
     booted_vms = 0
-    while len(sub_vms.keys()) > 0:
-        vms_to_boot = []
-        for i_core in sub_vms.keys():
-            vms_to_boot.append(sub_vms[i_core][0])
-            sub_vms[i_core].pop(0)
-            if len(sub_vms[i_core]) == 0:
-                del sub_vms[i_core]
-
-        logger.info(style.Thread(host) + ': Starting VMS '+', '.join( [vm['id'] for vm in sorted(vms_to_boot)]))
-        start_vms(vms_to_boot).run()
-        booted = wait_vms_have_started(vms_to_boot)
-        if not booted:
+    while booting:
+        ready = monitor.wait_any(timeout)
+        if not ready:
+            logger.error(style.Thread(host) + ': VMs %s have not booted',
+                         ', '.join(sorted(booting.keys())))
             return False
-        booted_vms += len(vms_to_boot)
-        logger.info(style.Thread(host)+': '+style.emph(str(booted_vms)+'/'+str(n_vm)))
+        booted_vms += len(ready)
+        logger.info(style.Thread(host) + ': ' +
+                    style.emph(str(booted_vms) + '/' + str(n_vm)))
+        next_vms = []
+        for vm_id in ready:
+            core_vms = sub_vms[booting.pop(vm_id)]
+            if core_vms:
+                next_vms.append(core_vms.pop(0))
+        if next_vms:
+            _start(next_vms)
     return True
-
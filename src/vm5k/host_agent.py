@@ -0,0 +1,212 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""The agent run on the hosts by :class:`vm5k.agent.host_agents`. It only
+depends on the python standard library, as it is copied alone on the hosts.
+
+The agent reads one JSON request per line on its standard input::
+
+    {"id": 1, "op": "list", "args": {"all": true}}
+
+and writes one JSON response per line on its standard output::
+
+    {"id": 1, "ok": true, "result": [{"id": "vm-1", "state": "running"}]}
+
+The requests are executed in the order they are received. It can be run
+locally for tests with ``python host_agent.py``.
+"""
+import os
+import sys
+import json
+import errno
+import socket
+import select
+from time import time
+from threading import Thread
+from subprocess import Popen, PIPE, STDOUT
+
+version = 1
+virsh = ['virsh', '--connect', 'qemu:///system']
+domains_dir = '/tmp/vm5k_domains/'
+
+
+def _call(cmd, shell=False):
+    """Run a command and return its exit code and output"""
+    try:
+        p = Popen(cmd, shell=shell, stdout=PIPE, stderr=STDOUT,
+                  close_fds=True)
+    except OSError, e:
+        return 127, str(e)
+    out = p.communicate()[0]
+    return p.returncode, out
+
+
+def op_ping():
+    """Return the version and the pid of the agent"""
+    return {'version': version, 'pid': os.getpid()}
+
+
+def op_run(cmd):
+    """Run a shell command"""
+    code, out = _call(cmd, shell=True)
+    return {'exit_code': code, 'stdout': out}
+
+
+def op_list(all=False):
+    """Return the domains, running ones only unless ``all``"""
+    code, out = _call(virsh + ['list'] + (['--all'] if all else []))
+    if code != 0:
+        raise RuntimeError(out.strip())
+    domains = []
+    for line in out.split('\n')[2:]:
+        fields = line.split(None, 2)
+        if len(fields) == 3:
+            domains.append({'id': fields[1], 'state': fields[2].strip()})
+    return domains
+
+
+def op_define(domains):
+    """Write the XML of the domains and define them, return a dict whose keys
+    are the domains and values the exit code of ``virsh define``"""
+    if not os.path.isdir(domains_dir):
+        os.makedirs(domains_dir)
+    codes = {}
+    for vm_id, xml in domains.iteritems():
+        xml_file = os.path.join(domains_dir, vm_id + '.xml')
+        f = open(xml_file, 'w')
+        f.write(xml)
+        f.close()
+        codes[vm_id] = _call(virsh + ['define', xml_file])[0]
+    return codes
+
+
+def op_start(batches, concurrency=None):
+    """Start the domains of each batch, one batch after the other, by a
+    window of ``concurrency`` domains, default to the whole batch, and
+    return a list of [id, start, end, exit_code]"""
+    results = []
+
+    def _start(vm_ids):
+        while vm_ids:
+            vm_id = vm_ids.pop(0)
+            start = time()
+            code = _call(virsh + ['start', vm_id])[0]
+            results.append([vm_id, start, time(), code])
+
+    for batch in batches:
+        vm_ids = list(batch)
+        threads = [Thread(target=_start, args=(vm_ids, ))
+                   for _ in range(min(len(batch), concurrency or len(batch)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return results
+
+
+def op_destroy(vms=None, undefine=False):
+    """Destroy some domains, default to all, and undefine them if asked.
+    Return a dict whose keys are the domains and values the exit code of the
+    last virsh command."""
+    if vms is None:
+        vms = [domain['id'] for domain in op_list(all=True)]
+    codes = {}
+    for vm_id in vms:
+        code = _call(virsh + ['destroy', vm_id])[0]
+        if undefine:
+            code = _call(virsh + ['undefine', vm_id])[0]
+        codes[vm_id] = code
+    return codes
+
+
+def op_probe(ips, port=22, timeout=2):
+    """Try to connect to a TCP port on some ip at the same time, return a
+    dict whose keys are the ip and values True if the port is open"""
+    results = {}
+    sockets = {}
+    poller = select.poll()
+    for ip in ips:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        err = sock.connect_ex((ip, port))
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sockets[sock.fileno()] = (sock, ip)
+            poller.register(sock, select.POLLOUT | select.POLLERR |
+                            select.POLLHUP)
+        else:
+            results[ip] = err == 0
+            sock.close()
+    deadline = time() + timeout
+    while sockets and time() < deadline:
+        for fd, _ in poller.poll(int((deadline - time()) * 1000) + 1):
+            sock, ip = sockets.pop(fd)
+            poller.unregister(fd)
+            results[ip] = sock.getsockopt(socket.SOL_SOCKET,
+                                          socket.SO_ERROR) == 0
+            sock.close()
+    for sock, ip in sockets.itervalues():
+        results[ip] = False
+        sock.close()
+    return results
+
+
+ops = {'ping': op_ping,
+       'run': op_run,
+       'list': op_list,
+       'define': op_define,
+       'start': op_start,
+       'destroy': op_destroy,
+       'probe': op_probe}
+"""The operations of the agent, whose arguments are the ``args`` of the
+requests"""
+
+
+def handle(request):
+    """Execute a request and return its response"""
+    response = {'id': request.get('id')}
+    try:
+        op = ops[request['op']]
+        args = dict((str(key), value)
+                    for key, value in request.get('args', {}).iteritems())
+        response['result'] = op(**args)
+        response['ok'] = True
+    except Exception, e:
+        response['ok'] = False
+        response['error'] = '%s: %s' % (e.__class__.__name__, e)
+    return response
+
+
+def serve(stdin=sys.stdin, stdout=sys.stdout):
+    """Answer the requests until stdin is closed"""
+    while True:
+        line = stdin.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError, e:
+            response = {'id': None, 'ok': False, 'error': str(e)}
+        else:
+            response = handle(request)
+        stdout.write(json.dumps(response) + '\n')
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,120 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Distribution of the backing files on the hosts, where each host only
+receives the chunks that differ from the copy it already holds"""
+import json
+from os import path, access, makedirs, W_OK
+from execo import logger, SequentialActions
+from execo.log import style
+import chunks
+
+cache_dir = path.expanduser('~/.vm5k/manifests')
+host_script = '/tmp/chunks.py'
+delta_ratio = 0.5
+
+
+def script_file():
+    """Return the path of the script run on the hosts"""
+    return chunks.__file__.replace('.pyc', '.py')
+
+
+def local_manifest(image):
+    """Return the manifest of a frontend image, cached alongside the image or
+    in ``~/.vm5k/manifests`` if its directory is not writable"""
+    manifest_path = chunks.default_manifest_path(image)
+    if not access(path.dirname(path.abspath(image)), W_OK) and \
+            chunks.load_manifest(image, manifest_path) is None:
+        if not path.exists(cache_dir):
+            makedirs(cache_dir)
+        manifest_path = path.join(cache_dir, path.abspath(image).strip('/')
+                                  .replace('/', '_') + '.manifest')
+    return chunks.get_manifest(image, manifest_path)
+
+
+def raw_disk(image):
+    """Return the path of the reference copy of an image on the hosts"""
+    return '/tmp/orig_' + path.basename(image)
+
+
+def hosts_manifests(image, hosts, fact):
+    """Return a dict whose keys are the hosts and values the manifest of their
+    copy of the image, or None if they do not have one. Hosts reuse their
+    cached manifest if the copy has not been modified."""
+    get = fact.get_remote('python ' + host_script + ' manifest ' +
+                          raw_disk(image), hosts)
+    for p in get.processes:
+        p.ignore_exit_code = p.nolog_exit_code = True
+    get.run()
+    manifests = {}
+    for p in get.processes:
+        try:
+            manifests[p.host.address] = json.loads(p.stdout.strip()
+                                                   .split('\n')[-1])
+        except ValueError:
+            manifests[p.host.address] = None
+    return manifests
+
+
+def image_copy(image, hosts, fact, local_dir):
+    """Return the list of actions that bring the copy of an image on the
+    hosts up to date, empty if all hosts already have it.
+
+    Hosts are grouped by the set of chunks they miss. A group that misses
+    more than ``delta_ratio`` of the chunks receives the whole image, the
+    others receive a patch containing only their missing chunks. Patches and
+    the reference manifest are written in ``local_dir``."""
+    name = path.basename(image)
+    reference = local_manifest(image)
+    ref_file = path.join(local_dir, name + '.ref')
+    with open(ref_file, 'w') as f:
+        json.dump(reference, f)
+    groups = {}
+    for host, manifest in hosts_manifests(image, hosts, fact).iteritems():
+        if manifest and manifest['digest'] == reference['digest'] and \
+                manifest['size'] == reference['size']:
+            continue
+        missing = chunks.missing_chunks(reference, manifest)
+        groups.setdefault(tuple(missing), []).append(host)
+    n_chunks = max(1, len(reference['chunks']))
+    actions = []
+    for i, (missing, group) in enumerate(groups.iteritems()):
+        if len(missing) > delta_ratio * n_chunks:
+            logger.detail('Copying %s on %s hosts', style.emph(name),
+                          len(group))
+            put = fact.get_fileput(group, [image, ref_file],
+                                   remote_location='/tmp')
+            finalize = 'mv /tmp/' + name + ' ' + raw_disk(image) + \
+                ' && python ' + host_script + ' adopt ' + raw_disk(image) + \
+                ' ' + chunks.default_manifest_path(raw_disk(image)) + \
+                ' /tmp/' + name + '.ref'
+        else:
+            logger.detail('Sending %s/%s chunks of %s to %s hosts',
+                          len(missing), n_chunks, style.emph(name),
+                          len(group))
+            patch = path.join(local_dir, name + '.' + str(i) + '.patch')
+            chunks.write_patch(image, reference, list(missing), patch)
+            put = fact.get_fileput(group, [patch, ref_file],
+                                   remote_location='/tmp')
+            finalize = 'python ' + host_script + ' apply ' + \
+                raw_disk(image) + ' ' + \
+                chunks.default_manifest_path(raw_disk(image)) + ' /tmp/' + \
+                path.basename(patch) + ' /tmp/' + name + '.ref && rm /tmp/' + \
+                path.basename(patch)
+        actions.append(SequentialActions([put,
+                                          fact.get_remote(finalize, group)]))
+    return actions
@@ -0,0 +1,386 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Lazy (ip, mac) ranges of the KaVLAN networks and an allocator of
+addresses that can be kept between runs"""
+import json
+import errno
+from copy import copy
+from contextlib import contextmanager
+from fcntl import flock, LOCK_EX, LOCK_UN
+from os import path, makedirs, rename, kill, getpid
+from time import time
+from socket import gethostname
+from bisect import bisect_right
+from collections import deque
+from itertools import count
+from threading import Lock
+from execo import logger
+
+
+_pools = count()
+
+
+def ip_to_int(ip):
+    """Return the integer value of a dotted IPv4 address"""
+    a, b, c, d = [int(part) for part in ip.split('.')]
+    return a << 24 | b << 16 | c << 8 | d
+
+
+def int_to_ip(value):
+    """Return the dotted IPv4 address of an integer"""
+    return '%d.%d.%d.%d' % (value >> 24 & 255, value >> 16 & 255,
+                            value >> 8 & 255, value & 255)
+
+
+class ip_range():
+    """The (ip, mac) of a network, computed on demand. The addresses whose
+    last byte is 0, 254 or 255, or whose third byte is lower than ``min_2``
+    are excluded. The MAC of an address is derived from its last three
+    bytes, so that an ip always gets the same MAC.
+
+    The range behaves as a read-only list of (ip, mac) tuples: it has a
+    length, can be indexed, sliced and iterated without building the
+    addresses of the whole network.
+    """
+
+    def __init__(self, network, mask_size, min_2=0,
+                 mac_prefix=(0x00, 0x20, 0x4e)):
+        """:param network: the address of the network, e.g. '10.16.0.0'
+
+        :param mask_size: the size of the network mask
+
+        :param min_2: the lowest third byte of the addresses
+
+        :param mac_prefix: the first three bytes of the MAC addresses
+        """
+        self.network = network
+        self.mask_size = int(mask_size)
+        self.min_2 = min_2
+        self.mac_prefix = ':'.join('%02x' % (byte, ) for byte in mac_prefix)
+        mask = ~(2 ** (32 - self.mask_size) - 1) & 0xffffffff
+        first = ip_to_int(network) & mask
+        last = first | ~mask & 0xffffffff
+        self._firsts = []
+        self._offsets = []
+        size = 0
+        for block in xrange(first & ~255, last + 1, 256):
+            if block >> 8 & 255 < min_2:
+                continue
+            low, high = max(block + 1, first), min(block + 253, last)
+            if low <= high:
+                self._firsts.append(low)
+                self._offsets.append(size)
+                size += high - low + 1
+        self._size = size
+        self._start = 0
+        self._stop = size
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __iter__(self):
+        i = 0
+        k = bisect_right(self._offsets, self._start) - 1
+        while k < len(self._firsts) and i < len(self):
+            value = self._firsts[k] + self._start + i - self._offsets[k]
+            end = self._offsets[k + 1] if k + 1 < len(self._offsets) \
+                else self._size
+            while self._start + i < end and i < len(self):
+                yield self._address(value)
+                value += 1
+                i += 1
+            k += 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in xrange(start, stop, step)]
+            sub = copy(self)
+            sub._start = self._start + start
+            sub._stop = self._start + max(start, stop)
+            return sub
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('ip_range index out of range')
+        i = self._start + key
+        k = bisect_right(self._offsets, i) - 1
+        return self._address(self._firsts[k] + i - self._offsets[k])
+
+    def index(self, ip):
+        """Return the index of an ip in the range"""
+        value = ip_to_int(ip)
+        k = bisect_right(self._firsts, value) - 1
+        if k >= 0:
+            i = self._offsets[k] + value - self._firsts[k]
+            end = self._offsets[k + 1] if k + 1 < len(self._offsets) \
+                else self._size
+            if i < end and self._start <= i < self._stop:
+                return i - self._start
+        raise ValueError('%s is not in the range' % (ip, ))
+
+    def mac(self, ip):
+        """Return the MAC address given to an ip"""
+        value = ip_to_int(ip)
+        return '%s:%02x:%02x:%02x' % (self.mac_prefix, value >> 16 & 255,
+                                      value >> 8 & 255, value & 255)
+
+    def _address(self, value):
+        ip = int_to_ip(value)
+        return ip, self.mac(ip)
+
+
+class ip_mac_pool():
+    """Allocate (ip, mac) from a list or an ip_range. Allocating and
+    releasing an address take a constant time, and the released addresses
+    are given again before new ones. The allocated addresses can be kept in
+    a JSON file, so that another run does not give the addresses still in
+    use. The file is written at most every ``save_delay`` seconds, and by
+    flush().
+
+    The file records the allocations of each pool, by host and pid. It is
+    read again and merged under a lock before each write, so that several
+    runs can share it. When the pool is opened with ``reclaim``, the
+    addresses of the runs of this machine that have ended, e.g. a crashed
+    run, are free again.
+    """
+
+    def __init__(self, addresses, store=None, save_delay=5, reclaim=True):
+        """:param addresses: a list of (ip, mac) or an ip_range
+
+        :param store: a JSON file where the allocated addresses are kept
+
+        :param save_delay: the minimum time in seconds between two writes of
+         the store
+
+        :param reclaim: free the addresses of the store whose run has ended
+        """
+        self.addresses = addresses
+        self.store = store
+        self.save_delay = save_delay
+        self.reclaim = reclaim
+        self._lock = Lock()
+        self._next = 0
+        self._free = deque()
+        self._free_set = set()
+        self._used = set()
+        self._others = set()
+        self._owner = '%s:%s:%s' % (gethostname(), getpid(), next(_pools))
+        self._mtime = None
+        self._indexes = None
+        self._changed = False
+        self._save_date = 0
+        if store:
+            self._load()
+
+    def allocate(self, n=1, prefer=None):
+        """Return a list of n (ip, mac), or less if the pool is exhausted.
+        The free addresses of ``prefer``, a list of (ip, mac), are given
+        first and in their order, e.g. to give back their addresses to VMs
+        that are kept between two runs."""
+        ip_mac = []
+        with self._lock:
+            if self.store:
+                self._refresh()
+            for ip, _ in prefer if prefer else []:
+                if len(ip_mac) == n:
+                    break
+                i = self._index(ip)
+                if i is None or i in self._used:
+                    continue
+                # the index stays in the deque and is skipped when popped
+                self._free_set.discard(i)
+                self._used.add(i)
+                ip_mac.append(tuple(self.addresses[i]))
+            while len(ip_mac) < n:
+                if self._free:
+                    i = self._free.popleft()
+                    if i not in self._free_set:
+                        continue
+                    self._free_set.remove(i)
+                elif self._next < len(self.addresses):
+                    i = self._next
+                    self._next += 1
+                    if i in self._used or i in self._free_set:
+                        continue
+                else:
+                    logger.warning('Only %s free addresses, %s requested',
+                                   len(ip_mac), n)
+                    break
+                self._used.add(i)
+                ip_mac.append(tuple(self.addresses[i]))
+            self._save(bool(ip_mac))
+        return ip_mac
+
+    def release(self, ip_mac):
+        """Give back a list of (ip, mac) to the pool"""
+        with self._lock:
+            for ip, _ in ip_mac:
+                i = self._index(ip)
+                if i is not None and i in self._used:
+                    self._used.remove(i)
+                    self._others.discard(i)
+                    self._free.append(i)
+                    self._free_set.add(i)
+            self._save(bool(ip_mac))
+
+    def flush(self):
+        """Write the allocated addresses in the store if they have changed
+        since the last write"""
+        with self._lock:
+            if self._changed:
+                self._write()
+
+    def n_free(self):
+        """Return the number of addresses that can be allocated"""
+        return len(self.addresses) - len(self._used)
+
+    def allocated(self):
+        """Return the list of the allocated (ip, mac)"""
+        return [tuple(self.addresses[i]) for i in sorted(self._used)]
+
+    def _index(self, ip):
+        if isinstance(self.addresses, ip_range):
+            try:
+                return self.addresses.index(ip)
+            except ValueError:
+                return None
+        if self._indexes is None:
+            self._indexes = {address[0]: i
+                             for i, address in enumerate(self.addresses)}
+        return self._indexes.get(ip)
+
+    def _load(self):
+        if not path.exists(self.store):
+            return
+        self._refresh()
+        logger.detail('%s addresses allocated by other runs in %s',
+                      len(self._others), self.store)
+
+    def _refresh(self):
+        """Merge the allocations of the other pools if the store has changed
+        since it was last read or written"""
+        try:
+            if not path.exists(self.store) or \
+                    path.getmtime(self.store) == self._mtime:
+                return
+            with _locked(self.store):
+                self._merge(self._read())
+                self._mtime = path.getmtime(self.store)
+        except (IOError, OSError):
+            logger.warning('Unable to read the allocated addresses %s',
+                           self.store)
+
+    def _read(self):
+        """Return a dict whose keys are the pools of the store and values
+        their allocated (ip, mac)"""
+        if not path.exists(self.store):
+            return {}
+        try:
+            with open(self.store) as f:
+                return json.load(f)['owners']
+        except (ValueError, KeyError):
+            logger.warning('Unable to read the allocated addresses %s',
+                           self.store)
+            return {}
+
+    def _merge(self, owners):
+        """Mark as used the addresses of the other pools of the store, free
+        those they have released and return the pools that are kept"""
+        mine = self._used - self._others
+        kept = {}
+        others = set()
+        for owner, allocated in owners.iteritems():
+            if owner == self._owner:
+                continue
+            host, pid, _ = owner.rsplit(':', 2)
+            if self.reclaim and host == gethostname() and \
+                    not _running(int(pid)):
+                logger.info('Reclaiming %s addresses of the ended run %s in '
+                            '%s', len(allocated), pid, self.store)
+                self._changed = True
+                continue
+            kept[owner] = allocated
+            for ip, _ in allocated:
+                i = self._index(ip)
+                if i is not None:
+                    others.add(i)
+        conflicts = others & mine
+        if conflicts:
+            logger.warning('%s addresses allocated by several runs in %s',
+                           len(conflicts), self.store)
+        others -= mine
+        for i in self._others - others:
+            self._used.discard(i)
+            self._free.append(i)
+            self._free_set.add(i)
+        for i in others - self._others:
+            self._free_set.discard(i)
+            self._used.add(i)
+        self._others = others
+        return kept
+
+    def _save(self, changed=True):
+        self._changed = self._changed or changed
+        if self.store and self._changed and \
+                time() - self._save_date >= self.save_delay:
+            self._write()
+
+    def _write(self):
+        if not self.store:
+            return
+        self._changed = False
+        self._save_date = time()
+        try:
+            if path.dirname(self.store) and \
+                    not path.exists(path.dirname(self.store)):
+                makedirs(path.dirname(self.store))
+            with _locked(self.store):
+                owners = self._merge(self._read())
+                mine = self._used - self._others
+                if mine:
+                    owners[self._owner] = [tuple(self.addresses[i])
+                                        for i in sorted(mine)]
+                with open(self.store + '.tmp', 'w') as f:
+                    json.dump({'owners': owners}, f)
+                rename(self.store + '.tmp', self.store)
+                self._mtime = path.getmtime(self.store)
+        except (IOError, OSError):
+            logger.warning('Unable to write the allocated addresses %s',
+                           self.store)
+
+
+@contextmanager
+def _locked(store):
+    """Hold an exclusive lock on a store shared by several runs"""
+    with open(store + '.lock', 'a') as f:
+        flock(f, LOCK_EX)
+        try:
+            yield
+        finally:
+            flock(f, LOCK_UN)
+
+
+def _running(pid):
+    """Return True if a process of this machine is running"""
+    try:
+        kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
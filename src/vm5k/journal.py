@@ -0,0 +1,204 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""A journal of the stages completed by the hosts and the VMs of a
+deployment, so that a deployment that stopped can be resumed"""
+import os
+import json
+from os import path
+from time import time
+from threading import Lock
+from execo import logger, Host
+from execo.log import style
+from vmtable import vms_column
+
+host_stages = ['deployed', 'packages', 'bridge', 'libvirt', 'backing']
+"""The stages of the hosts, in their order"""
+
+vm_stages = ['placed', 'disk', 'defined', 'started', 'ready']
+"""The stages of the VMs, in their order"""
+
+
+class deployment_journal():
+    """Record in a file the stages completed by the hosts and the VMs. Each
+    line of the file is a JSON record, appended and synced when a stage ends
+    on a group of hosts or VMs, so that the journal survives a crash of
+    vm5k. Nothing is recorded while the directory of the journal does not
+    exist.
+
+    When a journal is resumed, the stages it contains are the work that
+    does not need to be done again. A VM stage is only done if it was
+    completed on the host where the VM is placed now. The records of the
+    current run are appended to the same file, but are not seen as done
+    work until the journal is resumed again.
+    """
+
+    def __init__(self, journal_file, resume=False):
+        """:param journal_file: the path of the journal
+
+        :param resume: if True, read the journal and append to it, otherwise
+         begin a new journal
+        """
+        self.journal_file = journal_file
+        self.resumed = False
+        self.run = {}
+        """The information given to :meth:`record_run`"""
+        self.placement = {}
+        """A dict whose keys are the VM ids and values a dict with the
+        ``host``, ``ip`` and ``mac`` they had in the journal"""
+        self.ko_hosts = set()
+        """The hosts that were KO in the journal"""
+        self._hosts = {}
+        self._vms = {}
+        self._lock = Lock()
+        if resume and path.exists(journal_file):
+            self._load()
+            self.resumed = True
+        elif path.exists(journal_file):
+            os.remove(journal_file)
+
+    def record_run(self, **info):
+        """Record some information on the run, e.g. the command line options
+        and the jobs, that is available in :attr:`run` once resumed"""
+        self._write([{'stage': 'run', 'info': info}])
+
+    def record_hosts(self, stage, hosts):
+        """Record that some hosts have completed a stage"""
+        hosts = [_address(host) for host in hosts if host]
+        if hosts:
+            self._write([{'stage': stage, 'hosts': hosts}])
+
+    def record_ko(self, hosts):
+        """Record that some hosts are KO"""
+        self.record_hosts('ko', hosts)
+
+    def record_vms(self, stage, vms):
+        """Record that some VMs have completed a stage on their host. With
+        ``placed``, their ip and mac are recorded too."""
+        ids, hosts = vms_column(vms, 'id'), vms_column(vms, 'host')
+        if stage == 'placed':
+            rows = zip(ids, hosts, vms_column(vms, 'ip'),
+                       vms_column(vms, 'mac'))
+        else:
+            rows = zip(ids, hosts)
+        if rows:
+            self._write([{'stage': stage, 'vms': rows}])
+
+    def hosts_done(self, stage, hosts):
+        """Return the hosts that had completed a stage"""
+        return [host for host in hosts
+                if stage in self._hosts.get(_address(host), ())]
+
+    def hosts_todo(self, stage, hosts):
+        """Return the hosts that had not completed a stage"""
+        return [host for host in hosts
+                if stage not in self._hosts.get(_address(host), ())]
+
+    def vms_done(self, stage, vms):
+        """Return the VMs that had completed a stage on their current
+        host"""
+        done = []
+        for vm_id, host, vm in zip(vms_column(vms, 'id'),
+                                   vms_column(vms, 'host'), vms):
+            if self._vms.get(vm_id, {}).get(stage) == host:
+                done.append(vm)
+        return done
+
+    def vms_todo(self, stage, vms):
+        """Return the VMs that had not completed a stage on their current
+        host"""
+        todo = []
+        for vm_id, host, vm in zip(vms_column(vms, 'id'),
+                                   vms_column(vms, 'host'), vms):
+            if self._vms.get(vm_id, {}).get(stage) != host:
+                todo.append(vm)
+        return todo
+
+    def _load(self):
+        n_records = 0
+        end = 0
+        with open(self.journal_file) as f:
+            for line in f:
+                if line.endswith('\n'):
+                    end += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning('Ignoring a truncated record of %s',
+                                   self.journal_file)
+                    continue
+                n_records += 1
+                stage = record['stage']
+                if stage == 'run':
+                    self.run.update(record['info'])
+                elif stage == 'ko':
+                    self.ko_hosts.update(record['hosts'])
+                elif 'hosts' in record:
+                    for host in record['hosts']:
+                        self._hosts.setdefault(host, set()).add(stage)
+                        if stage == 'deployed':
+                            self.ko_hosts.discard(host)
+                elif stage == 'placed':
+                    for vm_id, host, ip, mac in record['vms']:
+                        self.placement[vm_id] = {'host': host, 'ip': ip,
+                                                 'mac': mac}
+                else:
+                    for vm_id, host in record['vms']:
+                        self._vms.setdefault(vm_id, {})[stage] = host
+        if end < path.getsize(self.journal_file):
+            # the records of this run must not be appended to the last line
+            with open(self.journal_file, 'r+') as f:
+                f.truncate(end)
+        logger.info('Resuming from %s: %s hosts deployed, %s VMs ready',
+                    style.emph(self.journal_file),
+                    sum(1 for stages in self._hosts.itervalues()
+                        if 'deployed' in stages),
+                    sum(1 for stages in self._vms.itervalues()
+                        if 'ready' in stages))
+        logger.debug('%s records read', n_records)
+
+    def _write(self, records):
+        for record in records:
+            record['date'] = time()
+        with self._lock:
+            directory = path.dirname(self.journal_file)
+            if directory and not path.isdir(directory):
+                return
+            with open(self.journal_file, 'a') as f:
+                f.write(''.join(json.dumps(record) + '\n'
+                                for record in records))
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def journal_run(journal_file):
+    """Return the information on the run recorded in a journal, without
+    reading its stages"""
+    run = {}
+    with open(journal_file) as f:
+        for line in f:
+            if '"stage": "run"' not in line:
+                continue
+            try:
+                run.update(json.loads(line)['info'])
+            except ValueError:
+                pass
+    return run
+
+
+def _address(host):
+    return host.address if isinstance(host, Host) else host
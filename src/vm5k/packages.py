@@ -0,0 +1,116 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""The packages installed on the hosts. A :class:`package_plan` merges
+packages into one APT transaction, so that a host resolves their
+dependencies once. The base packages are installed first without their
+recommended packages, so that the copy of the backing files can begin while
+libvirt and the extra packages are installed from the package lists already
+updated::
+
+    base = package_plan(upgrade=True, recommends=False).add(base_packages)
+    get_backend().get_remote(base.command(), hosts).run()
+    plan = package_plan().add(libvirt_packages, libvirt_release)
+    plan.add('iperf,htop')
+    get_backend().get_remote(plan.command(update=False), hosts).run()
+
+A directory of .deb files, e.g. filled on a deployed host with
+``plan.command(download_only=True)`` and copied back to the frontend, can be
+put in the APT cache of the hosts before running the plan, so that the
+packages come from the frontend instead of the Debian mirror.
+"""
+from os import listdir, path
+from collections import OrderedDict
+
+base_packages = ['uuid-runtime', 'bash-completion', 'taktuk', 'locate',
+                 'htop', 'init-system-helpers', 'netcat-traditional']
+"""The packages required for the disks copy"""
+
+libvirt_packages = ['libvirt-bin', 'virtinst', 'python2.7', 'python-pycurl',
+                    'python-libxml2', 'qemu-kvm', 'nmap', 'libgmp10']
+"""The packages of libvirt and KVM"""
+
+libvirt_release = 'wheezy-backports'
+"""The release from which the libvirt packages are installed"""
+
+apt_archives = '/var/cache/apt/archives/'
+"""The APT cache of the hosts, where the .deb bundle is copied"""
+
+
+class package_plan():
+    """The packages to install on the hosts with their target release,
+    installed by a single ``apt-get`` transaction"""
+
+    def __init__(self, upgrade=False, recommends=True):
+        """:param upgrade: if True, the transaction begins with a
+         dist-upgrade
+
+        :param recommends: if False, the recommended packages are not
+         installed"""
+        self.upgrade = upgrade
+        self.recommends = recommends
+        self.packages = OrderedDict()
+        """A dict whose keys are the packages and values their target
+        release, or None for the default one"""
+
+    def add(self, packages, release=None):
+        """Add some packages, given as a list or as a string separated by
+        spaces or commas. A package added with a release keeps it."""
+        if isinstance(packages, basestring):
+            packages = packages.replace(',', ' ').split()
+        for package in packages:
+            if release or package not in self.packages:
+                self.packages[package] = release
+        return self
+
+    def targets(self):
+        """Return the arguments of ``apt-get install``"""
+        return [package + '/' + release if release else package
+                for package, release in self.packages.iteritems()]
+
+    def command(self, download_only=False, update=True):
+        """Return the shell command that updates the package lists and
+        installs the packages. With ``download_only``, the packages are only
+        put in the APT cache. Without ``update``, the package lists of a
+        previous transaction are used."""
+        options = '-y --force-yes -o Dpkg::Options::="--force-confdef" ' + \
+            '-o Dpkg::Options::="--force-confold" '
+        if download_only:
+            options += '--download-only '
+        steps = ['apt-get update'] if update else []
+        if self.upgrade:
+            steps.append('apt-get dist-upgrade ' + options)
+        if self.packages:
+            steps.append('apt-get install ' + options +
+                         ('' if self.recommends
+                          else '--no-install-recommends ') +
+                         ' '.join(self.targets()))
+        return "echo 'debconf debconf/frontend select noninteractive' | " + \
+            "debconf-set-selections ; " + \
+            "echo 'debconf debconf/priority select critical' | " + \
+            "debconf-set-selections ; " + \
+            "export DEBIAN_FRONTEND=noninteractive ; " + \
+            (' && '.join(steps) if steps else 'true')
+
+
+def deb_files(deb_bundle):
+    """Return the .deb files of a directory, or an empty list if it does
+    not exist"""
+    if not deb_bundle or not path.isdir(deb_bundle):
+        return []
+    return sorted(path.join(deb_bundle, f) for f in listdir(deb_bundle)
+                  if f.endswith('.deb'))
@@ -0,0 +1,245 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Execution of a graph of deployment stages, where each host goes through
+the stages independently of the others"""
+import sys
+from multiprocessing import cpu_count
+from time import time
+from threading import Thread, Condition
+from execo import logger
+from execo.log import style
+from tracing import tracer
+
+
+default_max_workers = max(8, 2 * cpu_count())
+"""The default maximum number of stages running at the same time, each of
+them opening its own connections from the frontend"""
+
+
+class pipeline_stage():
+    """A stage of a host_pipeline"""
+
+    def __init__(self, name, func, after=None, barrier=False, wave_delay=0):
+        """:param name: the name of the stage
+
+        :param func: a function taking a list of hosts
+
+        :param after: the names of the stages that must be finished on a host
+         before this stage begins on it
+
+        :param barrier: if True, the stage runs once for all hosts, when all
+         of them have finished the ``after`` stages
+
+        :param wave_delay: the number of seconds the first ready host of a
+         wave waits for other hosts to join it, while some hosts have not
+         finished the ``after`` stages
+        """
+        self.name = name
+        self.func = func
+        self.after = after if after else []
+        self.barrier = barrier
+        self.wave_delay = wave_delay
+
+
+class host_pipeline():
+    """Run a graph of stages on a list of hosts. A host begins a stage as
+    soon as it has finished the stages it depends on, so fast hosts go on
+    while slow ones are still in the previous stages. The hosts that are
+    ready for a stage at the same time run it together in a wave, with one
+    call of the stage function, and barrier stages wait for all the hosts.
+
+    A host fails when it is no longer returned by ``check`` after a stage,
+    and then goes through no other stage. The start and end dates of every
+    stage on every host are recorded in ``timings``.
+    """
+
+    def __init__(self, hosts, stages, check=None, max_workers=None):
+        """:param hosts: the list of hosts
+
+        :param stages: the list of pipeline_stage, in a topological order
+
+        :param check: a function that returns the hosts still usable among a
+         list of hosts
+
+        :param max_workers: the maximum number of stages running at the same
+         time, default to ``default_max_workers``
+        """
+        self.hosts = list(hosts)
+        self.stages = stages
+        self._stages = {stage.name: stage for stage in stages}
+        self._rank = {stage.name: i for i, stage in enumerate(stages)}
+        self.check = check if check else lambda hosts: hosts
+        self.max_workers = max_workers if max_workers \
+            else default_max_workers
+        self.failed = set()
+        """The hosts that have failed a stage"""
+        self.timings = {stage.name: {} for stage in stages}
+        """A dict whose keys are the stages and values a dict whose keys
+        are the hosts and values the (start, end) dates of the stage"""
+        self._done = {stage.name: set() for stage in stages}
+        self._started = {stage.name: set() for stage in stages}
+        self._ready_since = {stage.name: {} for stage in stages}
+        self._wake = None
+        self._cond = Condition()
+        self._running = 0
+        self._error = None
+        self._span = None
+
+    def run(self):
+        """Run the stages on all hosts and return the pipeline"""
+        self.start_date = time()
+        with tracer.span('pipeline', hosts=self.hosts) as span:
+            self._span = span
+            with self._cond:
+                while True:
+                    if self._error is None:
+                        self._launch_ready()
+                    else:
+                        self._wake = None
+                    if self._running == 0 and self._wake is None:
+                        break
+                    self._cond.wait(self._wake - time() if self._wake
+                                    else None)
+        self.end_date = time()
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self
+
+    def alive(self):
+        """Return the hosts that have not failed"""
+        return [host for host in self.hosts if host not in self.failed]
+
+    def critical_path(self):
+        """Return the chain of (stage, host, start, end) that determined
+        the end of the pipeline"""
+        ends = [(timing[1], name, host)
+                for name, timings in self.timings.iteritems()
+                for host, timing in timings.iteritems()]
+        if not ends:
+            return []
+        _, name, host = max(ends)
+        path = []
+        while name:
+            start, end = self.timings[name][host]
+            path.append((name, host if not self._stages[name].barrier
+                         else None, start, end))
+            previous = [(self.timings[dep][h][1], dep, h)
+                        for dep in self._stages[name].after
+                        for h in ([host] if not self._stages[dep].barrier
+                                  and not self._stages[name].barrier
+                                  else self.timings[dep].keys())
+                        if h in self.timings[dep]]
+            name = None
+            if previous:
+                _, name, host = max(previous)
+        path.reverse()
+        return path
+
+    def report(self):
+        """Return a dict with the duration of the pipeline, the timings of
+        the stages by host, the failed hosts and the critical path"""
+        hosts_timings = {}
+        for name, timings in self.timings.iteritems():
+            for host, (start, end) in timings.iteritems():
+                hosts_timings.setdefault(host, {})[name] = \
+                    {'start': start - self.start_date,
+                     'duration': end - start}
+        return {'duration': self.end_date - self.start_date,
+                'hosts': hosts_timings,
+                'failed': sorted(self.failed),
+                'critical_path': [{'stage': name, 'host': host,
+                                   'start': start - self.start_date,
+                                   'duration': end - start}
+                                  for name, host, start, end
+                                  in self.critical_path()]}
+
+    def log_report(self):
+        """Log the critical path of the pipeline"""
+        log = ''
+        for name, host, start, end in self.critical_path():
+            log += '\n' + style.emph(name.ljust(12)) + \
+                (style.host(host.split('.')[0]) if host else 'all hosts') + \
+                ' %.1fs' % (end - start, )
+        logger.info('Pipeline executed in %.1fs, critical path:%s',
+                    self.end_date - self.start_date, log)
+
+    def _ready(self, stage, host):
+        return all(host in self._done[dep] for dep in stage.after)
+
+    def _launch_ready(self):
+        alive = self.alive()
+        now = time()
+        self._wake = None
+        for stage in sorted(self.stages, key=lambda s: -self._rank[s.name]):
+            if stage.barrier:
+                if self._started[stage.name] or not alive or \
+                        not all(self._ready(stage, host) for host in alive):
+                    continue
+                wave = alive
+            else:
+                todo = [host for host in alive
+                        if host not in self._started[stage.name]]
+                wave = [host for host in todo if self._ready(stage, host)]
+                if not wave:
+                    continue
+                since = self._ready_since[stage.name]
+                for host in wave:
+                    since.setdefault(host, now)
+                wake = min(since[host] for host in wave) + stage.wave_delay
+                if len(wave) < len(todo) and wake > now:
+                    self._wake = min(self._wake, wake) if self._wake \
+                        else wake
+                    continue
+            if not self._launch(stage, wave):
+                return
+
+    def _launch(self, stage, hosts):
+        if self._running >= self.max_workers:
+            return False
+        self._running += 1
+        self._started[stage.name].update(hosts)
+        t = Thread(target=self._run_stage, args=(stage, hosts))
+        t.daemon = True
+        t.start()
+        return True
+
+    def _run_stage(self, stage, hosts):
+        logger.detail('%s on %s', style.emph(stage.name),
+                      ', '.join(host.split('.')[0] for host in hosts)
+                      if not stage.barrier else 'all hosts')
+        start = time()
+        error = None
+        with tracer.span(stage.name, hosts=hosts, parent=self._span):
+            try:
+                stage.func(hosts)
+                ok = set(self.check(hosts))
+            except BaseException:
+                error = sys.exc_info()
+        end = time()
+        with self._cond:
+            self._running -= 1
+            if error:
+                self._error = self._error or error
+            else:
+                for host in hosts:
+                    self.timings[stage.name][host] = (start, end)
+                    if host in ok:
+                        self._done[stage.name].add(host)
+                    else:
+                        self.failed.add(host)
+            self._cond.notify()
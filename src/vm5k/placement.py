@@ -0,0 +1,336 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""A placement engine that distributes the virtual machines on the hosts
+according to their remaining RAM and CPU"""
+import sys
+import heapq
+from bisect import bisect_left, insort
+from collections import deque
+from math import ceil
+from random import randrange
+from execo import logger, Host
+from execo.log import style
+from utils import get_CPU_RAM_FLOPS
+from vmtable import VMTable, vms_column
+
+placement_modes = ['round-robin', 'concentrated', 'random',
+                   'first-fit-decreasing', 'best-fit', 'balanced']
+
+
+def vm_cpu(vm):
+    """Return the number of host cores consumed by a VM, a core being
+    shared by 3 virtual CPU"""
+    return vm['n_cpu'] / 3
+
+
+class placement_engine():
+    """Keep the remaining RAM and CPU of a list of hosts and place
+    virtual machines on them.
+
+    Available modes are:
+
+    - ``round-robin``: cycle around the hosts
+    - ``concentrated``: fill a host before using the next one
+    - ``random``: pick a random host for each VM
+    - ``first-fit-decreasing``: biggest VMs first, on the first host that fits
+    - ``best-fit``: use the host with the least remaining RAM that fits
+    - ``balanced``: use the host with the most remaining RAM
+    """
+
+    def __init__(self, hosts, mode='round-robin', hosts_attr=None):
+        """:param hosts: a list of hosts
+
+        :param mode: the placement mode, one of ``placement_modes``
+
+        :param hosts_attr: a dict similar to the one returned by
+         ``get_CPU_RAM_FLOPS``, retrieved from the API if not given
+        """
+        if mode not in placement_modes:
+            raise ValueError('Unknown placement mode ' + str(mode))
+        self.mode = mode
+        self.hosts = [host.address if isinstance(host, Host) else host
+                      for host in hosts]
+        if hosts_attr is None:
+            hosts_attr = get_CPU_RAM_FLOPS(self.hosts)
+        self.ram = [hosts_attr[host]['RAM'] for host in self.hosts]
+        self.cpu = [hosts_attr[host]['CPU'] for host in self.hosts]
+        self.host_ram = list(self.ram)
+        self.host_cpu = list(self.cpu)
+        self.total = {'RAM': sum(self.ram), 'CPU': sum(self.cpu)}
+        self._index = {host: i for i, host in enumerate(self.hosts)}
+
+    def remaining(self, host):
+        """Return a dict with the remaining RAM and CPU of a host"""
+        i = self._index[host]
+        return {'RAM': self.ram[i], 'CPU': self.cpu[i]}
+
+    def reserve(self, host, vm):
+        """Remove the resources of a VM from a host"""
+        i = self._index[host]
+        self.ram[i] -= vm['mem']
+        self.cpu[i] -= vm_cpu(vm)
+
+    def release(self, host, vm):
+        """Give back the resources of a VM to a host"""
+        i = self._index[host]
+        self.ram[i] += vm['mem']
+        self.cpu[i] += vm_cpu(vm)
+
+    def remove_host(self, host):
+        """Remove a host from the placement, its VMs must be placed again"""
+        i = self._index.pop(host, None)
+        if i is not None:
+            self.ram[i] = self.cpu[i] = 0
+            self.total['RAM'] -= self.host_ram[i]
+            self.total['CPU'] -= self.host_cpu[i]
+
+    def has_host(self, host):
+        """Return True if a host is in the placement"""
+        return host in self._index
+
+    def place(self, vms):
+        """Set the host of the VMs and return a placement report, which
+        ``feasible`` key is False if some VMs could not be placed.
+        """
+        sizes = _vms_sizes(vms)
+        placed = {}
+        unplaced = getattr(self, '_place_' + self.mode.replace('-', '_'))(
+            vms, sizes, placed)
+        hosts = {k: self.hosts[i] for k, i in placed.iteritems()}
+        if isinstance(vms, VMTable):
+            vms.set_column('host', hosts)
+        else:
+            for k, host in hosts.iteritems():
+                vms[k]['host'] = host
+        return self._report(vms, sizes, unplaced)
+
+    def _fits(self, i, mem, cpu):
+        return self.ram[i] - mem > 0 and self.cpu[i] - cpu > 0
+
+    def _full(self, i, smallest):
+        """Return True if a host cannot take even the smallest VM"""
+        return not self._fits(i, *smallest)
+
+    def _assign(self, placed, k, i, mem, cpu):
+        placed[k] = i
+        self.ram[i] -= mem
+        self.cpu[i] -= cpu
+
+    def _active_hosts(self):
+        return [i for i in range(len(self.hosts))
+                if self.hosts[i] in self._index]
+
+    def _place_cycle(self, sizes, placed, rotate):
+        """Walk the hosts in order and drop the ones that cannot sustain the
+        current VM, as the historical distribution did"""
+        active = deque(self._active_hosts())
+        unplaced = []
+        for k, (mem, cpu) in enumerate(sizes):
+            while active and not self._fits(active[0], mem, cpu):
+                active.popleft()
+            if not active:
+                unplaced.append(k)
+                continue
+            self._assign(placed, k, active[0], mem, cpu)
+            if rotate:
+                active.rotate(-1)
+        return unplaced
+
+    def _place_round_robin(self, vms, sizes, placed):
+        return self._place_cycle(sizes, placed, True)
+
+    def _place_concentrated(self, vms, sizes, placed):
+        return self._place_cycle(sizes, placed, False)
+
+    def _place_random(self, vms, sizes, placed):
+        active = self._active_hosts()
+        unplaced = []
+        for k, (mem, cpu) in enumerate(sizes):
+            while active:
+                j = randrange(len(active))
+                if self._fits(active[j], mem, cpu):
+                    self._assign(placed, k, active[j], mem, cpu)
+                    break
+                active[j] = active[-1]
+                active.pop()
+            else:
+                unplaced.append(k)
+        return unplaced
+
+    def _place_first_fit_decreasing(self, vms, sizes, placed):
+        """VMs are sorted by decreasing size, so for a given size the first
+        host that fits never moves backward"""
+        active = self._active_hosts()
+        unplaced = []
+        size, first = None, 0
+        keys = zip(vms_column(vms, 'mem'), vms_column(vms, 'n_cpu'))
+        for k in sorted(range(len(sizes)), key=keys.__getitem__,
+                        reverse=True):
+            mem, cpu = sizes[k]
+            if (mem, cpu) != size:
+                size, first = (mem, cpu), 0
+            while first < len(active) and \
+                    not self._fits(active[first], mem, cpu):
+                first += 1
+            if first == len(active):
+                unplaced.append(k)
+            else:
+                self._assign(placed, k, active[first], mem, cpu)
+        return unplaced
+
+    def _place_best_fit(self, vms, sizes, placed):
+        """Hosts are kept sorted by remaining RAM, and leave the list as soon
+        as they cannot take the smallest VM, so that the hosts whose CPU is
+        used up are not walked over again"""
+        n_hosts = len(self.hosts)
+        smallest = _smallest(sizes)
+        by_ram = sorted((self.ram[i], i) for i in self._active_hosts()
+                        if not self._full(i, smallest))
+        unplaced = []
+        failed = _failed_sizes()
+        # the host that took the previous VM stays the best fit for the
+        # next VMs of the same size as long as it can take them
+        current, size = None, None
+        for k, (mem, cpu) in enumerate(sizes):
+            if current is not None:
+                if (mem, cpu) == size and self._fits(current, mem, cpu):
+                    self._assign(placed, k, current, mem, cpu)
+                    continue
+                if not self._full(current, smallest):
+                    insort(by_ram, (self.ram[current], current))
+                current = None
+            if failed.dominates(mem, cpu):
+                unplaced.append(k)
+                continue
+            j = bisect_left(by_ram, (mem, n_hosts))
+            while j < len(by_ram) and not self._fits(by_ram[j][1], mem, cpu):
+                if self._full(by_ram[j][1], smallest):
+                    by_ram.pop(j)
+                else:
+                    j += 1
+            if j == len(by_ram):
+                failed.add(mem, cpu)
+                unplaced.append(k)
+                continue
+            current, size = by_ram.pop(j)[1], (mem, cpu)
+            self._assign(placed, k, current, mem, cpu)
+        return unplaced
+
+    def _place_balanced(self, vms, sizes, placed):
+        """Hosts are kept in a heap by decreasing remaining RAM, and leave
+        it as soon as they cannot take the smallest VM"""
+        smallest = _smallest(sizes)
+        heap = [(-self.ram[i], i) for i in self._active_hosts()
+                if not self._full(i, smallest)]
+        heapq.heapify(heap)
+        unplaced = []
+        failed = _failed_sizes()
+        for k, (mem, cpu) in enumerate(sizes):
+            if failed.dominates(mem, cpu):
+                unplaced.append(k)
+                continue
+            skipped = []
+            while heap and -heap[0][0] - mem > 0 and \
+                    not self._fits(heap[0][1], mem, cpu):
+                item = heapq.heappop(heap)
+                if not self._full(item[1], smallest):
+                    skipped.append(item)
+            if heap and self._fits(heap[0][1], mem, cpu):
+                i = heap[0][1]
+                self._assign(placed, k, i, mem, cpu)
+                if self._full(i, smallest):
+                    heapq.heappop(heap)
+                else:
+                    heapq.heapreplace(heap, (-self.ram[i], i))
+            else:
+                failed.add(mem, cpu)
+                unplaced.append(k)
+            for item in skipped:
+                heapq.heappush(heap, item)
+        return unplaced
+
+    def _report(self, vms, sizes, unplaced):
+        needed = {'RAM': sum(mem for mem, _ in sizes),
+                  'CPU': sum(cpu for _, cpu in sizes)}
+        ids = vms_column(vms, 'id')
+        report = {'feasible': len(unplaced) == 0,
+                  'mode': self.mode,
+                  'n_vms': len(sizes),
+                  'placed': len(sizes) - len(unplaced),
+                  'unplaced': [ids[k] for k in unplaced],
+                  'needed': needed,
+                  'available': dict(self.total),
+                  'max_vms': None}
+        if unplaced:
+            mem, cpu = sizes[unplaced[0]]
+            report['max_vms'] = sum(
+                min(_n_fit(self.host_ram[i], mem),
+                    _n_fit(self.host_cpu[i], cpu))
+                for i in self._active_hosts())
+        return report
+
+
+def _vms_sizes(vms):
+    """Return the list of the (mem, cpu) of the VMs"""
+    return zip(vms_column(vms, 'mem'),
+               [vm_cpu({'n_cpu': n_cpu}) for n_cpu in vms_column(vms, 'n_cpu')])
+
+
+def _smallest(sizes):
+    """Return the smallest RAM and CPU asked by a VM"""
+    if not sizes:
+        return 0, 0
+    return min(mem for mem, _ in sizes), min(cpu for _, cpu in sizes)
+
+
+def _n_fit(capacity, need):
+    """Return the number of VMs that fit in a capacity, a host keeping some
+    of each resource as in placement_engine._fits"""
+    if need <= 0:
+        return sys.maxint if capacity > 0 else 0
+    return max(0, int(ceil(float(capacity) / need)) - 1)
+
+
+class _failed_sizes():
+    """The sizes of the VMs that could not be placed. The resources of the
+    hosts only decrease while placing, so a VM at least as big as one of
+    them cannot be placed either."""
+
+    def __init__(self):
+        self.sizes = []
+
+    def add(self, mem, cpu):
+        self.sizes.append((mem, cpu))
+
+    def dominates(self, mem, cpu):
+        for failed_mem, failed_cpu in self.sizes:
+            if mem >= failed_mem and cpu >= failed_cpu:
+                return True
+        return False
+
+
+def log_infeasible(report):
+    """Log a placement report where some VMs could not be placed"""
+    logger.error('Not enough ressources ! \n' + 'RAM'.rjust(20)
+                 + 'CPU'.rjust(10) + '\n' + 'Needed'.ljust(15)
+                 + '%s Mb'.ljust(15) + '%s \n' +
+                 'Available'.ljust(15) + '%s Mb'.ljust(15)
+                 + '%s \n' + 'Maximum number of VM is %s',
+                 report['needed']['RAM'], report['needed']['CPU'],
+                 report['available']['RAM'], report['available']['CPU'],
+                 style.emph(str(report['max_vms'])))
@@ -0,0 +1,155 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""In-process detection of the hosts whose TCP port accepts connections,
+with non blocking connections multiplexed by poll"""
+import errno
+import socket
+import select
+from time import time, sleep
+from execo import logger, Host
+from execo.log import style
+
+
+class port_prober():
+    """Probe a TCP port on many hosts concurrently, from a single thread.
+
+    The hosts are resolved once, when the prober is created. A probe opens a
+    non blocking connection to every host and waits for all of them with
+    ``poll``, each connection having its own timeout. A host is up when the
+    connection is accepted, and down when it is refused, unreachable or
+    times out. The date of every change of state of a host is recorded in
+    :attr:`changes`.
+    """
+
+    def __init__(self, hosts, port=22, connect_timeout=2, max_sockets=1000):
+        """:param hosts: a list of hosts, as names, ip or execo Host
+
+        :param port: the TCP port to probe
+
+        :param connect_timeout: seconds after which a connection that is
+         neither accepted nor refused makes the host down
+
+        :param max_sockets: the maximum number of connections opened at the
+         same time
+        """
+        self.hosts = [host.address if isinstance(host, Host) else host
+                      for host in hosts]
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.max_sockets = max_sockets
+        self.ips = {}
+        """A dict whose keys are the hosts and values their ip"""
+        self.hosts_by_ip = {}
+        """A dict whose keys are the ip and values the hosts"""
+        self.state = dict((host, None) for host in self.hosts)
+        """A dict whose keys are the hosts and values True if up, False if
+        down and None before their first probe"""
+        self.changes = dict((host, []) for host in self.hosts)
+        """A dict whose keys are the hosts and values the list of (date, up)
+        of their changes of state"""
+        for host in self.hosts:
+            try:
+                ip = socket.gethostbyname(host)
+            except socket.error:
+                logger.warning('Unable to resolve %s', style.host(host))
+                continue
+            self.ips[host] = ip
+            self.hosts_by_ip[ip] = host
+
+    def probe(self, hosts=None):
+        """Probe some hosts, default to all, and return a dict whose keys are
+        the hosts and values True if they are up"""
+        hosts = self.hosts if hosts is None else hosts
+        date = time()
+        results = {}
+        todo = []
+        for host in hosts:
+            if host in self.ips:
+                todo.append(host)
+            else:
+                results[host] = False
+        poller = select.poll()
+        sockets = {}
+        deadlines = {}
+        todo.reverse()
+        while todo or sockets:
+            while todo and len(sockets) < self.max_sockets:
+                host = todo.pop()
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(0)
+                err = sock.connect_ex((self.ips[host], self.port))
+                if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    sockets[sock.fileno()] = (sock, host)
+                    deadlines[sock.fileno()] = time() + self.connect_timeout
+                    poller.register(sock, select.POLLOUT | select.POLLERR |
+                                    select.POLLHUP)
+                else:
+                    results[host] = err == 0
+                    sock.close()
+            if not sockets:
+                continue
+            wait = max(0, min(deadlines.itervalues()) - time())
+            for fd, _ in poller.poll(int(wait * 1000) + 1):
+                sock, host = sockets.pop(fd)
+                del deadlines[fd]
+                poller.unregister(fd)
+                results[host] = sock.getsockopt(socket.SOL_SOCKET,
+                                                socket.SO_ERROR) == 0
+                sock.close()
+            now = time()
+            for fd in [fd for fd, deadline in deadlines.iteritems()
+                       if deadline <= now]:
+                sock, host = sockets.pop(fd)
+                del deadlines[fd]
+                poller.unregister(fd)
+                results[host] = False
+                sock.close()
+        for host, up in results.iteritems():
+            if self.state.get(host) != up:
+                self.state[host] = up
+                self.changes.setdefault(host, []).append((date, up))
+        return results
+
+    def wait(self, up=True, timeout=300, interval=1):
+        """Probe the hosts that are not in the wanted state every
+        ``interval`` seconds, until all of them are or timeout is reached.
+        Return the list of hosts that did not reach the state."""
+        start = time()
+        pending = list(self.hosts)
+        while True:
+            probe_date = time()
+            for host, host_up in self.probe(pending).iteritems():
+                if host_up == up:
+                    logger.detail('%s is %s', style.host(host),
+                                  'up' if up else 'down')
+            pending = [host for host in pending if self.state[host] != up]
+            if not pending or time() - start >= timeout:
+                break
+            sleep(max(0, min(interval - (time() - probe_date),
+                             timeout - (time() - start))))
+        return pending
+
+    def changed(self, up=True, since=None):
+        """Return a dict whose keys are the hosts and values the date of
+        their last change to the given state, after ``since`` if given"""
+        dates = {}
+        for host, changes in self.changes.iteritems():
+            for date, state in changes:
+                if state == up and (since is None or date >= since):
+                    dates[host] = date
+        return dates
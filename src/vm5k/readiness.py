@@ -0,0 +1,319 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Detection of the virtual machines that have finished booting, by
+probing only the pending ones and by listening to push signals"""
+import socket
+from time import time
+from threading import Lock, Event, Thread
+from execo import logger
+from execo.log import style
+from execo.process import ProcessOutputHandler
+from vmtable import vms_by
+from backend import get_backend
+from agent import get_agents
+
+
+class vm_readiness_monitor():
+    """Follow the boot of a list of VMs and record the time at which each of
+    them is ready, i.e. accepts connections on its ssh port.
+
+    Pending VMs are probed from their host, with nmap or with the agent of the
+    host when agents are in use (see :mod:`vm5k.agent`). Each VM has its own
+    probe interval that doubles after every unsuccessful probe. Push signals
+    can shorten the wait:
+
+    - a DHCP lease given by dnsmasq triggers an immediate probe of the VM
+      (:meth:`listen_dnsmasq`)
+    - a datagram sent by the guest containing its id or ip marks it as
+      ready (:meth:`listen_callbacks`)
+    """
+
+    def __init__(self, vms, port=22, initial_delay=5, min_interval=1,
+                 max_interval=16, watch=True):
+        """:param vms: a VMTable or a list of VM dicts
+
+        :param port: the port that must be open for a VM to be ready
+
+        :param initial_delay: seconds before the first probe of a VM
+
+        :param min_interval: initial interval between two probes of a VM
+
+        :param max_interval: maximum interval between two probes of a VM
+
+        :param watch: if False, the VMs are only probed once they have been
+         given to :meth:`watch`, typically when they are started
+        """
+        self.vms = vms
+        self.port = port
+        self.initial_delay = initial_delay
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.start_date = time()
+        self.ready = {}
+        """A dict whose keys are VM ids and values the date at which they
+        have been seen ready"""
+        self.last_down = {}
+        """A dict whose keys are VM ids and values the date of the last
+        unsuccessful probe, which bounds the ready date from below"""
+        self.n_vms = 0
+        self._pending = {}
+        self._interval = {}
+        self._next_probe = {}
+        self._ready_order = []
+        self._vms_ip = vms_by(vms, 'ip')
+        self._vms_mac = vms_by(vms, 'mac')
+        self._vms_id = vms_by(vms, 'id')
+        self._lock = Lock()
+        self._event = Event()
+        self._listeners = []
+        if watch:
+            self.watch(vms)
+
+    def watch(self, vms):
+        """Start to probe some VMs, after the initial delay"""
+        first_probe = time() + self.initial_delay
+        with self._lock:
+            for vm in vms:
+                if vm['id'] in self._pending or vm['id'] in self.ready:
+                    continue
+                self._pending[vm['id']] = vm
+                self._interval[vm['id']] = self.min_interval
+                self._next_probe[vm['id']] = first_probe
+                self.n_vms += 1
+        self._event.set()
+
+    def pending(self):
+        """Return the list of VMs that are not ready yet"""
+        with self._lock:
+            return self._pending.values()
+
+    def notify(self, key, ready=True, date=None):
+        """Handle a push signal for a VM.
+
+        :param key: the id, ip or mac of the VM
+
+        :param ready: if True, the VM is marked as ready, otherwise it is only
+         probed as soon as possible
+
+        :param date: the date of the signal, default to now
+        """
+        vm = self._vms_id.get(key) or self._vms_ip.get(key) \
+            or self._vms_mac.get(key)
+        if vm is None:
+            return
+        date = date if date else time()
+        with self._lock:
+            if vm['id'] not in self._pending:
+                return
+            if ready:
+                self._set_ready(vm, date)
+            else:
+                self._interval[vm['id']] = self.min_interval
+                self._next_probe[vm['id']] = date
+        self._event.set()
+
+    def probe(self):
+        """Probe the VMs whose next probe date has been reached and return the
+        number of VMs that became ready"""
+        now = time()
+        hosts_ips = {}
+        with self._lock:
+            for vm_id, vm in self._pending.iteritems():
+                if self._next_probe[vm_id] <= now:
+                    hosts_ips.setdefault(vm['host'], []).append(vm['ip'])
+        if not hosts_ips:
+            return 0
+        agents = get_agents(hosts_ips.keys())
+        if agents:
+            up_ips = agents.probe(hosts_ips, self.port)
+        else:
+            up_ips = self._nmap(hosts_ips)
+        date = time()
+        n_ready = 0
+        with self._lock:
+            for ips in hosts_ips.itervalues():
+                for ip in ips:
+                    vm = self._vms_ip[ip]
+                    if vm['id'] not in self._pending:
+                        continue
+                    if ip in up_ips:
+                        self._set_ready(vm, date)
+                        n_ready += 1
+                    else:
+                        self.last_down[vm['id']] = date
+                        interval = min(2 * self._interval[vm['id']],
+                                       self.max_interval)
+                        self._interval[vm['id']] = interval
+                        self._next_probe[vm['id']] = date + interval
+        return n_ready
+
+    def _nmap(self, hosts_ips):
+        """Probe the VMs with nmap from their host and return the set of
+        ip whose port is open"""
+        nmap = get_backend().get_remote_cmds(
+            {host: 'nmap -n -Pn -oG - -p ' + str(self.port) + ' ' +
+             ' '.join(ips) for host, ips in hosts_ips.iteritems()})
+        for p in nmap.processes:
+            p.ignore_exit_code = p.nolog_exit_code = True
+        nmap.run()
+        up_ips = set()
+        for p in nmap.processes:
+            for line in p.stdout.split('\n'):
+                if line.startswith('Host:') and \
+                        str(self.port) + '/open/' in line:
+                    up_ips.add(line.split()[1])
+        return up_ips
+
+    def wait(self, timeout=600, stall=60, restart=True):
+        """Probe the pending VMs until all of them are ready or timeout is
+        reached. If no VM becomes ready during ``stall`` seconds, the ARP
+        tables are refreshed and, if ``restart``, the VMs that are not running
+        are started again. Return True if all VMs are ready."""
+        from actions import activate_vms, restart_vms
+        last_progress = time()
+        n_ready = len(self.ready)
+        activated = False
+        start = time()
+        while self._pending and time() - start < timeout:
+            self._event.clear()
+            self.probe()
+            if len(self.ready) > n_ready:
+                n_ready = len(self.ready)
+                last_progress = time()
+                logger.info('%s/%s', n_ready, self.n_vms)
+            elif time() - last_progress > stall:
+                if not activated:
+                    activate_vms(self.pending())
+                    activated = True
+                if restart:
+                    restart_vms(self.pending())
+                last_progress = time()
+            with self._lock:
+                next_probe = min(self._next_probe[vm_id]
+                                 for vm_id in self._pending) \
+                    if self._pending else time()
+            self._event.wait(max(0, min(next_probe - time(),
+                                        self.max_interval)))
+        self.stop()
+        if not self._pending:
+            logger.info('All VM have been started')
+            return True
+        logger.error('All VM have not been started: %s',
+                     ', '.join(sorted(style.emph(vm_id)
+                                      for vm_id in self._pending)))
+        return False
+
+    def wait_any(self, timeout=600):
+        """Probe the pending VMs until at least one of them is ready or
+        timeout is reached, and return the ids of the VMs that became ready
+        since the last call"""
+        start = time()
+        while not self._new_ready() and self._pending \
+                and time() - start < timeout:
+            self._event.clear()
+            self.probe()
+            if self._new_ready():
+                break
+            with self._lock:
+                next_probe = min(self._next_probe[vm_id]
+                                 for vm_id in self._pending) \
+                    if self._pending else time()
+            self._event.wait(max(0, min(next_probe - time(),
+                                        self.max_interval)))
+        with self._lock:
+            ready, self._ready_order = self._ready_order, []
+        return ready
+
+    def boot_times(self, start_dates=None):
+        """Return a dict whose keys are the ready VM ids and values their boot
+        duration, from their start date if given or from the creation of the
+        monitor"""
+        start_dates = start_dates if start_dates else {}
+        return {vm_id: date - start_dates.get(vm_id, self.start_date)
+                for vm_id, date in self.ready.iteritems()}
+
+    def listen_dnsmasq(self, server, log_file='/var/log/syslog'):
+        """Follow the dnsmasq log on the service node, and probe a VM as soon
+        as it has received its DHCP lease"""
+        follow = get_backend().get_ssh_process(
+            'tail -n 0 -F ' + log_file + ' | grep --line-buffered DHCPACK',
+            server)
+        follow.ignore_exit_code = follow.nolog_exit_code = True
+        follow.stdout_handlers.append(_dnsmasq_lease_handler(self))
+        follow.start()
+        self._listeners.append(follow)
+        return follow
+
+    def listen_callbacks(self, port=8422):
+        """Listen on an UDP port of the frontend for datagrams sent by the
+        guests, containing their id or ip, for example with
+        ``hostname | nc -u -q 0 <frontend> 8422`` in the guest rc.local"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('', port))
+        sock.settimeout(1)
+        self._listeners.append(sock)
+
+        def _receive():
+            while sock in self._listeners:
+                try:
+                    data, address = sock.recvfrom(1024)
+                except socket.timeout:
+                    continue
+                except socket.error:
+                    break
+                key = data.strip() if data.strip() else address[0]
+                self.notify(key, ready=True)
+
+        t = Thread(target=_receive)
+        t.daemon = True
+        t.start()
+        return sock
+
+    def stop(self):
+        """Stop the push signals listeners"""
+        listeners, self._listeners = self._listeners, []
+        for listener in listeners:
+            if isinstance(listener, socket.socket):
+                listener.close()
+            else:
+                listener.kill()
+
+    def _set_ready(self, vm, date):
+        vm['state'] = 'OK'
+        self.ready[vm['id']] = date
+        self._ready_order.append(vm['id'])
+        del self._pending[vm['id']]
+
+    def _new_ready(self):
+        with self._lock:
+            return len(self._ready_order) > 0
+
+
+class _dnsmasq_lease_handler(ProcessOutputHandler):
+    """Parse the dnsmasq DHCPACK log lines and notify the monitor"""
+
+    def __init__(self, monitor):
+        super(_dnsmasq_lease_handler, self).__init__()
+        self.monitor = monitor
+
+    def read_line(self, process, stream, string, eof, error):
+        fields = string.split()
+        for i, field in enumerate(fields):
+            if field.startswith('DHCPACK') and i + 1 < len(fields):
+                self.monitor.notify(fields[i + 1], ready=False)
+                break
@@ -0,0 +1,233 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Start of the virtual machines with a bounded concurrency on each host"""
+from collections import deque
+from threading import Thread, Condition
+from execo import logger
+from execo.log import style
+from vmtable import vms_by_host
+from backend import get_backend
+from agent import get_agents
+
+vm_start_cmd = "s=`date +%s.%N`; " + \
+    "virsh --connect qemu:///system start {} >/dev/null 2>&1; " + \
+    "r=$?; echo {} $s `date +%s.%N` $r"
+"""The command starting the VM {} and printing ``id start end exit_code``"""
+
+
+class vm_start_scheduler():
+    """Start the VMs of each host in parallel, with at most
+    ``host_concurrency`` simultaneous ``virsh start`` on a host and
+    ``global_concurrency`` on all hosts. A VM is started as soon as another
+    one of its host has started, in a sliding window. When ``ramp`` is True,
+    the concurrency of a host begins at 1 and doubles after each batch, so
+    that the disks of the host are not overloaded by the first VMs.
+
+    Without ``global_concurrency``, each host starts its VMs with one remote
+    command, or one request to its agent. With it, the frontend starts the
+    VMs one by one from a window shared by all the hosts.
+
+    The start date of each VM, as seen by its host, is recorded in
+    ``started`` and can be given to
+    ``vm5k.readiness.vm_readiness_monitor.boot_times``.
+    """
+
+    def __init__(self, vms, host_concurrency=4, global_concurrency=None,
+                 ramp=True):
+        """:param vms: a VMTable or a list of VM dicts
+
+        :param host_concurrency: maximum number of VMs starting at the same
+         time on a host
+
+        :param global_concurrency: maximum number of VMs starting at the same
+         time on all hosts
+
+        :param ramp: increase progressively the concurrency on each host
+        """
+        self.hosts_vms = vms_by_host(vms)
+        self.concurrency = host_concurrency
+        self.global_concurrency = global_concurrency
+        self.ramp = ramp
+        self.started = {}
+        """A dict whose keys are VM ids and values the date at which
+        ``virsh start`` returned"""
+        self.start_duration = {}
+        """A dict whose keys are VM ids and values the duration of their
+        ``virsh start`` command"""
+        self.failed = []
+        """The list of VM ids that could not be started"""
+
+    def batches(self, vms_ids):
+        """Split a host list of VM ids in the batches of the ramp, whose
+        size doubles from 1 to the concurrency, and a last batch with the
+        other VMs. Each batch is started by a window of at most
+        ``concurrency`` VMs."""
+        batches = []
+        size = 1 if self.ramp else self.concurrency
+        i = 0
+        while i < len(vms_ids) and size < self.concurrency:
+            batches.append(vms_ids[i:i + size])
+            i += size
+            size = min(2 * size, self.concurrency)
+        if i < len(vms_ids):
+            batches.append(vms_ids[i:])
+        return batches
+
+    def host_cmd(self, vms_ids):
+        """Return the shell command that starts the VMs of a host and prints
+        a line ``id start end exit_code`` for each of them"""
+        return ' ; '.join("echo '" + ' '.join(batch) + "' | tr ' ' '\\n' | " +
+                          "xargs -P " + str(min(len(batch),
+                                                self.concurrency)) +
+                          " -I{} sh -c '" + vm_start_cmd + "'"
+                          for batch in self.batches(vms_ids))
+
+    def action(self):
+        """Return the action that starts the VMs"""
+        start = get_backend().get_remote_cmds(
+            {host: self.host_cmd([vm['id'] for vm in vms])
+             for host, vms in self.hosts_vms.iteritems()})
+        for p in start.processes:
+            p.nolog_exit_code = True
+        return start
+
+    def run(self):
+        """Start the VMs, parse the per-VM results and return the
+        scheduler"""
+        n_vms = sum(len(vms) for vms in self.hosts_vms.itervalues())
+        logger.debug('Starting %s VMs on %s hosts, %s at a time on each host'
+                     ' and %s on all hosts', n_vms, len(self.hosts_vms),
+                     self.concurrency, self.global_concurrency or n_vms)
+        if self.global_concurrency and self.global_concurrency < \
+                sum(min(len(vms), self.concurrency)
+                    for vms in self.hosts_vms.itervalues()):
+            self.parse_results(self._run_window())
+            return self
+        agents = get_agents(self.hosts_vms.keys())
+        if agents:
+            results = agents.start_vms(
+                {host: self.batches([vm['id'] for vm in vms])
+                 for host, vms in self.hosts_vms.iteritems()},
+                self.concurrency)
+            self.parse_results([result for host_results in results.values()
+                                for result in host_results])
+            return self
+        start = self.action().run()
+        self.parse(start)
+        return self
+
+    def host_limit(self, n_started):
+        """Return the number of VMs a host may start at the same time once
+        n_started of its VMs have started. With the ramp, the limit grows
+        by one for each VM started, so that it doubles at each round."""
+        if not self.ramp:
+            return self.concurrency
+        return min(self.concurrency, 1 + n_started)
+
+    def _run_window(self):
+        """Start the VMs one by one by global_concurrency workers, taking
+        the hosts in turn, and return the list of (id, start, end,
+        exit_code)"""
+        pending = deque((host, deque(vm['id'] for vm in vms))
+                        for host, vms in self.hosts_vms.iteritems() if vms)
+        running = {host: 0 for host in self.hosts_vms}
+        n_started = {host: 0 for host in self.hosts_vms}
+        results = []
+        cond = Condition()
+
+        def _next():
+            for _ in xrange(len(pending)):
+                host, vms_ids = pending[0]
+                pending.rotate(-1)
+                if running[host] < self.host_limit(n_started[host]):
+                    vm_id = vms_ids.popleft()
+                    if not vms_ids:
+                        pending.pop()
+                    return host, vm_id
+            return None
+
+        def _worker():
+            while True:
+                with cond:
+                    job = _next()
+                    while job is None and pending:
+                        cond.wait()
+                        job = _next()
+                    if job is None:
+                        return
+                    running[job[0]] += 1
+                result = self._start_vm(*job)
+                with cond:
+                    results.append(result)
+                    running[job[0]] -= 1
+                    n_started[job[0]] += 1
+                    cond.notify_all()
+
+        workers = [Thread(target=_worker)
+                   for _ in xrange(self.global_concurrency)]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        for t in workers:
+            t.join()
+        return results
+
+    def _start_vm(self, host, vm_id):
+        """Start a VM with its own remote command and return its (id, start,
+        end, exit_code)"""
+        p = get_backend().get_ssh_process(vm_start_cmd.replace('{}', vm_id),
+                                          host)
+        p.nolog_exit_code = True
+        p.run()
+        for line in p.stdout.strip().split('\n'):
+            fields = line.split()
+            if len(fields) == 4 and fields[0] == vm_id:
+                return fields
+        return [vm_id, 0, 0, p.exit_code if p.exit_code else 255]
+
+    def parse(self, action):
+        """Read the start dates and exit codes of the VMs from the output of
+        the action"""
+        results = []
+        for p in action.processes:
+            for line in p.stdout.strip().split('\n'):
+                fields = line.split()
+                if len(fields) == 4:
+                    results.append(fields)
+        self.parse_results(results)
+
+    def parse_results(self, results):
+        """Record the start dates and exit codes of the VMs from a list of
+        (id, start, end, exit_code)"""
+        expected = set()
+        for vms in self.hosts_vms.itervalues():
+            expected.update(vm['id'] for vm in vms)
+        for vm_id, start, end, code in results:
+            if vm_id not in expected:
+                continue
+            expected.discard(vm_id)
+            if str(code) == '0':
+                self.started[vm_id] = float(end)
+                self.start_duration[vm_id] = float(end) - float(start)
+            else:
+                self.failed.append(vm_id)
+        self.failed += sorted(expected)
+        if self.failed:
+            logger.warning('Unable to start %s',
+                           ', '.join(style.emph(vm_id)
+                                     for vm_id in self.failed))
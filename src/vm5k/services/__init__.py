@@ -17,5 +17,6 @@
 # along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
 
 from dnsmasq import dnsmasq_server
+from dnstier import dns_tier
 from munin import setup_munin
 from aptcacher import setup_aptcacher_server, configure_apt_proxy
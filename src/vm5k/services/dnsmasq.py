@@ -4,36 +4,140 @@
 from os import fdopen
 from tempfile import mkstemp
 from math import ceil, log
-from execo import logger, SshProcess, Put, Remote, Host, TaktukRemote, \
-    Process, TaktukPut
+from itertools import izip
+from socket import inet_aton
+from struct import unpack
+from execo import logger, Host, Process
 from execo.log import style
+from execo.config import SCP, TAKTUK
 from execo_g5k import get_host_site
+from vm5k.backend import get_backend
+from vm5k.ippool import ip_to_int, int_to_ip
+from vm5k.vmtable import vms_column
 
 
-def add_vms(vms, server):
-    """Generate the list of virtual machines """
-    logger.debug('Adding the VM in /etc/hosts ...')
-    fd, vms_list = mkstemp(dir='/tmp/', prefix='vms_')
-    f = fdopen(fd, 'w')
-    f.write('\n' + '\n'.join([vm['ip'] + ' \t ' + vm['id'] for vm in vms]))
-    f.close()
-    Put([server], [vms_list], remote_location='/etc/').run()
-    SshProcess('[ -f /etc/hosts.bak ] && cp /etc/hosts.bak /etc/hosts || ' +
-               ' cp /etc/hosts /etc/hosts.bak', server).run()
-    Remote('cat /etc/' + vms_list.split('/')[-1] + ' >> /etc/hosts',
-           [server]).run()
-    Process('rm ' + vms_list).run()
+vms_hosts_file = '/etc/vm5k_hosts'
+"""The names of the VMs, read by dnsmasq as an addn-hosts file"""
+
+vms_dhcp_file = '/etc/vm5k_dhcp_hosts'
+"""The dhcp-host entries of the VMs, read by dnsmasq as a dhcp-hostsfile"""
+
+_servers_ip = {}
+
+
+def hosts_lines(vms):
+    """Generate the lines of the addn-hosts file of some VMs"""
+    for ip_id in izip(vms_column(vms, 'ip'), vms_column(vms, 'id')):
+        yield '%s \t %s\n' % ip_id
+
+
+def dhcp_lines(vms):
+    """Generate the lines of the dhcp-hostsfile of some VMs"""
+    for mac_id_ip in izip(vms_column(vms, 'mac'), vms_column(vms, 'id'),
+                          vms_column(vms, 'ip')):
+        yield '%s,%s,%s\n' % mac_id_ip
+
+
+def dhcp_ranges(ips):
+    """Return the minimal list of (first, last) ip intervals that contain a
+    list of ips. The addresses ending with .0, .254 or .255, that are never
+    given to VMs, do not split an interval."""
+    values = sorted(set(unpack('!%sI' % (len(ips), ),
+                               ''.join(inet_aton(ip) for ip in ips))))
+    ranges = []
+    for value in values:
+        if ranges and (value == ranges[-1][1] + 1 or
+                       all(gap & 255 in (0, 254, 255)
+                           for gap in xrange(ranges[-1][1] + 1, value))):
+            ranges[-1][1] = value
+        else:
+            ranges.append([value, value])
+    return [(int_to_ip(first), int_to_ip(last)) for first, last in ranges]
+
+
+def add_vms(vms, server, append=False, dhcp_vms=None):
+    """Write the names and the dhcp-host entries of the virtual machines in
+    the files read by dnsmasq, or append them if ``append``. The dhcp-host
+    entries are restricted to ``dhcp_vms`` if given."""
+    logger.debug('Adding the VM in %s ...', vms_hosts_file)
+    _put_file(server, hosts_lines(vms), vms_hosts_file, append)
+    _put_file(server, dhcp_lines(vms if dhcp_vms is None else dhcp_vms),
+              vms_dhcp_file, append)
+
+
+def update_vms(server, vms, sites, dhcp=True, dhcp_vms=None):
+    """Bring the configuration of a running dnsmasq to a list of virtual
+    machines without restarting it. The new VMs are appended to the files of
+    dnsmasq, which are rewritten only if some VMs have been removed or
+    changed, and dnsmasq reloads them on SIGHUP. The service is restarted,
+    keeping the leases, only if the dhcp-range must be extended. Return the
+    number of added and removed VMs."""
+    dhcp_vms = vms if dhcp_vms is None else dhcp_vms
+    conf, hosts, entries, gc_thresh = get_dnsmasq_state(server)
+    added, n_removed = _update_file(server, vms_hosts_file, hosts, vms,
+                                    lambda vm: (vm['ip'], ), hosts_lines)
+    dhcp_added, dhcp_removed = _update_file(server, vms_dhcp_file, entries,
+                                            dhcp_vms,
+                                            lambda vm: (vm['ip'], vm['mac']),
+                                            dhcp_lines)
+    logger.debug('%s VMs added and %s VMs removed on %s', len(added),
+                 n_removed, style.host(server))
+    if dhcp and len(dhcp_vms) > gc_thresh:
+        sysctl_conf(server, dhcp_vms)
+    new_conf = _dnsmasq_conf(server, dhcp_vms, sites, dhcp,
+                             exclusive=len(dhcp_vms) < len(vms))
+    if _conf_outdated(conf, new_conf, [vm['ip'] for vm in dhcp_added]):
+        logger.debug('Restarting dnsmasq with a new dnsmasq.conf')
+        _put_file(server, [new_conf], '/etc/dnsmasq.conf')
+        get_backend().get_ssh_process('service dnsmasq restart',
+                                      server).run()
+    elif added or n_removed or dhcp_added or dhcp_removed:
+        logger.debug('Reloading dnsmasq')
+        get_backend().get_ssh_process('killall -HUP dnsmasq', server).run()
+    return len(added), n_removed
+
+
+def get_dnsmasq_state(server):
+    """Return the lines of the dnsmasq.conf of a server, two dicts whose
+    keys are VMs ids and values their (ip, ) in its addn-hosts file and their
+    (ip, mac) in its dhcp-hostsfile, and its gc_thresh1 ARP setting"""
+    get_state = get_backend().get_ssh_process(
+        ' ; echo %s ; '.join(['cat /etc/dnsmasq.conf', 'cat ' + vms_hosts_file,
+                              'cat ' + vms_dhcp_file,
+                              'sysctl -n net.ipv4.neigh.default.gc_thresh1'])
+        % ((_separator, ) * 3), server)
+    get_state.ignore_exit_code = get_state.nolog_exit_code = True
+    get_state.run()
+    parts = get_state.stdout.split(_separator + '\n')
+    parts += [''] * (4 - len(parts))
+    conf = [line for line in parts[0].split('\n') if line.strip()]
+    hosts = {}
+    for line in parts[1].split('\n'):
+        fields = line.split()
+        if len(fields) == 2:
+            hosts[fields[1]] = (fields[0], )
+    entries = {}
+    for line in parts[2].split('\n'):
+        fields = line.strip().split(',')
+        if len(fields) == 3:
+            entries[fields[1]] = (fields[2], fields[0])
+    gc_thresh = int(parts[3].strip()) if parts[3].strip().isdigit() else 0
+    return conf, hosts, entries, gc_thresh
 
 
 def get_server_ip(host):
-    """Get the server IP"""
+    """Get the server IP, resolved once by host"""
     if isinstance(host, Host):
         host = host.address
+    ip = _servers_ip.get(host)
+    if ip:
+        return ip
     logger.debug('Retrieving IP from %s', style.host(host))
-    get_ip = Process('host ' + host + ' |cut -d \' \' -f 4')
-    get_ip.shell = True
-    get_ip.run()
+    get_ip = get_backend().get_process('host ' + host + ' |cut -d \' \' -f 4',
+                                       shell=True).run()
     ip = get_ip.stdout.strip()
+    if get_ip.ok and ip:
+        _servers_ip[host] = ip
     return ip
 
 
@@ -41,47 +145,37 @@ def get_server_iface(server):
     """Get the default network interface of the serve """
     logger.debug('Retrieving default interface from %s',
                  style.host(server.address))
-    get_if = SshProcess('ip route |grep default |cut -d " " -f 5',
-                        server).run()
+    get_if = get_backend().get_ssh_process(
+        'ip route |grep default |cut -d " " -f 5', server).run()
     return get_if.stdout.strip()
 
 
-def resolv_conf(server, clients, sites):
-    """Generate the resolv.conf with dhcp parameters and put it on the server
-    """
+def resolv_conf(server, clients, sites, nameservers=None):
+    """Generate the resolv.conf with dhcp parameters and put it on the
+    clients, with the servers given in ``nameservers``, default to server,
+    as name servers"""
+    nameservers = nameservers if nameservers else [server]
     fd, resolv = mkstemp(dir='/tmp/', prefix='resolv_')
     f = fdopen(fd, 'w')
     f.write('domain grid5000.fr\nsearch grid5000.fr ' +
             ' '.join([site + '.grid5000.fr' for site in sites]) +
-            '\nnameserver ' + get_server_ip(server))
+            ''.join('\nnameserver ' + get_server_ip(nameserver)
+                    for nameserver in nameservers[:3]))
     f.close()
-    TaktukPut(clients, [resolv], remote_location='/etc/').run()
-    TaktukRemote('cd /etc && cp ' + resolv.split('/')[-1] + ' resolv.conf',
-                 clients).run()
+    get_backend().get_fileput(clients, [resolv], remote_location='/etc/',
+                              tool=TAKTUK).run()
+    get_backend().get_remote('cd /etc && cp ' + resolv.split('/')[-1] +
+                             ' resolv.conf', clients).run()
     Process('rm ' + resolv).run()
 
 
-def dhcp_conf(server, vms, sites):
-    """Generate the dnsmasq.conf with dhcp parameters and
-    put it on the server"""
+def dhcp_conf(server, vms, sites, dhcp=True, exclusive=False):
+    """Generate the dnsmasq.conf, with dhcp parameters if ``dhcp``, and
+    put it on the server. With ``exclusive``, dnsmasq only answers to the
+    MAC of its dhcp-hostsfile."""
     logger.debug('Creating dnsmasq.conf')
-    ip_mac = [(vm['ip'], vm['mac']) for vm in vms]
-    dhcp_lease = 'dhcp-lease-max=10000\n'
-    dhcp_range = 'dhcp-range=' + ip_mac[0][0] + ',' + ip_mac[len(vms) - 1][0] + ',12h\n'
-    dhcp_router = 'dhcp-option=option:router,' + get_server_ip(server) + '\n'
-    dhcp_hosts = '' + '\n'.join(['dhcp-host=' + ':' + ip_mac[i][1] + ',' +
-                               vms[i]['id'] + ',' + ip_mac[i][0]
-                               for i in range(len(vms))])
-    dhcp_option = 'dhcp-option=option:domain-search,grid5000.fr,' + \
-        ','.join([site + '.grid5000.fr' for site in sites]) + '\n'
-    fd, dnsmasq = mkstemp(dir='/tmp/', prefix='dnsmasq_')
-    f = fdopen(fd, 'w')
-    f.write(dhcp_lease + dhcp_range + dhcp_router + dhcp_hosts + '\n' + dhcp_option)
-    f.close()
-    Put([server], [dnsmasq], remote_location='/etc/').run()
-    SshProcess('cd /etc && cp ' + dnsmasq.split('/')[-1]+' dnsmasq.conf',
-               server).run()
-    Process('rm ' + dnsmasq).run()
+    _put_file(server, [_dnsmasq_conf(server, vms, sites, dhcp, exclusive)],
+              '/etc/dnsmasq.conf')
 
 
 def sysctl_conf(server, vms):
@@ -95,13 +189,17 @@ def sysctl_conf(server, vms):
     f = fdopen(fd, 'w')
     f.write(conf)
     f.close()
-    Put([server], [sysctl], remote_location='/etc/').run()
-    SshProcess('cd /etc && cat ' + sysctl.split('/')[-1] +
-               ' >> sysctl.conf && sysctl -p', server).run()
+    get_backend().get_fileput([server], [sysctl], remote_location='/etc/',
+                              tool=SCP).run()
+    get_backend().get_ssh_process('cd /etc && cat ' + sysctl.split('/')[-1] +
+                                  ' >> sysctl.conf && sysctl -p',
+                                  server).run()
     Process('rm '+sysctl).run()
 
 
-def dnsmasq_server(server, clients=None, vms=None, dhcp=True):
+def dnsmasq_server(server, clients=None, vms=None, dhcp=True,
+                   incremental=False, dhcp_vms=None, nameservers=None,
+                   sites=None):
     """Configure a DHCP server with dnsmasq
 
     :param server: host where the server will be installed
@@ -110,13 +208,25 @@ def dnsmasq_server(server, clients=None, vms=None, dhcp=True):
 
     :param vms: list of virtual machines
 
+    :param incremental: if True and dnsmasq is already running, only the
+     changes of the VMs are applied, without losing the leases
+
+    :param dhcp_vms: the VMs served by the DHCP of this server, default to
+     all VMs
+
+    :param nameservers: the name servers of the clients, default to server
+
+    :param sites: the sites in the domain search of the VMs and clients,
+     default to the sites of the server and clients
+
     """
     logger.debug('Installing and configuring a DNS/DHCP server on %s', server)
 
-    test_running = Process('nmap ' + server + ' -p 53 | grep domain')
-    test_running.shell = True
-    test_running.run()
-    if 'open' in test_running.stdout:
+    test_running = get_backend().get_process('nmap ' + server +
+                                             ' -p 53 | grep domain',
+                                             shell=True).run()
+    running = 'open' in test_running.stdout
+    if running:
         logger.info('DNS server already running, updating configuration')
     else:
         cmd = 'killall dnsmasq; export DEBIAN_MASTER=noninteractive ; ' + \
@@ -124,23 +234,97 @@ def dnsmasq_server(server, clients=None, vms=None, dhcp=True):
             'apt-get install -t wheezy -o Dpkg::Options::="--force-confdef" ' + \
             '-o Dpkg::Options::="--force-confnew" ' + \
             '-y dnsmasq; echo 1 > /proc/sys/net/ipv4/ip_forward '
-        SshProcess(cmd, server).run()
+        get_backend().get_ssh_process(cmd, server).run()
 
-    sites = list(set([get_host_site(client) for client in clients
-                      if get_host_site(client)] + [get_host_site(server)]))
-    add_vms(vms, server)
+    if sites is None:
+        sites = list(set([get_host_site(client) for client in clients
+                          if get_host_site(client)] +
+                         [get_host_site(server)]))
     if clients:
-        kill_dnsmasq = TaktukRemote('killall dnsmasq', clients)
+        kill_dnsmasq = get_backend().get_remote('killall dnsmasq', clients)
         for p in kill_dnsmasq.processes:
             p.ignore_exit_code = p.nolog_exit_code = True
         kill_dnsmasq.run()
-        resolv_conf(server, clients, sites)
+        resolv_conf(server, clients, sites, nameservers)
+
+    if incremental and running:
+        update_vms(server, vms, sites, dhcp, dhcp_vms)
+        return
 
+    exclusive = dhcp_vms is not None and len(dhcp_vms) < len(vms)
+    dhcp_vms = vms if dhcp_vms is None else dhcp_vms
+    add_vms(vms, server, dhcp_vms=dhcp_vms)
     if dhcp:
-        sysctl_conf(server, vms)
-        dhcp_conf(server, vms, sites)
+        sysctl_conf(server, dhcp_vms)
+    dhcp_conf(server, dhcp_vms, sites, dhcp, exclusive)
 
     logger.debug('Restarting service ...')
     cmd = 'service dnsmasq stop ; rm /var/lib/misc/dnsmasq.leases ; ' + \
-        'service dnsmasq start',
-    SshProcess(cmd, server).run()
+        'service dnsmasq start'
+    get_backend().get_ssh_process(cmd, server).run()
+
+
+_separator = '--vm5k--'
+
+
+def _dnsmasq_conf(server, vms, sites, dhcp, exclusive=False):
+    conf = 'addn-hosts=' + vms_hosts_file + '\n'
+    if dhcp and exclusive:
+        conf += 'dhcp-ignore=tag:!known\n'
+    if dhcp and vms:
+        conf += 'dhcp-lease-max=' + str(max(10000, len(vms))) + '\n' + \
+            ''.join('dhcp-range=' + first + ',' + last + ',12h\n'
+                    for first, last in dhcp_ranges(vms_column(vms, 'ip'))) + \
+            'dhcp-option=option:router,' + get_server_ip(server) + '\n' + \
+            'dhcp-hostsfile=' + vms_dhcp_file + '\n' + \
+            'dhcp-option=option:domain-search,grid5000.fr,' + \
+            ','.join([site + '.grid5000.fr' for site in sites]) + '\n'
+    return conf
+
+
+def _conf_outdated(conf, new_conf, new_ips):
+    """Return True if the dnsmasq.conf must be replaced, i.e. if its options
+    differ or if its dhcp-range do not cover the new ips"""
+    ranges = [line for line in conf if line.startswith('dhcp-range=')]
+    new_lines = [line for line in new_conf.split('\n') if line.strip()]
+    if [line for line in conf if line not in ranges] != \
+            [line for line in new_lines
+             if not line.startswith('dhcp-range=')]:
+        return True
+    if not new_ips or not [line for line in new_lines
+                           if line.startswith('dhcp-range=')]:
+        return False
+    bounds = []
+    for line in ranges:
+        fields = line[len('dhcp-range='):].split(',')
+        bounds.append((ip_to_int(fields[0]), ip_to_int(fields[1])))
+    return not all(any(low <= ip_to_int(ip) <= high for low, high in bounds)
+                   for ip in new_ips)
+
+
+def _update_file(server, remote_file, current, vms, key, lines):
+    """Append the new VMs to a file of dnsmasq, or rewrite it if some have
+    been removed or changed, and return the new VMs and the number of
+    removed ones"""
+    desired = {vm['id']: key(vm) for vm in vms}
+    added = [vm for vm in vms if current.get(vm['id']) != desired[vm['id']]]
+    n_removed = len([vm_id for vm_id, entry in current.iteritems()
+                     if desired.get(vm_id) != entry])
+    if n_removed:
+        _put_file(server, lines(vms), remote_file)
+    elif added:
+        _put_file(server, lines(added), remote_file, append=True)
+    return added, n_removed
+
+
+def _put_file(server, lines, remote_file, append=False):
+    fd, local_file = mkstemp(dir='/tmp/', prefix='dnsmasq_')
+    with fdopen(fd, 'w', 1 << 20) as f:
+        f.writelines(lines)
+    tmp_file = '/tmp/' + local_file.split('/')[-1]
+    get_backend().get_fileput([server], [local_file], remote_location='/tmp/',
+                              tool=SCP).run()
+    get_backend().get_ssh_process(('cat %s >> %s' if append else 'cp %s %s')
+                                  % (tmp_file, remote_file) + ' ; rm ' +
+                                  tmp_file, server).run()
+    Process('rm ' + local_file).run()
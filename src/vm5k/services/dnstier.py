@@ -0,0 +1,140 @@
+# Copyright 2009-2013 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+import sys
+from zlib import crc32
+from threading import Thread
+from execo import logger, Host
+from execo.log import style
+from execo_g5k import get_host_site
+from vm5k.backend import get_backend
+from dnsmasq import dnsmasq_server
+
+
+def shard_key(name):
+    """Return a stable hash of a MAC address or a host name"""
+    return crc32(name) & 0xffffffff
+
+
+class dns_tier():
+    """DNS and DHCP of the virtual machines served by several dnsmasq
+    servers. Each server is the DHCP server of a shard of the VMs, chosen by
+    the site of their host or by a hash of their MAC, and resolves the names
+    of all VMs. The hosts use the server of their shard as first name
+    server."""
+
+    def __init__(self, servers, vms, shard_by='mac'):
+        """:param servers: the hosts running dnsmasq
+
+        :param vms: the list of VMs
+
+        :param shard_by: ``mac`` to spread the VMs evenly with a hash of
+         their MAC, or ``site`` to serve the VMs of a site by the servers of
+         the same site
+        """
+        self.servers = [server.address if isinstance(server, Host)
+                        else server for server in servers]
+        self.shard_by = shard_by
+        self.vms = vms
+        self.clients = {server: [] for server in self.servers}
+        """A dict whose keys are the servers and values their clients"""
+        self.shards = {server: [] for server in self.servers}
+        """A dict whose keys are the servers and values the VMs of their
+        DHCP"""
+        self._servers_site = {}
+        for server in self.servers:
+            self._servers_site.setdefault(get_host_site(server),
+                                          []).append(server)
+        for vm in vms:
+            self.shards[self.server_of(vm)].append(vm)
+
+    def server_of(self, vm):
+        """Return the server of the shard of a VM"""
+        if self.shard_by == 'site':
+            return self._pick(get_host_site(vm['host']), vm['mac'])
+        return self.servers[shard_key(vm['mac']) % len(self.servers)]
+
+    def server_of_host(self, host):
+        """Return the first name server of a host"""
+        if isinstance(host, Host):
+            host = host.address
+        if self.shard_by == 'site':
+            return self._pick(get_host_site(host), host)
+        return self.servers[shard_key(host) % len(self.servers)]
+
+    def nameservers(self, host):
+        """Return the name servers of a host, the server of its shard
+        first"""
+        first = self.server_of_host(host)
+        return [first] + [server for server in self.servers
+                          if server != first]
+
+    def configure(self, clients, dhcp=True, incremental=False):
+        """Configure dnsmasq on all the servers at the same time"""
+        clients = [client.address if isinstance(client, Host) else client
+                   for client in clients]
+        self.clients = {server: [] for server in self.servers}
+        for client in clients:
+            if client not in self.servers:
+                self.clients[self.server_of_host(client)].append(client)
+        logger.info('Sharding DNS/DHCP by %s on %s',
+                    style.emph(self.shard_by),
+                    ', '.join('%s (%s VMs)' % (
+                        style.host(server.split('.')[0]),
+                        len(self.shards[server]))
+                        for server in self.servers))
+        sites = sorted(set([get_host_site(host)
+                            for host in clients + self.servers]) - set([None]))
+        errors = []
+
+        def _configure(server):
+            try:
+                dnsmasq_server(server, self.clients[server], self.vms, dhcp,
+                               incremental, dhcp_vms=self.shards[server],
+                               nameservers=[server] + [
+                                   other for other in self.servers
+                                   if other != server],
+                               sites=sites)
+            except BaseException:
+                errors.append(sys.exc_info())
+
+        threads = [Thread(target=_configure, args=(server, ))
+                   for server in self.servers]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def load(self):
+        """Return a dict whose keys are the servers and values a dict with
+        the number of VMs of their DHCP, of their clients and of the leases
+        they have given"""
+        count = get_backend().get_remote(
+            'cat /var/lib/misc/dnsmasq.leases | wc -l', self.servers)
+        for p in count.processes:
+            p.ignore_exit_code = p.nolog_exit_code = True
+        count.run()
+        leases = {}
+        for p in count.processes:
+            host = p.host.address if isinstance(p.host, Host) else p.host
+            if p.stdout.strip().isdigit():
+                leases[host] = int(p.stdout.strip())
+        return {server: {'vms': len(self.shards[server]),
+                         'clients': len(self.clients[server]),
+                         'leases': leases.get(server, 0)}
+                for server in self.servers}
+
+    def log_load(self):
+        """Log the load of the servers"""
+        logger.info('DNS/DHCP load:%s', ''.join(
+            '\n%s %s VMs, %s clients, %s leases' % (
+                style.host(server.split('.')[0]).ljust(20), load['vms'],
+                load['clients'], load['leases'])
+            for server, load in sorted(self.load().iteritems())))
+
+    def _pick(self, site, key):
+        servers = self._servers_site.get(site, self.servers)
+        return servers[shard_key(key) % len(servers)]
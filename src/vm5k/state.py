@@ -0,0 +1,115 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""The state of a deployment, indexed by site, cluster, host and VM, and
+exported to the vm5k XML format on demand"""
+from collections import OrderedDict
+from xml.etree.ElementTree import Element, SubElement
+from vmtable import VMTable
+
+
+class deployment_state():
+    """Store the sites, clusters, hosts and virtual machines of a deployment
+    in dicts indexed by their id, so that updating the state of an element
+    does not require a search in a tree. :meth:`to_xml` builds the
+    ElementTree used for the vm5k XML files."""
+
+    def __init__(self):
+        self.sites = []
+        """The list of sites"""
+        self.clusters = OrderedDict()
+        """A dict whose keys are the clusters and values their site"""
+        self.hosts = OrderedDict()
+        """A dict whose keys are the hosts and values a dict with their
+        cluster and XML attributes"""
+        self.vms = {}
+        """A dict whose keys are the VM ids and values their XML
+        attributes"""
+        self._vms_ids = []
+
+    def add_site(self, site):
+        """Add a site"""
+        if site not in self.sites:
+            self.sites.append(site)
+
+    def add_cluster(self, cluster, site):
+        """Add a cluster to a site"""
+        self.clusters[cluster] = site
+
+    def add_host(self, host, cluster, **attrib):
+        """Add a host to a cluster, with some XML attributes"""
+        self.hosts[host] = {'cluster': cluster, 'attrib': attrib}
+
+    def add_vm(self, vm):
+        """Add a virtual machine given as a dict"""
+        if vm['id'] not in self.vms:
+            self._vms_ids.append(vm['id'])
+        self.vms[vm['id']] = {'id': vm['id'],
+                              'host': vm['host'],
+                              'ip': vm['ip'],
+                              'mac': vm['mac'],
+                              'mem': str(vm['mem']),
+                              'n_cpu': str(vm['n_cpu']),
+                              'cpuset': vm['cpuset'],
+                              'hdd': str(vm['hdd']),
+                              'backing_file': vm['backing_file'],
+                              'real_file': str(vm['real_file']),
+                              'state': vm['state']}
+
+    def set_host_state(self, host, state):
+        """Change the state of a host"""
+        self.hosts[host]['attrib']['state'] = state
+
+    def update_vms(self, vms):
+        """Copy the state and the host of some VMs, given as a VMTable or a
+        list of VM dicts"""
+        if isinstance(vms, VMTable):
+            ids, hosts, states = vms.column('id'), vms.column('host'), \
+                vms.column('state')
+        else:
+            ids = [vm['id'] for vm in vms]
+            hosts = [vm['host'] for vm in vms]
+            states = [vm['state'] for vm in vms]
+        for vm_id, host, state in zip(ids, hosts, states):
+            attrib = self.vms[vm_id]
+            attrib['host'] = host
+            attrib['state'] = state
+
+    def to_xml(self):
+        """Return the state as an ElementTree Element"""
+        root = Element('vm5k')
+        el_sites = {}
+        for site in self.sites:
+            el_sites[site] = SubElement(root, 'site', attrib={'id': site})
+        el_clusters = {}
+        for cluster, site in self.clusters.iteritems():
+            el_clusters[cluster] = SubElement(el_sites[site], 'cluster',
+                                              attrib={'id': cluster})
+        el_hosts = {}
+        for host, desc in self.hosts.iteritems():
+            attrib = {'id': host}
+            attrib.update(desc['attrib'])
+            el_hosts[host] = SubElement(el_clusters[desc['cluster']], 'host',
+                                        attrib=attrib)
+        for vm_id in self._vms_ids:
+            attrib = self.vms[vm_id]
+            if attrib['host'] in el_hosts:
+                SubElement(el_hosts[attrib['host']], 'vm',
+                           attrib={key: value
+                                   for key, value in attrib.iteritems()
+                                   if key != 'host'})
+        return root
@@ -0,0 +1,311 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Nested timing spans of the steps of a deployment, exported as a JSON
+trace and as folded stacks for flame graphs"""
+import json
+import inspect
+from os import path
+from time import time
+from functools import wraps
+from contextlib import contextmanager
+from threading import Lock, local, current_thread
+from execo import logger, Host
+from execo.action import Action, ActionLifecycleHandler
+from execo.log import style
+from execo.time_utils import format_duration
+
+
+class trace_span():
+    """A step of a deployment, with its dates, its hosts and the hosts on
+    which its actions succeeded or failed"""
+
+    def __init__(self, name, parent=None, hosts=None):
+        self.name = name
+        self.parent = parent
+        self.children = []
+        self.start = time()
+        self.end = None
+        self.thread = current_thread().name
+        self.hosts = set(_address(host) for host in hosts) if hosts \
+            else set()
+        self.hosts_ok = set()
+        self.hosts_ko = set()
+        self.kept = True
+        """False if the span is not in the tree of its tracer"""
+
+    @property
+    def duration(self):
+        """The duration of the span, up to now if it is not closed"""
+        return (self.end if self.end else time()) - self.start
+
+    def record(self, action, hosts=None):
+        """Count the hosts on which the processes of an action succeeded or
+        failed, restricted to ``hosts`` if given"""
+        for p in action.processes:
+            host = _address(getattr(p, 'host', None))
+            if host is None or (hosts is not None and host not in hosts):
+                continue
+            (self.hosts_ok if p.ok else self.hosts_ko).add(host)
+
+    def record_hosts(self, hosts_ok, hosts_ko):
+        """Add hosts to the successful and failed hosts"""
+        self.hosts_ok.update(_address(host) for host in hosts_ok if host)
+        self.hosts_ko.update(_address(host) for host in hosts_ko if host)
+
+    def counts(self):
+        """Return the number of hosts of the span and of its children, and
+        the number of those that succeeded and failed"""
+        hosts, ok, ko = self._hosts()
+        return len(hosts), len(ok - ko), len(ko)
+
+    def to_dict(self, origin):
+        """Return the span and its children as a dict, with dates relative
+        to origin"""
+        n_hosts, n_ok, n_ko = self.counts()
+        return {'name': self.name,
+                'start': self.start - origin,
+                'duration': self.duration,
+                'thread': self.thread,
+                'hosts': n_hosts,
+                'ok': n_ok,
+                'ko': n_ko,
+                'children': [child.to_dict(origin)
+                             for child in list(self.children)]}
+
+    def _hosts(self):
+        hosts, ok, ko = set(self.hosts), set(self.hosts_ok), \
+            set(self.hosts_ko)
+        for child in list(self.children):
+            child_hosts, child_ok, child_ko = child._hosts()
+            hosts |= child_hosts
+            ok |= child_ok
+            ko |= child_ko
+        return hosts | ok | ko, ok, ko
+
+
+class _action_span_handler(ActionLifecycleHandler):
+    """Open a span when an action starts and close it when it ends"""
+
+    def __init__(self, span):
+        self.span = span
+
+    def start(self, action):
+        self.span.start = time()
+
+    def end(self, action):
+        self.span.record(action)
+        self.span.end = time()
+
+
+class deployment_tracer():
+    """Record a tree of spans. The spans opened in a thread are the children
+    of the innermost span opened before in the same thread, or of an
+    explicit parent for the spans opened in a new thread.
+
+    At most ``max_spans`` spans are recorded, so that a long campaign does
+    not fill the memory: the spans opened afterwards, and their children,
+    are timed but left out of the tree and counted in ``dropped``."""
+
+    def __init__(self, max_spans=100000):
+        self.roots = []
+        """The spans without parent"""
+        self.max_spans = max_spans
+        self.dropped = 0
+        """The number of spans left out of the tree"""
+        self._n_spans = 0
+        self._local = local()
+        self._lock = Lock()
+
+    def current(self):
+        """Return the innermost open span of the current thread"""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def open(self, name, hosts=None, parent=None):
+        """Open a span and make it the current span of the thread"""
+        parent = parent if parent else self.current()
+        span = trace_span(name, parent, hosts)
+        with self._lock:
+            if (parent and not parent.kept) or \
+                    (self.max_spans and self._n_spans >= self.max_spans):
+                span.kept = False
+                self.dropped += 1
+            else:
+                self._n_spans += 1
+                (parent.children if parent else self.roots).append(span)
+        self._stack().append(span)
+        return span
+
+    def close(self, span):
+        """Close a span opened by the current thread"""
+        span.end = time()
+        stack = self._stack()
+        if span in stack:
+            del stack[stack.index(span):]
+
+    @contextmanager
+    def span(self, name, hosts=None, parent=None):
+        """Context manager around a span"""
+        span = self.open(name, hosts, parent)
+        try:
+            yield span
+        finally:
+            self.close(span)
+
+    def record(self, action, hosts=None):
+        """Count the hosts of an action in the current span"""
+        span = self.current()
+        if span:
+            span.record(action, hosts)
+
+    def record_hosts(self, hosts_ok, hosts_ko):
+        """Count successful and failed hosts in the current span"""
+        span = self.current()
+        if span:
+            span.record_hosts(hosts_ok, hosts_ko)
+
+    def traced(self, name=None):
+        """Decorator opening a span around each call of a function. When the
+        function returns an execo Action, the span lasts from the start to
+        the end of the action. A ``hosts`` argument gives the hosts of the
+        span."""
+
+        def decorator(func):
+            span_name = name if name else func.__name__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                try:
+                    hosts = inspect.getcallargs(func, *args,
+                                                **kwargs).get('hosts')
+                except TypeError:
+                    hosts = None
+                span = self.open(span_name, hosts if isinstance(hosts, list)
+                                 else None)
+                try:
+                    result = func(*args, **kwargs)
+                except:
+                    self.close(span)
+                    raise
+                self.close(span)
+                if isinstance(result, Action) and not result.ended:
+                    span.end = None
+                    result.lifecycle_handlers.append(
+                        _action_span_handler(span))
+                return result
+            return wrapper
+        return decorator
+
+    def reset(self):
+        """Forget all the spans"""
+        with self._lock:
+            self.roots = []
+            self._n_spans = 0
+            self.dropped = 0
+        self._local = local()
+
+    def origin(self):
+        """Return the start date of the first span"""
+        return min(span.start for span in self.roots) if self.roots else 0
+
+    def to_dict(self):
+        """Return the spans as a list of nested dicts"""
+        origin = self.origin()
+        return {'origin': origin,
+                'spans': [span.to_dict(origin) for span in list(self.roots)]}
+
+    def trace_events(self):
+        """Return the spans as complete events of the Trace Event Format,
+        that can be opened in chrome://tracing"""
+        origin = self.origin()
+        events = []
+        for span in self._walk():
+            n_hosts, n_ok, n_ko = span.counts()
+            events.append({'name': span.name, 'cat': 'vm5k', 'ph': 'X',
+                           'ts': int((span.start - origin) * 10 ** 6),
+                           'dur': int(span.duration * 10 ** 6),
+                           'pid': 1, 'tid': span.thread,
+                           'args': {'hosts': n_hosts, 'ok': n_ok,
+                                    'ko': n_ko}})
+        return events
+
+    def folded(self):
+        """Return the spans as folded stacks, one line per stack with its own
+        time in microseconds, the input format of flamegraph.pl"""
+        stacks = {}
+        for span in self._walk():
+            names = []
+            parent = span
+            while parent:
+                names.append(parent.name.replace(';', ':').replace(' ', '_'))
+                parent = parent.parent
+            own = span.duration - sum(child.duration
+                                      for child in span.children)
+            key = ';'.join(reversed(names))
+            stacks[key] = stacks.get(key, 0) + max(0, int(own * 10 ** 6))
+        return ['%s %s' % (stack, value)
+                for stack, value in sorted(stacks.iteritems())]
+
+    def write(self, outdir, name='trace'):
+        """Write the spans in ``<name>.json`` and ``<name>.folded`` in
+        outdir"""
+        with open(path.join(outdir, name + '.json'), 'w') as f:
+            trace = self.to_dict()
+            trace['dropped'] = self.dropped
+            trace['traceEvents'] = self.trace_events()
+            json.dump(trace, f)
+        with open(path.join(outdir, name + '.folded'), 'w') as f:
+            f.write('\n'.join(self.folded()) + '\n')
+
+    def log_summary(self, depth=2):
+        """Log the duration of the spans down to a depth"""
+        log = ''
+        for span, level in self._walk(depth=depth):
+            log += '\n' + ' ' * 2 * level + \
+                style.emph((span.name + ':').ljust(30 - 2 * level)) + \
+                format_duration(span.duration)
+            n_hosts, _, n_ko = span.counts()
+            if n_hosts:
+                log += ' (%s hosts, %s KO)' % (n_hosts, n_ko)
+        if self.dropped:
+            log += '\n%s spans not recorded' % (self.dropped, )
+        logger.info('Execution time %s', log)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _walk(self, depth=None):
+        todo = [(span, 0) for span in reversed(self.roots)]
+        while todo:
+            span, level = todo.pop()
+            yield (span, level) if depth is not None else span
+            if depth is None or level + 1 < depth:
+                todo += [(child, level + 1)
+                         for child in reversed(span.children)]
+
+
+def _address(host):
+    return host.address if isinstance(host, Host) else host
+
+
+tracer = deployment_tracer()
+"""The tracer shared by the vm5k functions"""
+
+traced = tracer.traced
@@ -18,89 +18,59 @@
 
 import re
 import copy
-from os import fdopen
-from tempfile import mkstemp
 from pprint import pformat
 from xml.dom import minidom
 from random import randint
 from itertools import cycle
 from math import floor
-from execo import logger, Host, Process, Timer, Remote, sleep
+from time import time
+from execo import logger, Host, Remote
 from execo.log import style
 from execo_g5k import get_oar_job_nodes, get_oargrid_job_oar_jobs, \
     get_oar_job_subnets, get_oar_job_kavlan, wait_oar_job_start, \
     wait_oargrid_job_start, distribute_hosts, get_planning, \
     OarSubmission
 from execo.time_utils import get_seconds
-from execo_g5k.api_utils import get_host_cluster, get_g5k_clusters, \
-    get_host_attributes, get_resource_attributes, get_cluster_site, \
+from execo_g5k.api_utils import get_g5k_clusters, \
+    get_resource_attributes, get_cluster_site, \
     get_g5k_sites, get_site_clusters, get_host_site
 from execo_g5k.planning import _slots_limits
+from vm5k.apicache import attributes_cache
+from vm5k.prober import port_prober
+from vm5k.ippool import ip_range
 
 from xml.etree.ElementTree import tostring
-from execo_g5k.utils import get_ipv4_range, get_mac_addresses, hosts_list
+from execo_g5k.utils import hosts_list
 
 
 def reboot_hosts(hosts, timeout=300):
-    """ """
+    """Reboot the hosts and wait for their ssh port to close and open again.
+    Return a dict whose keys are the hosts and values the (down, up) dates
+    at which the prober saw them, or False if the reboot command failed"""
+    prober = port_prober(hosts)
     reboot = Remote('reboot', hosts).run()
     if not reboot.ok:
         return False
-    wait_hosts_down(hosts, timeout)
-    wait_hosts_up(hosts, timeout)
-
-
-def wait_hosts_down(hosts, timeout=300):
-    """ """
-    timer = Timer()
-    up_hosts = map(lambda x: x.address if isinstance(x, Host) else x,
-                   hosts)
-    fd, hosts_file = mkstemp(dir='/tmp/', prefix='hosts_')
-    with fdopen(fd, 'w') as f:
-        f.write('\n' + '\n'.join(up_hosts))
-
-    while len(up_hosts) > 0 and timer.elapsed() < timeout:
-        nmap = Process("nmap -v -oG - -i %s -p 22 |grep Host|grep Status" %
-                       (hosts_file, ), shell=True).run()
-        logger.debug('timer: %s \nnmap output: \n%s', timer.elapsed(),
-                     nmap.stdout.strip())
-        for line in nmap.stdout.strip().split('\n'):
-            if 'Down' in line:
-                ip = line.split()[1]
-                get_host = Process('host ' + ip + '| cut -f 5 -d " "',
-                                   shell=True).run()
-                host = get_host.stdout.strip()[0:-1]
-                if host in up_hosts:
-                    logger.detail(host + ' is down')
-                    up_hosts.remove(host)
-    Process('rm ' + hosts_file).run()
-
-    return len(up_hosts) == 0
-
-
-def wait_hosts_up(hosts, timeout=300):
-    """ """
-    down_hosts = map(lambda x: x.address if isinstance(x, Host) else x,
-                     hosts)
-    fd, hosts_file = mkstemp(dir='/tmp/', prefix='hosts_')
-    f = fdopen(fd, 'w')
-    f.write('\n' + '\n'.join(down_hosts))
-    f.close()
-    timer = Timer()
-    while len(down_hosts) > 0 and timer.elapsed() < timeout:
-        nmap = Process("nmap -v -oG - -i %s -p 22 |grep Host|grep Status" %
-                       (hosts_file, ), shell=True).run()
-        logger.debug('timer: %s \nnmap output: \n%s', timer.elapsed(),
-                     nmap.stdout.strip())
-        for line in nmap.stdout.strip().split('\n'):
-            s = line.split()[2]
-            host = s[s.find("(") + 1:s.find(")")]
-            if host in down_hosts:
-                logger.detail('%s is up', host)
-                down_hosts.remove(host)
-    Process('rm ' + hosts_file).run()
-    sleep(3)
-    return len(down_hosts) == 0
+    start = time()
+    wait_hosts_down(hosts, timeout, prober=prober)
+    wait_hosts_up(hosts, timeout, prober=prober)
+    down = prober.changed(up=False, since=start)
+    up = prober.changed(up=True, since=start)
+    return {host: (down.get(host), up.get(host)) for host in prober.hosts}
+
+
+def wait_hosts_down(hosts, timeout=300, prober=None):
+    """Wait for the ssh port of the hosts to be closed, and return True if
+    all of them are down before timeout"""
+    prober = prober if prober else port_prober(hosts)
+    return len(prober.wait(up=False, timeout=timeout)) == 0
+
+
+def wait_hosts_up(hosts, timeout=300, prober=None):
+    """Wait for the ssh port of the hosts to be open, and return True if
+    all of them are up before timeout"""
+    prober = prober if prober else port_prober(hosts)
+    return len(prober.wait(up=True, timeout=timeout)) == 0
 
 
 def get_oar_job_vm5k_resources(jobs):
@@ -171,18 +141,13 @@ def get_kavlan_network(kavlan, site):
 
 
 def get_kavlan_ip_mac(kavlan, site):
-    """Retrieve the network parameters for a given kavlan from the API"""
+    """Return the (ip, mac) of a kavlan as an ip_range, whose addresses are
+    computed on demand"""
     network, mask_size = get_kavlan_network(kavlan, site)
     min_2 = (kavlan - 4) * 64 + 2 if kavlan < 8 \
         else (kavlan - 8) * 64 + 2 if kavlan < 10 \
         else 216
-    ips = [".".join([str(part) for part in ip]) for ip in
-           [ip for ip in get_ipv4_range(tuple([int(part)
-            for part in network.split('.')]), int(mask_size))
-           if ip[3] not in [0, 254, 255] and ip[2] >= min_2]]
-    macs = get_mac_addresses(len(ips))
-
-    return zip(ips, macs)
+    return ip_range(network, mask_size, min_2)
 
 
 def print_step(step_desc=None):
@@ -201,21 +166,13 @@ def prettify(elem):
 def get_CPU_RAM_FLOPS(hosts):
     """Return the number of CPU and amount RAM for a host list """
     hosts_attr = {'TOTAL': {'CPU': 0, 'RAM': 0}}
-    cluster_attr = {}
     for host in hosts:
         if isinstance(host, Host):
             host = host.address
-        cluster = get_host_cluster(host)
-        if cluster not in cluster_attr:
-            attr = get_host_attributes(host)
-            cluster_attr[cluster] = {
-                 'CPU': attr['architecture']['nb_cores'],
-                 'RAM': int(attr['main_memory']['ram_size'] / 10 ** 6),
-                 'flops': attr['performance']['node_flops']}
-        hosts_attr[host] = cluster_attr[cluster]
-        hosts_attr['TOTAL']['CPU'] += attr['architecture']['nb_cores']
-        hosts_attr['TOTAL']['RAM'] += int(attr['main_memory']['ram_size'] \
-                                          / 10 ** 6)
+        attr = attributes_cache.host(host)
+        hosts_attr[host] = attr
+        hosts_attr['TOTAL']['CPU'] += attr['CPU']
+        hosts_attr['TOTAL']['RAM'] += attr['RAM']
 
     logger.debug(hosts_list(hosts_attr))
     return hosts_attr
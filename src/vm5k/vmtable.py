@@ -0,0 +1,362 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""A columnar table of virtual machines, indexed by id, ip, mac and host,
+that behaves like the list of dicts used in vm5k"""
+import sys
+from array import array
+
+vm_keys = ['id', 'host', 'ip', 'mac', 'mem', 'n_cpu', 'cpuset', 'hdd',
+           'backing_file', 'real_file', 'state', 'tap']
+int_keys = ['mem', 'n_cpu', 'hdd']
+unique_keys = ['id', 'ip', 'mac']
+_null_int = -sys.maxint - 1
+"""The value stored in the integer columns for None"""
+
+
+class VMRow(object):
+    """A dict-like view on the virtual machine at a position of a
+    VMTable"""
+    __slots__ = ('_table', '_i')
+
+    def __init__(self, table, i):
+        self._table = table
+        self._i = i
+
+    def __getitem__(self, key):
+        return self._table._get(self._i, key)
+
+    def __setitem__(self, key, value):
+        self._table._set(self._i, key, value)
+
+    def __contains__(self, key):
+        return key in self._table._columns or \
+            key in self._table._extra.get(self._i, ())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return vm_keys + self._table._extra.get(self._i, {}).keys()
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def update(self, other):
+        for key in other.keys():
+            self[key] = other[key]
+
+    def copy(self):
+        return dict(self.items())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, VMRow):
+            return self._table is other._table and self._i == other._i
+        return isinstance(other, dict) and self.copy() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._table), self._i))
+
+    def __lt__(self, other):
+        return self['id'] < other['id']
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+class VMTable(object):
+    """Store the virtual machines parameters in columns and keep indexes by
+    ``id``, ``ip``, ``mac`` and ``host``. Iterating over the table or
+    indexing it returns ``VMRow`` objects that can be used as the VM dicts,
+    and modifications made through them update the indexes. The table is
+    modified in place, a VMRow staying on its position like a list index.
+    """
+    __slots__ = ('_columns', '_extra', '_index', '_hosts')
+
+    def __init__(self, vms=None):
+        """:param vms: an iterable of VM dicts"""
+        self._columns = {key: array('l') if key in int_keys else []
+                         for key in vm_keys}
+        self._extra = {}
+        self._index = {key: {} for key in unique_keys}
+        self._hosts = {}
+        if vms:
+            self.extend(vms)
+
+    def __len__(self):
+        return len(self._columns['id'])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield VMRow(self, i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [VMRow(self, j) for j in xrange(*i.indices(len(self)))]
+        return VMRow(self, self._position(i))
+
+    def __setitem__(self, i, value):
+        if not isinstance(i, slice):
+            self._replace(self._position(i), dict(value.items()))
+            return
+        # the VMs are copied first, as they may be rows of the table
+        vms = [dict(vm.items()) for vm in value]
+        start, stop, step = i.indices(len(self))
+        if step == 1:
+            self._splice(start, max(start, stop), vms)
+            return
+        positions = range(start, stop, step)
+        if len(vms) != len(positions):
+            raise ValueError('attempt to assign sequence of size %s to '
+                             'extended slice of size %s' %
+                             (len(vms), len(positions)))
+        for j, vm in zip(positions, vms):
+            self._replace(j, vm)
+
+    def __delitem__(self, i):
+        if not isinstance(i, slice):
+            j = self._position(i)
+            self._splice(j, j + 1, [])
+            return
+        start, stop, step = i.indices(len(self))
+        if step == 1:
+            self._splice(start, max(start, stop), [])
+            return
+        for j in sorted(xrange(start, stop, step), reverse=True):
+            self._splice(j, j + 1, [])
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return 'VMTable(%s)' % (list(self), )
+
+    def append(self, vm):
+        """Add a VM given as a dict"""
+        i = len(self)
+        for key in vm_keys:
+            self._columns[key].append(_to_column(key, vm.get(key)))
+        for key in vm.keys():
+            if key not in self._columns:
+                self._extra.setdefault(i, {})[key] = vm[key]
+        self._add_index(i)
+
+    def extend(self, vms):
+        """Add several VMs given as dicts"""
+        for vm in vms:
+            self.append(vm)
+
+    def by_id(self, vm_id):
+        """Return the VM with the given id or None"""
+        return self._lookup('id', vm_id)
+
+    def by_ip(self, ip):
+        """Return the VM with the given ip or None"""
+        return self._lookup('ip', ip)
+
+    def by_mac(self, mac):
+        """Return the VM with the given mac or None"""
+        return self._lookup('mac', mac)
+
+    def on_host(self, host):
+        """Return the list of VMs placed on a host"""
+        return [VMRow(self, i) for i in sorted(self._hosts.get(host, ()))]
+
+    def hosts(self):
+        """Return the list of hosts that have at least one VM"""
+        return [host for host, vms in self._hosts.iteritems() if vms]
+
+    def column(self, key):
+        """Return the list of the values of a VM parameter"""
+        column = self._columns[key]
+        if key in int_keys and _null_int in column:
+            return [None if value == _null_int else value
+                    for value in column]
+        return list(column)
+
+    def set_column(self, key, values):
+        """Set a VM parameter from a dict whose keys are the positions of
+        the VMs and values the new values"""
+        if key != 'host':
+            for i, value in values.iteritems():
+                self._set(i, key, value)
+            return
+        column, hosts = self._columns['host'], self._hosts
+        for i, value in values.iteritems():
+            hosts[column[i]].discard(i)
+            hosts.setdefault(value, set()).add(i)
+            column[i] = value
+
+    def to_dicts(self):
+        """Return the VMs as a list of dicts"""
+        return [vm.copy() for vm in self]
+
+    def _lookup(self, key, value):
+        i = self._index[key].get(value)
+        return None if i is None else VMRow(self, i)
+
+    def _position(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('VMTable index out of range')
+        return i
+
+    def _get(self, i, key):
+        if key in self._columns:
+            value = self._columns[key][i]
+            return None if value == _null_int and key in int_keys else value
+        if i in self._extra and key in self._extra[i]:
+            return self._extra[i][key]
+        raise KeyError(key)
+
+    def _set(self, i, key, value):
+        if key not in self._columns:
+            self._extra.setdefault(i, {})[key] = value
+            return
+        old = self._columns[key][i]
+        self._columns[key][i] = _to_column(key, value)
+        if key in self._index:
+            if self._index[key].get(old) == i:
+                del self._index[key][old]
+            if value is not None:
+                self._index[key][value] = i
+        elif key == 'host':
+            self._hosts[old].discard(i)
+            self._hosts.setdefault(value, set()).add(i)
+
+    def _replace(self, i, vm):
+        """Replace the VM at a position by a VM given as a dict"""
+        for key in vm_keys:
+            self._set(i, key, vm.get(key))
+        self._extra.pop(i, None)
+        for key in vm.keys():
+            if key not in self._columns:
+                self._extra.setdefault(i, {})[key] = vm[key]
+
+    def _splice(self, start, stop, vms):
+        """Replace the VMs from start to stop by VMs given as dicts, and
+        shift the positions of the following VMs in the indexes"""
+        n = len(self)
+        for j in xrange(start, n):
+            self._remove_index(j)
+        for key in vm_keys:
+            values = [_to_column(key, vm.get(key)) for vm in vms]
+            self._columns[key][start:stop] = array('l', values) \
+                if key in int_keys else values
+        extra = {}
+        for j, values in self._extra.iteritems():
+            if j < start:
+                extra[j] = values
+            elif j >= stop:
+                extra[j - stop + start + len(vms)] = values
+        for k, vm in enumerate(vms):
+            values = {key: vm[key] for key in vm.keys()
+                      if key not in self._columns}
+            if values:
+                extra[start + k] = values
+        self._extra = extra
+        for j in xrange(start, len(self)):
+            self._add_index(j)
+
+    def _add_index(self, i):
+        for key in unique_keys:
+            value = self._columns[key][i]
+            if value is not None:
+                self._index[key][value] = i
+        self._hosts.setdefault(self._columns['host'][i], set()).add(i)
+
+    def _remove_index(self, i):
+        for key in unique_keys:
+            value = self._columns[key][i]
+            if self._index[key].get(value) == i:
+                del self._index[key][value]
+        self._hosts[self._columns['host'][i]].discard(i)
+
+
+def _to_column(key, value):
+    """Return the value stored in a column for a VM parameter"""
+    if key in int_keys:
+        return _null_int if value is None else int(value)
+    return value
+
+
+def vms_by(vms, key):
+    """Return a mapping from the value of a unique VM parameter (``id``,
+    ``ip`` or ``mac``) to the VM, for a VMTable or a list of VM dicts"""
+    if isinstance(vms, VMTable):
+        return _table_index(vms, key)
+    return {vm[key]: vm for vm in vms}
+
+
+def vms_column(vms, key):
+    """Return the list of the values of a VM parameter, for a VMTable or a
+    list of VM dicts"""
+    if isinstance(vms, VMTable):
+        return vms.column(key)
+    return [vm[key] for vm in vms]
+
+
+def vms_by_host(vms):
+    """Return a dict whose keys are hosts and values the list of VMs placed
+    on it, for a VMTable or a list of VM dicts"""
+    if isinstance(vms, VMTable):
+        return {host: vms.on_host(host) for host in vms.hosts()}
+    hosts_vms = {}
+    for vm in vms:
+        hosts_vms.setdefault(vm['host'], []).append(vm)
+    return hosts_vms
+
+
+class _table_index(object):
+    """A read-only mapping over one of the VMTable indexes"""
+    __slots__ = ('_table', '_key')
+
+    def __init__(self, table, key):
+        self._table = table
+        self._key = key
+
+    def __getitem__(self, value):
+        vm = self._table._lookup(self._key, value)
+        if vm is None:
+            raise KeyError(value)
+        return vm
+
+    def __contains__(self, value):
+        return value in self._table._index[self._key]
+
+    def get(self, value, default=None):
+        vm = self._table._lookup(self._key, value)
+        return default if vm is None else vm
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+#
+#    Tests of the cache of the API attributes, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import unittest
+from os import path
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k.apicache import api_attributes_cache
+
+
+class apicache_test(unittest.TestCase):
+
+    def test_host_lookup(self):
+        requests = []
+
+        def source(cluster, host):
+            requests.append((cluster, host))
+            return {'CPU': 4, 'RAM': 16000, 'flops': 1, 'virtual': True}
+
+        cache = api_attributes_cache(source=source)
+        for i in (3, 4):
+            attr = cache.host('graphene-%s.nancy.grid5000.fr' % (i, ))
+            self.assertEqual(attr['CPU'], 4)
+        self.assertEqual(requests,
+                         [('graphene', 'graphene-3.nancy.grid5000.fr')])
+
+    def test_copies(self):
+        cache = api_attributes_cache(source={'graphene': {'CPU': 4,
+                                                          'RAM': 16000}})
+        attr = cache.cluster('graphene')
+        attr['RAM'] -= 1000
+        self.assertEqual(cache.cluster('graphene')['RAM'], 16000)
+
+
+if __name__ == '__main__':
+    unittest.main()
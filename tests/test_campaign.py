@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+#    Tests of the host pool and of the combination scheduler, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import unittest
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock, Thread
+from time import sleep
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from execo_engine import ParamSweeper, sweep
+from vm5k.campaign import host_pool, combination_scheduler
+from vm5k.ippool import ip_mac_pool, ip_range
+
+
+class host_pool_test(unittest.TestCase):
+
+    def test_groups(self):
+        pool = host_pool(['a1', 'a2', 'a3'], 'a')
+        pool.add(['b1', 'b2'], 'b')
+        hosts = pool.acquire(2, prefer=['b2'])
+        self.assertEqual(hosts, ['b2', 'b1'])
+        self.assertEqual(pool.acquire(3), ['a1', 'a2', 'a3'])
+        self.assertIsNone(pool.acquire(4))
+        self.assertIsNone(pool.acquire(1, timeout=0.01))
+        pool.release(hosts)
+        self.assertEqual(sorted(pool.idle()), ['b1', 'b2'])
+        self.assertEqual(sorted(pool.busy()), ['a1', 'a2', 'a3'])
+
+    def test_remove(self):
+        pool = host_pool(['h1', 'h2', 'h3'])
+        busy = pool.acquire(1)
+        pool.remove(['h1', 'h2'])
+        self.assertEqual(pool.idle(), ['h3'])
+        pool.release(busy)
+        self.assertEqual(pool.idle(), ['h3'])
+        self.assertIsNone(pool.acquire(2))
+
+    def test_wait(self):
+        pool = host_pool(['h1', 'h2'])
+        busy = pool.acquire(2)
+        acquired = []
+        t = Thread(target=lambda: acquired.append(pool.acquire(1)))
+        t.start()
+        sleep(0.05)
+        self.assertEqual(acquired, [])
+        pool.release(busy[:1])
+        t.join(5)
+        self.assertEqual(acquired, [busy[:1]])
+        t = Thread(target=lambda: acquired.append(pool.acquire(2)))
+        t.start()
+        pool.close()
+        t.join(5)
+        self.assertIsNone(acquired[-1])
+
+
+class combination_scheduler_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.lock = Lock()
+        self.running = 0
+        self.max_running = 0
+        self.runs = []
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def sweeper(self, n):
+        return ParamSweeper(self.dir, sweep({'n_vm': range(1, n + 1)}))
+
+    def workflow(self, sweeper, fail=()):
+        def _workflow(comb, hosts, ip_mac):
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+                self.runs.append((comb['n_vm'], tuple(hosts), ip_mac))
+            sleep(0.01)
+            with self.lock:
+                self.running -= 1
+            if comb['n_vm'] in fail:
+                raise ValueError('failed combination')
+            sweeper.done(comb)
+        return _workflow
+
+    def test_run(self):
+        sweeper = self.sweeper(6)
+        pool = host_pool(['h1', 'h2', 'h3', 'h4'])
+        ip_mac = ip_mac_pool(ip_range('10.16.0.0', 24))
+        scheduler = combination_scheduler(
+            sweeper, pool, self.workflow(sweeper), n_nodes=2,
+            cost=lambda comb: comb['n_vm'], ip_mac=ip_mac,
+            comb_nvm=lambda comb: comb['n_vm']).run()
+        self.assertEqual(scheduler.n_done, 6)
+        self.assertEqual(len(sweeper.get_remaining()), 0)
+        self.assertLessEqual(self.max_running, 2)
+        # the most costly combinations first
+        self.assertEqual(sorted(n for n, _, _ in self.runs[:2]), [5, 6])
+        for n, hosts, addresses in self.runs:
+            self.assertEqual(len(hosts), 2)
+            self.assertEqual(len(addresses), n)
+        self.assertEqual(ip_mac.n_free(), len(ip_mac.addresses))
+        self.assertEqual(sorted(pool.idle()), ['h1', 'h2', 'h3', 'h4'])
+
+    def test_max_tries(self):
+        sweeper = self.sweeper(3)
+        scheduler = combination_scheduler(
+            sweeper, host_pool(['h1']), self.workflow(sweeper, fail=[2]),
+            max_tries=2).run()
+        self.assertEqual(scheduler.n_done, 2)
+        self.assertEqual([comb['n_vm'] for comb in sweeper.get_skipped()],
+                         [2])
+        self.assertEqual(len([n for n, _, _ in self.runs if n == 2]), 2)
+
+    def test_affinity(self):
+        # a worker keeps the hosts and takes the combination of the same
+        # parity as the previous one
+        sweeper = self.sweeper(6)
+        last = {}
+
+        def _workflow(comb, hosts, ip_mac):
+            self.runs.append(comb['n_vm'])
+            last[hosts[0]] = comb['n_vm']
+            sweeper.done(comb)
+
+        combination_scheduler(
+            sweeper, host_pool(['h1']), _workflow,
+            cost=lambda comb: comb['n_vm'],
+            affinity=lambda comb, hosts: hosts[0] in last and
+            comb['n_vm'] % 2 == last[hosts[0]] % 2).run()
+        self.assertEqual(self.runs, [6, 4, 2, 5, 3, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
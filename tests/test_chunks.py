@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+#    Tests of the chunk manifests and patches of the disk images, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import json
+import random
+import unittest
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k import chunks
+
+size = 64
+
+
+class chunks_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.random = random.Random(5)
+        self.reference = self.image('reference', 10 * size + 17)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def image(self, name, length, data=None):
+        """Write an image of random bytes, or of the given bytes"""
+        image_path = path.join(self.dir, name)
+        if data is None:
+            data = ''.join(chr(self.random.randint(0, 255))
+                           for _ in xrange(length))
+        with open(image_path, 'wb') as f:
+            f.write(data[:length])
+        return image_path
+
+    def read(self, image):
+        with open(image, 'rb') as f:
+            return f.read()
+
+    def patch(self, image):
+        """Bring an image up to date with the reference, as image_copy and
+        the host script do, and return the patched chunks"""
+        reference = chunks.compute_manifest(self.reference, size)
+        manifest = chunks.compute_manifest(image, size) \
+            if path.exists(image) else None
+        missing = chunks.missing_chunks(reference, manifest)
+        patch = path.join(self.dir, 'patch')
+        chunks.write_patch(self.reference, reference, missing, patch)
+        ref_file = path.join(self.dir, 'reference.ref')
+        with open(ref_file, 'w') as f:
+            json.dump(reference, f)
+        manifest_path = chunks.default_manifest_path(image)
+        self.assertEqual(chunks.main(['apply', image, manifest_path, patch,
+                                      ref_file]), 0)
+        self.assertEqual(self.read(image), self.read(self.reference))
+        adopted = chunks.load_manifest(image, manifest_path, size)
+        self.assertEqual(adopted, chunks.compute_manifest(image, size))
+        self.assertEqual(adopted['digest'], reference['digest'])
+        return missing
+
+    def test_grow(self):
+        data = self.read(self.reference)
+        image = self.image('grow', 6 * size + 5, data[:3 * size] +
+                           'x' * size + data[4 * size:])
+        self.assertEqual(self.patch(image), [3] + range(6, 11))
+
+    def test_shrink(self):
+        data = self.read(self.reference) + 'y' * 3 * size
+        image = self.image('shrink', len(data), data)
+        self.assertEqual(self.patch(image), [10])
+        # on a chunk boundary, the patch only truncates the image
+        self.reference = self.image('reference', 8 * size,
+                                    self.read(self.reference))
+        self.assertEqual(self.patch(image), [])
+
+    def test_missing(self):
+        image = path.join(self.dir, 'missing')
+        self.assertIsNone(chunks.get_manifest(image))
+        self.assertEqual(self.patch(image), range(11))
+
+    def test_cached_manifest(self):
+        manifest = chunks.get_manifest(self.reference, size=size)
+        self.assertEqual(chunks.load_manifest(self.reference, size=size),
+                         manifest)
+        self.assertIsNone(chunks.load_manifest(self.reference, size=size * 2))
+        self.assertEqual(chunks.missing_chunks(
+            manifest, chunks.compute_manifest(self.reference, size * 2)),
+            range(11))
+        with open(self.reference, 'ab') as f:
+            f.write('z')
+        self.assertIsNone(chunks.load_manifest(self.reference, size=size))
+
+
+if __name__ == '__main__':
+    unittest.main()
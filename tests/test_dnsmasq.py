@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+#    Tests of the incremental configuration of dnsmasq, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import unittest
+from os import path
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k.backend import get_backend, set_backend
+from vm5k.services.dnsmasq import dhcp_ranges, hosts_lines, \
+    _conf_outdated, _update_file
+
+
+class recorded_action():
+
+    def __init__(self, func):
+        self.func = func
+
+    def run(self):
+        self.func()
+        return self
+
+
+class file_backend():
+    """A backend recording the content of the files put on the server and
+    the commands installing them"""
+
+    def __init__(self):
+        self.puts = []
+        self.cmds = []
+
+    def get_fileput(self, hosts, local_files, remote_location='.',
+                    tool=None):
+        def _put():
+            for local_file in local_files:
+                with open(local_file) as f:
+                    self.puts.append(f.read())
+        return recorded_action(_put)
+
+    def get_ssh_process(self, cmd, host):
+        return recorded_action(lambda: self.cmds.append(cmd))
+
+
+def vms_list(ips):
+    return [{'id': 'vm-%s' % (i, ), 'ip': ip} for i, ip in enumerate(ips)]
+
+
+class dnsmasq_test(unittest.TestCase):
+
+    def setUp(self):
+        self.previous = get_backend()
+        self.backend = set_backend(file_backend())
+
+    def tearDown(self):
+        set_backend(self.previous)
+
+    def test_dhcp_ranges(self):
+        self.assertEqual(dhcp_ranges([]), [])
+        self.assertEqual(dhcp_ranges(['10.0.1.1', '10.0.0.253', '10.0.0.1',
+                                      '10.0.0.2', '10.0.0.1']),
+                         [('10.0.0.1', '10.0.0.2'),
+                          ('10.0.0.253', '10.0.1.1')])
+        self.assertEqual(dhcp_ranges(['10.0.0.5', '10.0.0.3', '10.0.0.1']),
+                         [('10.0.0.1', '10.0.0.1'), ('10.0.0.3', '10.0.0.3'),
+                          ('10.0.0.5', '10.0.0.5')])
+        # .253 to .1 of the next block only skips .254, .255 and .0
+        self.assertEqual(dhcp_ranges(['10.0.2.1', '10.0.0.253']),
+                         [('10.0.0.253', '10.0.0.253'),
+                          ('10.0.2.1', '10.0.2.1')])
+
+    def test_conf_outdated(self):
+        conf = ['domain-needed', 'dhcp-range=10.0.0.1,10.0.0.20,12h']
+        new_conf = 'domain-needed\ndhcp-range=10.0.0.1,10.0.0.30,12h\n'
+        self.assertFalse(_conf_outdated(conf, new_conf, ['10.0.0.5',
+                                                         '10.0.0.20']))
+        self.assertTrue(_conf_outdated(conf, new_conf, ['10.0.0.5',
+                                                        '10.0.0.21']))
+        self.assertFalse(_conf_outdated(conf, new_conf, []))
+        self.assertTrue(_conf_outdated(conf, 'bogus-priv\n' + new_conf,
+                                       ['10.0.0.5']))
+        # without dhcp, the ranges are not checked
+        self.assertFalse(_conf_outdated(conf[:1], 'domain-needed\n',
+                                        ['10.0.0.50']))
+
+    def update(self, current, vms):
+        return _update_file('server', '/etc/vms', current, vms,
+                            lambda vm: (vm['ip'], ), hosts_lines)
+
+    def test_update_file(self):
+        vms = vms_list(['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        current = {'vm-0': ('10.0.0.1', ), 'vm-1': ('10.0.0.2', )}
+        added, n_removed = self.update(current, vms)
+        self.assertEqual([vm['id'] for vm in added], ['vm-2'])
+        self.assertEqual(n_removed, 0)
+        self.assertEqual(self.backend.puts, [''.join(hosts_lines(vms[2:]))])
+        self.assertTrue(self.backend.cmds[0].startswith('cat '))
+        self.assertIn(' >> /etc/vms', self.backend.cmds[0])
+        # no change, nothing is sent
+        self.assertEqual(self.update(dict(current, **{'vm-2': ('10.0.0.3',
+                                                               )}), vms),
+                         ([], 0))
+        self.assertEqual(len(self.backend.puts), 1)
+
+    def test_rewrite_file(self):
+        vms = vms_list(['10.0.0.1', '10.0.0.4'])
+        for current, removed in [({'vm-0': ('10.0.0.1', ),
+                                   'vm-5': ('10.0.0.9', )}, 1),
+                                 ({'vm-0': ('10.0.0.1', ),
+                                   'vm-1': ('10.0.0.2', )}, 1)]:
+            self.backend.puts, self.backend.cmds = [], []
+            added, n_removed = self.update(current, vms)
+            self.assertEqual(n_removed, removed)
+            self.assertEqual([vm['id'] for vm in added], ['vm-1'])
+            self.assertEqual(self.backend.puts, [''.join(hosts_lines(vms))])
+            self.assertTrue(self.backend.cmds[0].startswith('cp '))
+            self.assertIn(' /etc/vms', self.backend.cmds[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+#    Tests of the plans of the host state tracker, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import unittest
+from os import path
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k.engine import host_state_tracker
+
+
+def vm_dict(i, host='h0', **params):
+    vm = {'id': 'vm-%s' % (i, ), 'ip': '10.0.0.%s' % (i, ),
+          'mac': '02:00:00:00:00:%02x' % (i, ), 'host': host, 'mem': 512,
+          'n_cpu': 1, 'cpuset': 'auto', 'tap': None, 'hdd': 10,
+          'backing_file': '/tmp/vm-base.img', 'real_file': False}
+    vm.update(params)
+    return vm
+
+
+def ids(vms):
+    return [vm['id'] for vm in vms]
+
+
+class host_state_tracker_test(unittest.TestCase):
+
+    def setUp(self):
+        self.states = host_state_tracker()
+        self.states.record([vm_dict(i) for i in range(3)], ['h0'], 'a')
+
+    def test_unknown(self):
+        vms = [vm_dict(0), vm_dict(1, 'h1')]
+        plan = self.states.plan(vms, ['h0', 'h1'])
+        self.assertEqual(plan['unknown'], ['h1'])
+        self.assertEqual(ids(plan['keep']), ['vm-0'])
+        self.assertEqual(ids(plan['define']), ['vm-1'])
+        self.assertEqual(ids(plan['disk']), ['vm-1'])
+
+    def test_keep(self):
+        plan = self.states.plan([vm_dict(i) for i in range(3)], ['h0'])
+        self.assertEqual(ids(plan['keep']), ['vm-0', 'vm-1', 'vm-2'])
+        self.assertEqual(plan['define'], [])
+        self.assertEqual(plan['disk'], [])
+        self.assertEqual(plan['undefine'], {})
+        self.assertEqual(plan['rm'], {})
+
+    def test_redefine(self):
+        # a change of the domain keeps the disk
+        vms = [vm_dict(0, cpuset='2'), vm_dict(1, mem=1024), vm_dict(2)]
+        plan = self.states.plan(vms, ['h0'])
+        self.assertEqual(ids(plan['define']), ['vm-0', 'vm-1'])
+        self.assertEqual(plan['undefine'], {'h0': ['vm-0', 'vm-1']})
+        self.assertEqual(plan['disk'], [])
+        self.assertEqual(ids(plan['keep']), ['vm-2'])
+
+    def test_disks(self):
+        vms = [vm_dict(0, hdd=20), vm_dict(1), vm_dict(2)]
+        plan = self.states.plan(vms, ['h0'])
+        self.assertEqual(ids(plan['disk']), ['vm-0'])
+        self.assertEqual(plan['define'], [])
+        self.assertEqual(ids(plan['keep']), ['vm-1', 'vm-2'])
+        plan = self.states.plan(vms, ['h0'], fresh_disks=True)
+        self.assertEqual(ids(plan['disk']), ['vm-0', 'vm-1', 'vm-2'])
+        self.assertEqual(plan['keep'], [])
+        plan = self.states.plan(vms, ['h0'], fresh_disks=lambda vm:
+                                vm['id'] == 'vm-2')
+        self.assertEqual(ids(plan['disk']), ['vm-0', 'vm-2'])
+        self.assertEqual(ids(plan['keep']), ['vm-1'])
+        self.assertEqual(plan['define'], [])
+
+    def test_removed(self):
+        vms = [vm_dict(1), vm_dict(3)]
+        plan = self.states.plan(vms, ['h0'])
+        self.assertEqual(plan['undefine'], {'h0': ['vm-0', 'vm-2']})
+        self.assertEqual(plan['rm'], {'h0': ['vm-0', 'vm-2']})
+        self.assertEqual(ids(plan['keep']), ['vm-1'])
+        self.assertEqual(ids(plan['define']), ['vm-3'])
+        self.assertEqual(ids(plan['disk']), ['vm-3'])
+
+    def test_record(self):
+        self.assertEqual(self.states.key(['h0']), 'a')
+        self.assertEqual([ip for ip, _ in self.states.ip_mac(['h0'])],
+                         ['10.0.0.0', '10.0.0.1', '10.0.0.2'])
+        self.states.record([vm_dict(4, 'h1')], ['h1'], 'a')
+        self.assertEqual(self.states.key(['h0', 'h1']), 'a')
+        self.states.record([], ['h1'], 'b')
+        self.assertIsNone(self.states.key(['h0', 'h1']))
+        self.assertEqual(self.states.ip_mac(['h1']), [])
+        self.states.forget(['h0'])
+        self.assertIsNone(self.states.key(['h0']))
+        self.assertEqual(self.states.plan([vm_dict(0)], ['h0'])['unknown'],
+                         ['h0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
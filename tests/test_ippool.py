@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+#    Tests of the allocator of (ip, mac), run with
+#    python -m unittest discover -s tests
+#
+import sys
+import json
+import unittest
+from os import path, getpid, getppid
+from shutil import rmtree
+from socket import gethostname
+from subprocess import Popen
+from tempfile import mkdtemp
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k.ippool import ip_mac_pool, ip_range
+
+
+class ippool_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.store = path.join(self.dir, 'ip_mac.json')
+        self.addresses = ip_range('10.16.0.0', 24)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write_store(self, owners):
+        """Write a store with the allocations of some pids of this host"""
+        with open(self.store, 'w') as f:
+            json.dump({'owners': {'%s:%s:0' % (gethostname(), pid): ip_mac
+                                  for pid, ip_mac in owners.iteritems()}}, f)
+
+    def read_store(self):
+        with open(self.store) as f:
+            owners = json.load(f)['owners']
+        return {int(owner.split(':')[1]): [tuple(ip_mac) for ip_mac in
+                                           allocated]
+                for owner, allocated in owners.iteritems()}
+
+    def ended_pid(self):
+        ended = Popen(['true'])
+        ended.wait()
+        return ended.pid
+
+    def test_exhaustion(self):
+        pool = ip_mac_pool(self.addresses[:10])
+        self.assertEqual(len(pool.allocate(8)), 8)
+        last = pool.allocate(5)
+        self.assertEqual(len(last), 2)
+        self.assertEqual(pool.allocate(1), [])
+        self.assertEqual(pool.n_free(), 0)
+        pool.release(last[:1])
+        self.assertEqual(pool.allocate(3), last[:1])
+
+    def test_prefer(self):
+        pool = ip_mac_pool(self.addresses)
+        first = pool.allocate(4)
+        pool.release(first)
+        again = pool.allocate(2, prefer=[first[2], ('192.168.0.1', None),
+                                         first[0]])
+        self.assertEqual(again, [first[2], first[0]])
+        # the preferred addresses are no longer free
+        others = pool.allocate(4)
+        self.assertEqual(others[:2], [first[1], first[3]])
+        self.assertEqual(len(set(again + others)), 6)
+        self.assertEqual(pool.allocate(1, prefer=[first[0]]),
+                         [self.addresses[6]])
+
+    def test_batched_save(self):
+        pool = ip_mac_pool(self.addresses, store=self.store, save_delay=3600)
+        pool.allocate(3)
+        self.assertEqual(len(self.read_store()[getpid()]), 3)
+        pool.allocate(2)
+        self.assertEqual(len(self.read_store()[getpid()]), 3)
+        pool.flush()
+        self.assertEqual(len(self.read_store()[getpid()]), 5)
+        self.assertEqual(ip_mac_pool(self.addresses, store=self.store,
+                                     reclaim=False).n_free(),
+                         len(self.addresses) - 5)
+
+    def test_reclaim(self):
+        self.write_store({self.ended_pid(): list(self.addresses[:4])})
+        pool = ip_mac_pool(self.addresses, store=self.store)
+        self.assertEqual(pool.n_free(), len(self.addresses))
+        self.write_store({getppid(): list(self.addresses[:4])})
+        pool = ip_mac_pool(self.addresses, store=self.store)
+        self.assertEqual(pool.allocated(), list(self.addresses[:4]))
+
+    def test_shared_store(self):
+        # the allocations of the pools are merged, and only those of the
+        # ended runs are reclaimed
+        ended = self.ended_pid()
+        self.write_store({getppid(): list(self.addresses[:2]),
+                          ended: list(self.addresses[2:4])})
+        pool = ip_mac_pool(self.addresses, store=self.store, save_delay=0)
+        self.assertEqual(pool.allocate(2), list(self.addresses[2:4]))
+        self.assertEqual(self.read_store(),
+                         {getppid(): list(self.addresses[:2]),
+                          getpid(): list(self.addresses[2:4])})
+        # another pool of this run allocates addresses meanwhile
+        other = ip_mac_pool(self.addresses, store=self.store, save_delay=0)
+        self.assertEqual(other.allocate(2), list(self.addresses[4:6]))
+        self.assertEqual(pool.allocate(1), [self.addresses[6]])
+        # the other run releases an address
+        with open(self.store) as f:
+            stored = json.load(f)
+        stored['owners']['%s:%s:0' % (gethostname(), getppid())] = \
+            [self.addresses[1]]
+        with open(self.store, 'w') as f:
+            json.dump(stored, f)
+        self.assertEqual(pool.allocate(2), [self.addresses[0],
+                                            self.addresses[7]])
+        pool.release(list(self.addresses[2:4]))
+        self.assertEqual(sorted(ip for ip, _ in pool.allocated()),
+                         sorted(ip for ip, _ in list(self.addresses[:2]) +
+                                list(self.addresses[4:8])))
+
+    def test_release_loaded(self):
+        # an address of the store released and then reached by the next
+        # index is given only once
+        self.write_store({getppid(): list(self.addresses[:3])})
+        pool = ip_mac_pool(self.addresses[:10], store=self.store,
+                           reclaim=False)
+        pool.release(list(self.addresses[1:2]))
+        self.write_store({getppid(): [self.addresses[0], self.addresses[2]]})
+        allocated = pool.allocate(10)
+        self.assertEqual(len(allocated), 8)
+        self.assertEqual(len(set(allocated)), 8)
+        self.assertEqual(pool.n_free(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#
+#    Tests of the journal of the deployments, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import unittest
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from execo import Host
+from vm5k.actions import define_vms
+from vm5k.journal import deployment_journal, journal_run
+
+
+def vms_list(hosts):
+    vms = define_vms(['vm-%s' % (i, ) for i in range(len(hosts))],
+                     ip_mac=[('10.0.0.%s' % (i, ), '02:00:00:00:00:%02x' %
+                              (i, )) for i in range(len(hosts))])
+    for vm, host in zip(vms, hosts):
+        vm['host'] = host
+    return vms
+
+
+def ids(vms):
+    return [vm['id'] for vm in vms]
+
+
+class journal_test(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.file = path.join(self.dir, 'journal')
+        self.hosts = ['h0', 'h1', 'h2']
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_resume(self):
+        journal = deployment_journal(self.file)
+        journal.record_run(options={'n_vm': 3})
+        journal.record_hosts('deployed', [Host('h0'), 'h1', 'h2'])
+        journal.record_hosts('packages', ['h0', 'h1'])
+        journal.record_ko(['h1', 'h2'])
+        journal.record_hosts('deployed', ['h2'])
+        vms = vms_list(['h0', 'h0', 'h2'])
+        journal.record_vms('placed', vms)
+        journal.record_vms('disk', vms)
+        journal.record_vms('defined', vms[:2])
+        # the records of the run are not done work before it is resumed
+        self.assertEqual(journal.hosts_todo('deployed', self.hosts),
+                         self.hosts)
+        with open(self.file, 'a') as f:
+            f.write('{"stage": "ready", "vms": [["vm-0"')
+
+        journal = deployment_journal(self.file, resume=True)
+        self.assertTrue(journal.resumed)
+        self.assertEqual(journal.run, {'options': {'n_vm': 3}})
+        self.assertEqual(journal_run(self.file), journal.run)
+        self.assertEqual(journal.ko_hosts, set(['h1']))
+        self.assertEqual(journal.hosts_todo('deployed', self.hosts), [])
+        self.assertEqual(journal.hosts_todo('packages', self.hosts), ['h2'])
+        self.assertEqual(journal.hosts_done('packages', [Host('h0')]),
+                         [Host('h0')])
+        self.assertEqual(journal.placement['vm-2'],
+                         {'host': 'h2', 'ip': '10.0.0.2',
+                          'mac': '02:00:00:00:00:02'})
+        # vm-1 is now placed on another host, its stages are done again
+        vms = vms_list(['h0', 'h1', 'h2'])
+        self.assertEqual(ids(journal.vms_todo('disk', vms)), ['vm-1'])
+        self.assertEqual(ids(journal.vms_done('disk', vms)), ['vm-0', 'vm-2'])
+        self.assertEqual(ids(journal.vms_todo('defined', vms)),
+                         ['vm-1', 'vm-2'])
+        self.assertEqual(ids(journal.vms_todo('ready', vms)), ids(vms))
+
+        # the resumed run appends to the journal
+        journal.record_vms('ready', vms)
+        journal = deployment_journal(self.file, resume=True)
+        self.assertEqual(journal.vms_todo('ready', vms), [])
+        self.assertEqual(journal.hosts_todo('packages', self.hosts), ['h2'])
+
+    def test_new_journal(self):
+        deployment_journal(self.file).record_hosts('deployed', self.hosts)
+        journal = deployment_journal(self.file)
+        self.assertFalse(path.exists(self.file))
+        self.assertEqual(journal.hosts_todo('deployed', self.hosts),
+                         self.hosts)
+        journal = deployment_journal(path.join(self.dir, 'no', 'journal'))
+        journal.record_hosts('deployed', self.hosts)
+        self.assertFalse(path.exists(path.join(self.dir, 'no')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+#
+#    Tests of the package plans, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import unittest
+from os import path
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k.packages import package_plan, base_packages, libvirt_packages, \
+    libvirt_release
+
+
+class packages_test(unittest.TestCase):
+
+    def test_recommends(self):
+        base = package_plan(upgrade=True, recommends=False).add(base_packages)
+        cmd = base.command()
+        self.assertIn('apt-get update && apt-get dist-upgrade', cmd)
+        self.assertIn('--no-install-recommends ' + ' '.join(base_packages),
+                      cmd)
+        plan = package_plan().add(libvirt_packages, libvirt_release)
+        self.assertNotIn('--no-install-recommends', plan.command())
+
+    def test_no_update(self):
+        plan = package_plan().add('iperf,htop').add(['htop'], 'testing')
+        self.assertEqual(plan.targets(), ['iperf', 'htop/testing'])
+        cmd = plan.command(update=False)
+        self.assertNotIn('apt-get update', cmd)
+        self.assertTrue(cmd.endswith('iperf htop/testing'))
+        self.assertTrue(package_plan().command(update=False).endswith('true'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+#    Tests of the host pipeline, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import unittest
+from os import path
+from threading import Lock
+from time import sleep, time
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k.pipeline import host_pipeline, pipeline_stage, \
+    default_max_workers
+
+
+class recorder():
+    """Stage functions recording the (stage, host, start, end) of their
+    calls, with a duration per host"""
+
+    def __init__(self, durations=None):
+        self.durations = durations if durations else {}
+        self.calls = []
+        self.failed = set()
+        self.lock = Lock()
+
+    def stage(self, name, fail=()):
+        def _func(hosts):
+            start = time()
+            sleep(max(self.durations.get((name, host), 0.001)
+                      for host in hosts))
+            with self.lock:
+                self.calls.append((name, tuple(hosts), start, time()))
+                for host in hosts:
+                    if host in fail:
+                        self.failed.add(host)
+        return _func
+
+    def call(self, name, host):
+        return [c for c in self.calls if c[0] == name and host in c[1]][0]
+
+
+def deployment_stages(rec, wave_delay=0):
+    """The graph of stages of vm5k_deployment._run_pipeline"""
+    return [pipeline_stage('base', rec.stage('base')),
+            pipeline_stage('copy', rec.stage('copy'), ['base'],
+                           wave_delay=wave_delay),
+            pipeline_stage('packages', rec.stage('packages'), ['base']),
+            pipeline_stage('libvirt', rec.stage('libvirt'), ['packages']),
+            pipeline_stage('disks', rec.stage('disks'), ['libvirt', 'copy']),
+            pipeline_stage('vms', rec.stage('vms'), ['disks'], barrier=True)]
+
+
+class pipeline_test(unittest.TestCase):
+
+    def test_copy_overlap(self):
+        # the copy runs while the packages and libvirt are installed, and
+        # the disks of a host wait for its copy
+        rec = recorder({('copy', 'h1'): 0.3, ('libvirt', 'h0'): 0.05})
+        pipeline = host_pipeline(['h0', 'h1'], deployment_stages(rec))
+        pipeline.run()
+        for name in ['base', 'copy', 'packages', 'disks']:
+            self.assertEqual([c[1] for c in rec.calls if c[0] == name],
+                             [('h0', 'h1')])
+        self.assertLess(rec.call('libvirt', 'h1')[3],
+                        rec.call('copy', 'h1')[3])
+        self.assertGreaterEqual(rec.call('disks', 'h1')[2],
+                                rec.call('copy', 'h1')[3])
+        vms = [c for c in rec.calls if c[0] == 'vms']
+        self.assertEqual(len(vms), 1)
+        self.assertGreaterEqual(vms[0][2], rec.call('disks', 'h1')[3])
+        report = pipeline.report()
+        self.assertEqual([step['stage'] for step in report['critical_path']],
+                         ['base', 'copy', 'disks', 'vms'])
+
+    def test_wave_delay(self):
+        # the first hosts ready for the copy wait for the others, until the
+        # delay has passed
+        hosts = ['h0', 'h1', 'h2', 'h3']
+        pipeline = host_pipeline(hosts, deployment_stages(recorder(), 10))
+        pipeline._started['base'].update(hosts)
+        pipeline._done['base'].update(['h0', 'h1'])
+        with pipeline._cond:
+            pipeline._launch_ready()
+            self.assertEqual(pipeline._started['copy'], set())
+            self.assertEqual(pipeline._started['packages'],
+                             set(['h0', 'h1']))
+            self.assertGreater(pipeline._wake, time() + 5)
+            pipeline._done['base'].add('h2')
+            pipeline._ready_since['copy']['h0'] -= 10
+            pipeline._launch_ready()
+            self.assertEqual(pipeline._started['copy'],
+                             set(['h0', 'h1', 'h2']))
+            pipeline._done['base'].add('h3')
+            pipeline._launch_ready()
+            self.assertEqual(pipeline._started['copy'], set(hosts))
+            while pipeline._running:
+                pipeline._cond.wait()
+
+    def test_failed_host(self):
+        rec = recorder()
+        stages = deployment_stages(rec)
+        stages[1] = pipeline_stage('copy', rec.stage('copy', ['h1']),
+                                   ['base'])
+        pipeline = host_pipeline(['h0', 'h1'], stages,
+                                 check=lambda hosts: [h for h in hosts
+                                                      if h not in rec.failed])
+        pipeline.run()
+        self.assertEqual(pipeline.failed, set(['h1']))
+        self.assertFalse([c for c in rec.calls
+                          if c[0] == 'disks' and 'h1' in c[1]])
+        self.assertEqual([c[1] for c in rec.calls if c[0] == 'vms'],
+                         [('h0', )])
+
+    def test_error(self):
+        def _fail(hosts):
+            raise ValueError('stage error')
+        stages = [pipeline_stage('a', lambda hosts: None),
+                  pipeline_stage('b', _fail, ['a'])]
+        self.assertRaises(ValueError, host_pipeline(['h0'], stages).run)
+
+    def test_max_workers(self):
+        # more stages are ready than workers, the stages left over are
+        # launched when workers end
+        running = [0, 0]
+        lock = Lock()
+
+        def _func(hosts):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            sleep(0.005)
+            with lock:
+                running[0] -= 1
+        stages = [pipeline_stage('a%s' % (i, ), _func) for i in range(6)] + \
+            [pipeline_stage('b%s' % (i, ), _func, ['a%s' % (i, )])
+             for i in range(6)] + \
+            [pipeline_stage('c', _func, ['b%s' % (i, ) for i in range(6)],
+                            barrier=True)]
+        hosts = ['h%s' % (i, ) for i in range(8)]
+        pipeline = host_pipeline(hosts, stages, max_workers=2).run()
+        self.assertLessEqual(running[1], 2)
+        for stage in stages:
+            self.assertEqual(sorted(pipeline.timings[stage.name]), hosts)
+        self.assertEqual(host_pipeline(hosts, stages).max_workers,
+                         default_max_workers)
+
+
+if __name__ == '__main__':
+    unittest.main()
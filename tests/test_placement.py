@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+#    Tests of the placement engine, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import unittest
+from os import path
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k.actions import define_vms
+from vm5k.placement import placement_engine, placement_modes
+
+
+def hosts_attr(n_hosts, ram, cpu):
+    return {'h%s' % (i, ): {'RAM': ram, 'CPU': cpu} for i in range(n_hosts)}
+
+
+def vms_list(n_vms, mem=512, n_cpu=3):
+    return [{'id': 'vm-%s' % (i, ), 'mem': mem, 'n_cpu': n_cpu,
+             'host': None} for i in range(n_vms)]
+
+
+class placement_test(unittest.TestCase):
+
+    def place(self, mode, attr, vms):
+        engine = placement_engine(sorted(attr), mode, attr)
+        return engine, engine.place(vms)
+
+    def test_cpu_bound(self):
+        # a host keeps some CPU, so 9 VMs of one core fit on 10 cores
+        attr = hosts_attr(10, 10 ** 7, 10)
+        for mode in placement_modes:
+            vms = vms_list(200)
+            _, report = self.place(mode, attr, vms)
+            self.assertFalse(report['feasible'], mode)
+            self.assertEqual(report['placed'], 90, mode)
+            self.assertEqual(report['max_vms'], 90, mode)
+            self.assertEqual(len(report['unplaced']), 110, mode)
+            self.assertEqual(sum(1 for vm in vms if vm['host']), 90, mode)
+
+    def test_ram_bound(self):
+        attr = hosts_attr(4, 2048, 100)
+        _, report = self.place('best-fit', attr, vms_list(20))
+        self.assertEqual(report['placed'], 12)
+        self.assertEqual(report['max_vms'], 12)
+
+    def test_best_fit(self):
+        attr = {'small': {'RAM': 1200, 'CPU': 10},
+                'big': {'RAM': 5000, 'CPU': 10},
+                'no-cpu': {'RAM': 1100, 'CPU': 1}}
+        vms = vms_list(3)
+        _, report = self.place('best-fit', attr, vms)
+        self.assertTrue(report['feasible'])
+        self.assertEqual([vm['host'] for vm in vms], ['small', 'small', 'big'])
+
+    def test_balanced(self):
+        attr = {'a': {'RAM': 3000, 'CPU': 10}, 'b': {'RAM': 2000, 'CPU': 10},
+                'no-cpu': {'RAM': 9000, 'CPU': 1}}
+        vms = vms_list(4)
+        self.place('balanced', attr, vms)
+        self.assertEqual([vm['host'] for vm in vms], ['a', 'a', 'b', 'a'])
+
+    def test_mixed_sizes(self):
+        # the big VM does not fit anymore, the small ones still do
+        attr = hosts_attr(1, 4000, 10)
+        vms = vms_list(2, mem=1500) + vms_list(1, mem=1500) + \
+            vms_list(1, mem=500, n_cpu=1)
+        _, report = self.place('best-fit', attr, vms)
+        self.assertEqual(report['placed'], 3)
+        self.assertEqual(vms[3]['host'], 'h0')
+
+    def test_vmtable(self):
+        vms = define_vms(['vm-%s' % (i, ) for i in range(30)], mem=512,
+                         n_cpu=3)
+        engine, report = self.place('best-fit', hosts_attr(3, 10 ** 6, 10),
+                                    vms)
+        self.assertEqual(report['placed'], 27)
+        self.assertEqual(sorted(len(vms.on_host(host))
+                                for host in vms.hosts() if host), [9, 9, 9])
+
+    def test_remove_host(self):
+        attr = hosts_attr(3, 4096, 10)
+        engine = placement_engine(sorted(attr), 'round-robin', attr)
+        engine.remove_host('h0')
+        self.assertFalse(engine.has_host('h0'))
+        report = engine.place(vms_list(30))
+        self.assertEqual(report['available'], {'RAM': 2 * 4096, 'CPU': 20})
+        self.assertEqual(report['max_vms'], 14)
+
+
+if __name__ == '__main__':
+    unittest.main()
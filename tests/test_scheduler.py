@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#
+#    Tests of the scheduler of the VM starts, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import unittest
+from os import path
+from threading import Lock
+from time import sleep
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k.backend import get_backend, set_backend
+from vm5k.scheduler import vm_start_scheduler
+
+
+class counting_process():
+    """A process starting a VM, which records how many starts run at the
+    same time on its host and on all hosts"""
+
+    def __init__(self, backend, cmd, host):
+        self.backend = backend
+        self.vm_id = cmd.split(' start ')[1].split()[0]
+        self.host = host
+        self.stdout = ''
+        self.exit_code = 0
+
+    def run(self):
+        b = self.backend
+        with b.lock:
+            b.running[self.host] = b.running.get(self.host, 0) + 1
+            b.total += 1
+            b.max_host[self.host] = max(b.max_host.get(self.host, 0),
+                                        b.running[self.host])
+            b.max_total = max(b.max_total, b.total)
+        sleep(0.002)
+        with b.lock:
+            b.running[self.host] -= 1
+            b.total -= 1
+        code = 1 if self.vm_id in b.failing else 0
+        self.stdout = '%s 1.0 2.0 %s\n' % (self.vm_id, code)
+        return self
+
+
+class counting_backend():
+
+    def __init__(self, failing=()):
+        self.lock = Lock()
+        self.running = {}
+        self.max_host = {}
+        self.total = 0
+        self.max_total = 0
+        self.failing = set(failing)
+
+    def get_ssh_process(self, cmd, host):
+        return counting_process(self, cmd, host)
+
+
+def vms_list(n_hosts, n_vms):
+    return [{'id': 'vm-%s' % (i, ), 'host': 'h%s' % (i % n_hosts, )}
+            for i in range(n_vms)]
+
+
+class scheduler_test(unittest.TestCase):
+
+    def setUp(self):
+        self.previous = get_backend()
+
+    def tearDown(self):
+        set_backend(self.previous)
+
+    def test_batches(self):
+        ids = ['vm-%s' % (i, ) for i in range(10)]
+        sched = vm_start_scheduler([], host_concurrency=4)
+        self.assertEqual([len(b) for b in sched.batches(ids)], [1, 2, 7])
+        self.assertEqual([len(b) for b in sched.batches(ids[:2])], [1, 1])
+        sched.ramp = False
+        self.assertEqual(sched.batches(ids), [ids])
+
+    def test_host_cmd(self):
+        sched = vm_start_scheduler([], host_concurrency=4)
+        cmd = sched.host_cmd(['vm-%s' % (i, ) for i in range(10)])
+        self.assertEqual([part.split('xargs -P ')[1].split()[0]
+                          for part in cmd.split(' ; ')], ['1', '2', '4'])
+
+    def test_host_limit(self):
+        sched = vm_start_scheduler([], host_concurrency=4)
+        self.assertEqual([sched.host_limit(n) for n in range(6)],
+                         [1, 2, 3, 4, 4, 4])
+        sched.ramp = False
+        self.assertEqual(sched.host_limit(0), 4)
+
+    def test_global_concurrency(self):
+        # more hosts than the global limit
+        backend = set_backend(counting_backend(failing=['vm-7']))
+        vms = vms_list(12, 120)
+        sched = vm_start_scheduler(vms, host_concurrency=3,
+                                   global_concurrency=5).run()
+        self.assertLessEqual(backend.max_total, 5)
+        self.assertLessEqual(max(backend.max_host.values()), 3)
+        self.assertEqual(len(sched.started), 119)
+        self.assertEqual(sched.failed, ['vm-7'])
+
+    def test_global_concurrency_one_host(self):
+        backend = set_backend(counting_backend())
+        sched = vm_start_scheduler(vms_list(1, 30), host_concurrency=8,
+                                   global_concurrency=4, ramp=False).run()
+        self.assertLessEqual(backend.max_total, 4)
+        self.assertEqual(len(sched.started), 30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+#
+#    Tests of the deployment tracer, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import unittest
+from os import path
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k.tracing import deployment_tracer
+
+
+class tracing_test(unittest.TestCase):
+
+    def test_nesting(self):
+        tracer = deployment_tracer()
+
+        @tracer.traced()
+        def step(hosts=None):
+            with tracer.span('inner'):
+                pass
+        with tracer.span('root'):
+            step(hosts=['h0', 'h1'])
+        self.assertIsNone(tracer.current())
+        root, = tracer.roots
+        self.assertEqual([child.name for child in root.children], ['step'])
+        self.assertEqual(root.counts(), (2, 0, 0))
+        self.assertEqual(sorted(tracer.folded())[0].split()[0], 'root')
+
+    def test_max_spans(self):
+        tracer = deployment_tracer(max_spans=3)
+        for _ in range(5):
+            with tracer.span('step'):
+                with tracer.span('action'):
+                    pass
+        self.assertEqual(len(tracer.trace_events()), 3)
+        self.assertEqual(tracer.dropped, 7)
+        tracer.reset()
+        self.assertEqual((tracer.roots, tracer.dropped), ([], 0))
+        with tracer.span('step'):
+            pass
+        self.assertEqual(len(tracer.roots), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
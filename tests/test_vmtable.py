@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+#    Tests of the columnar table of VMs, run with
+#    python -m unittest discover -s tests
+#
+import sys
+import unittest
+from os import path
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'src'))
+from vm5k.vmtable import VMTable, vms_by, vms_column, vms_by_host
+
+
+def vm_dict(i, host='h0', **params):
+    vm = {'id': 'vm-%s' % (i, ), 'ip': '10.0.0.%s' % (i, ),
+          'mac': '02:00:00:00:00:%02x' % (i, ), 'host': host, 'mem': 512,
+          'n_cpu': 1}
+    vm.update(params)
+    return vm
+
+
+def table(n, n_hosts=2):
+    return VMTable([vm_dict(i, 'h%s' % (i % n_hosts, )) for i in range(n)])
+
+
+class vmtable_test(unittest.TestCase):
+
+    def assertIndexed(self, vms):
+        """Check the indexes against the columns"""
+        for i, vm in enumerate(vms):
+            self.assertEqual(vms.by_id(vm['id'])['id'], vm['id'])
+            self.assertEqual(vms.by_ip(vm['ip'])['id'], vm['id'])
+            self.assertIn(vm['id'], [v['id'] for v in vms.on_host(vm['host'])])
+        self.assertEqual(sum(len(vms.on_host(host)) for host in vms.hosts()),
+                         len(vms))
+
+    def test_none_fields(self):
+        vms = VMTable([{'id': 'vm-0', 'mem': None}])
+        self.assertIsNone(vms[0]['mem'])
+        self.assertIsNone(vms[0]['hdd'])
+        self.assertEqual(vms.column('mem'), [None])
+        vms[0]['mem'] = 1024
+        self.assertEqual(vms[0]['mem'], 1024)
+        vms[0]['mem'] = None
+        self.assertIsNone(vms[0]['mem'])
+        vms[0]['ip'] = None
+        self.assertIsNone(vms.by_ip(None))
+
+    def test_row_update(self):
+        vms = table(4)
+        vms[1]['host'] = 'h9'
+        vms[1]['ip'] = '10.1.0.1'
+        vms[1]['tag'] = 'extra'
+        self.assertEqual(vms.by_ip('10.1.0.1')['id'], 'vm-1')
+        self.assertIsNone(vms.by_ip('10.0.0.1'))
+        self.assertEqual([vm['id'] for vm in vms.on_host('h9')], ['vm-1'])
+        self.assertEqual(vms[1]['tag'], 'extra')
+        self.assertIndexed(vms)
+
+    def test_setitem_in_place(self):
+        vms = table(4)
+        row = vms[2]
+        vms[2] = vm_dict(7, 'h5', tag='new')
+        self.assertEqual(row['id'], 'vm-7')
+        self.assertEqual(row['tag'], 'new')
+        self.assertIsNone(vms.by_id('vm-2'))
+        self.assertEqual(vms.by_mac(vm_dict(7)['mac']), row)
+        vms[0] = vms[1]
+        self.assertEqual(vms[0]['host'], 'h1')
+        self.assertIndexed(vms)
+
+    def test_delitem(self):
+        vms = table(6)
+        vms[3]['tag'] = 3
+        first = vms[0]
+        del vms[1]
+        self.assertEqual(len(vms), 5)
+        self.assertEqual(first['id'], 'vm-0')
+        self.assertEqual(vms[2]['tag'], 3)
+        self.assertEqual(vms.by_id('vm-5'), vms[4])
+        self.assertIsNone(vms.by_id('vm-1'))
+        del vms[::2]
+        self.assertEqual(vms_column(vms, 'id'), ['vm-2', 'vm-4'])
+        self.assertIndexed(vms)
+
+    def test_slices(self):
+        vms = table(10)
+        vms[:] = vms[0:4]
+        self.assertEqual(vms_column(vms, 'id'),
+                         ['vm-0', 'vm-1', 'vm-2', 'vm-3'])
+        self.assertIsNone(vms.by_id('vm-7'))
+        vms[1:3] = [vm_dict(20), vm_dict(21), vm_dict(22)]
+        self.assertEqual(vms_column(vms, 'id'),
+                         ['vm-0', 'vm-20', 'vm-21', 'vm-22', 'vm-3'])
+        vms[::2] = [vm_dict(30), vm_dict(31), vm_dict(32)]
+        self.assertEqual(vms_column(vms, 'id'),
+                         ['vm-30', 'vm-20', 'vm-31', 'vm-22', 'vm-32'])
+        self.assertRaises(ValueError, vms.__setitem__, slice(None, None, 2),
+                          [vm_dict(40)])
+        self.assertIndexed(vms)
+
+    def test_helpers(self):
+        vms = table(5, 3)
+        self.assertEqual(vms_by(vms, 'id')['vm-3']['host'], 'h0')
+        self.assertEqual(sorted(len(host_vms) for host_vms
+                                in vms_by_host(vms).itervalues()), [1, 2, 2])
+        dicts = vms.to_dicts()
+        self.assertEqual(vms_by_host(dicts).keys(), vms_by_host(vms).keys())
+
+
+if __name__ == '__main__':
+    unittest.main()